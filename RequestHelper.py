@@ -3,6 +3,7 @@ import json
 import re
 from urllib.parse import unquote
 from utils.llm_proxy_service import ROUTE_PREFIX
+from policy_spec import limits_string, windows_from_rate_limit
 
 class RequestHelper:
     def __init__(self):
@@ -309,12 +310,12 @@ class RequestHelper:
     def get_rate_limiting_string(self):
         """
         Get rate limiting configuration string for app_id + model_id
+        Every request window ("windows" or rpm/rps), e.g. "10/second;500/minute"
         """
         model_config = self.find_model_config()
         if model_config:
             rate_limit = model_config.get("rate_limit", {})
-            rpm = rate_limit.get("rpm", "unknown")
-            return f"{rpm}/minute"
+            return limits_string(windows_from_rate_limit(rate_limit)) or "unknown/minute"
         return "unknown/minute"
 
     def apply_rate_limit(self, request, tokens_requested):
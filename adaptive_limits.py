@@ -0,0 +1,218 @@
+import json
+import threading
+import time
+
+from config_compiler import strip_comments
+from token_bucket import apply_token_bucket
+
+# Header pairs providers use to report headroom: (remaining, limit)
+RATE_LIMIT_HEADERS = [
+    ("x-ratelimit-remaining-tokens", "x-ratelimit-limit-tokens"),
+    ("x-ratelimit-remaining-requests", "x-ratelimit-limit-requests"),
+    ("anthropic-ratelimit-tokens-remaining", "anthropic-ratelimit-tokens-limit"),
+    ("anthropic-ratelimit-requests-remaining", "anthropic-ratelimit-requests-limit")
+]
+
+
+def load_provider_limits(path="load_test_config.txt"):
+    """
+    Load the provider model config ({"models": {provider: {model: {"rate_limit_details": ...}}}})
+    The file has // comments, so they are stripped before parsing
+    Returns {(provider, model_id): rate_limit_details}
+    """
+    with open(path) as f:
+        config = json.loads(strip_comments(f.read()))
+
+    provider_limits = {}
+    for provider, models in config.get("models", {}).items():
+        for model_id, model in models.items():
+            provider_limits[(provider, model_id)] = model["rate_limit_details"]
+    return provider_limits
+
+
+def provider_bucket_id(provider):
+    """
+    app_id of a provider's own buckets (dynamic:{provider:<name>:<model_id>}), apart from every app's
+    """
+    return f"provider:{provider}"
+
+
+def remaining_fraction(headers):
+    """
+    Lowest remaining/limit ratio reported in the response headers, or None if there are none
+    """
+    headers = {k.lower(): v for k, v in headers.items()}
+    fractions = []
+    for remaining_header, limit_header in RATE_LIMIT_HEADERS:
+        try:
+            remaining = float(headers[remaining_header])
+            limit = float(headers[limit_header])
+        except (KeyError, ValueError):
+            continue
+        if limit > 0:
+            fractions.append(remaining / limit)
+    return min(fractions) if fractions else None
+
+
+class AimdController:
+    def __init__(self, base_limits, min_scale=0.25, max_scale=2.0, increase_step=0.05,
+                 increase_interval=1.0, decrease_factor=0.5, decrease_cooldown=2.0, low_watermark=0.1):
+        """
+        Additive-increase / multiplicative-decrease scale on one provider model's configured limits
+        A 429 or a response reporting less than low_watermark headroom cuts the scale by
+        decrease_factor (at most once per decrease_cooldown, so one burst of 429s counts once);
+        otherwise successful responses raise it by increase_step per increase_interval.
+        The default max_scale of 2.0 is the provider's full capacity, since the sample config is set at 50%
+        """
+        self.base_limits = base_limits
+        self.min_scale = min_scale
+        self.max_scale = max_scale
+        self.increase_step = increase_step
+        self.increase_interval = increase_interval
+        self.decrease_factor = decrease_factor
+        self.decrease_cooldown = decrease_cooldown
+        self.low_watermark = low_watermark
+
+        self.scale = 1.0
+        self._last_increase = 0.0
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+
+    def on_response(self, status_code, headers=None, now=None):
+        """
+        Feed one provider response into the controller
+        """
+        if now is None:
+            now = time.time()
+        fraction = remaining_fraction(headers or {})
+
+        with self._lock:
+            if status_code == 429 or (fraction is not None and fraction < self.low_watermark):
+                if now - self._last_decrease >= self.decrease_cooldown:
+                    self.scale = max(self.min_scale, self.scale * self.decrease_factor)
+                    self._last_decrease = now
+                    self._last_increase = now
+            elif 200 <= status_code < 300:
+                if now - self._last_increase >= self.increase_interval:
+                    self.scale = min(self.max_scale, self.scale + self.increase_step)
+                    self._last_increase = now
+
+    def effective_limits(self):
+        """
+        Configured limits with the current scale applied
+        """
+        limits = dict(self.base_limits)
+        for field in ("max_tokens", "refill_rate", "burst_capacity"):
+            if limits.get(field) is not None:
+                limits[field] = limits[field] * self.scale
+        if limits.get("rpm") is not None:
+            limits["rpm"] = max(1, int(limits["rpm"] * self.scale))
+        return limits
+
+
+class AdaptiveProviderLimits:
+    def __init__(self, provider_limits):
+        """
+        One AimdController per provider model; bounds can be set per model with
+        "min_scale"/"max_scale" next to the other rate_limit_details
+        Each worker adapts on the responses it sees itself
+        """
+        self.controllers = {}
+        for key, details in provider_limits.items():
+            bounds = {k: details[k] for k in ("min_scale", "max_scale") if k in details}
+            self.controllers[key] = AimdController(details, **bounds)
+
+    def on_provider_response(self, provider, model_id, status_code, headers=None, now=None):
+        controller = self.controllers.get((provider, model_id))
+        if controller is not None:
+            controller.on_response(status_code, headers, now)
+
+    def limits_for(self, provider, model_id):
+        """
+        Effective limits for a provider model, or None if it isn't configured
+        """
+        controller = self.controllers.get((provider, model_id))
+        return controller.effective_limits() if controller is not None else None
+
+    def check(self, engine, provider, model_id, requested_tokens=None, now=None, dry_run=False):
+        """
+        Check and charge the provider model's own bucket (and rpm window) at the adapted limits
+        with a RedisTokenBucket, shared by every app sending to it
+        Returns the decision dict, or None if the provider model isn't configured
+        """
+        limits = self.limits_for(provider, model_id)
+        if limits is None:
+            return None
+        windows = [(limits["rpm"], 60, "requests")] if limits.get("rpm") is not None else []
+        return engine.check(provider_bucket_id(provider), model_id, requested_tokens, limits, windows,
+                            now=now, dry_run=dry_run)
+
+
+class MockProvider:
+    def __init__(self, tokens_per_minute):
+        """
+        Local stand-in for an LLM provider with a fixed real capacity
+        Answers 429 when over capacity and reports headroom in x-ratelimit-* headers
+        """
+        self.limits = {
+            "max_tokens": tokens_per_minute,
+            "refill_rate": tokens_per_minute / 60,
+            "burst_capacity": 0,
+            "burst_window": 60
+        }
+        self.state = None
+
+    def call(self, tokens, now=None):
+        """
+        Returns (status_code, headers)
+        """
+        if now is None:
+            now = time.time()
+        if self.state is None:
+            self.state = {
+                "available_tokens": self.limits["max_tokens"],
+                "last_refill_ts": now,
+                "burst_tokens_used": 0,
+                "burst_window_start": now
+            }
+
+        allowed, _ = apply_token_bucket(self.state, self.limits, tokens, now)
+        headers = {
+            "x-ratelimit-limit-tokens": str(self.limits["max_tokens"]),
+            "x-ratelimit-remaining-tokens": str(int(self.state["available_tokens"]))
+        }
+        return (200 if allowed else 429), headers
+
+
+# Demo against the mock provider: python adaptive_limits.py
+if __name__ == "__main__":
+    provider_limits = load_provider_limits()
+    adaptive = AdaptiveProviderLimits(provider_limits)
+    provider, model_id = "google", "gemini-1.5-flash-002"
+
+    # Config assumes ~250k TPM and uses half; this region really has 180k
+    mock = MockProvider(tokens_per_minute=180000)
+    client_state = None
+    request_tokens = 1000
+    sent = throttled = 0
+
+    now = 0.0
+    for step in range(6000):
+        now = step * 0.05
+        limits = adaptive.limits_for(provider, model_id)
+        if step % 600 == 0:
+            print(f"t={now:6.1f}s scale={adaptive.controllers[(provider, model_id)].scale:.2f} "
+                  f"refill_rate={limits['refill_rate']:.0f}/s")
+        if client_state is None:
+            client_state = {"available_tokens": limits["max_tokens"], "last_refill_ts": now,
+                            "burst_tokens_used": 0, "burst_window_start": now}
+        # Send whenever our own (adaptive) bucket lets us
+        allowed, _ = apply_token_bucket(client_state, {**limits, "burst_capacity": 0}, request_tokens, now)
+        if not allowed:
+            continue
+        status_code, headers = mock.call(request_tokens, now)
+        adaptive.on_provider_response(provider, model_id, status_code, headers, now)
+        sent += 1
+        throttled += status_code == 429
+
+    print(f"sent {sent} requests ({sent * request_tokens / (now / 60):.0f} TPM), {throttled} throttled upstream")
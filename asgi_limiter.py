@@ -0,0 +1,193 @@
+import asyncio
+import inspect
+import json
+import math
+import time
+
+
+def helper_ids(request_helper):
+    """
+    extract_ids for RateLimitMiddleware from a RequestHelper: its data_extraction_from_request on a
+    starlette Request built over the scope (no body is read)
+    """
+    from starlette.requests import Request
+
+    def extract_ids(scope):
+        request_helper.data_extraction_from_request(Request(scope))
+        return request_helper.app_id, request_helper.model_id
+
+    return extract_ids
+
+
+def bucket_check(engine, policies, windows=None, token_bucket=False):
+    """
+    check for RateLimitMiddleware from a RedisTokenBucket and policies_from_config() limits
+    Windows are each policy's own (policy_spec) unless given. Only the request windows are checked
+    unless token_bucket is set, since the token bucket is charged for the real token count later on
+    The Redis call runs in a worker thread, not on the event loop
+    """
+    async def check(app_id, model_id, requested_tokens):
+        limits = policies.get((app_id, model_id)) or {}
+        return await asyncio.to_thread(
+            engine.check, app_id, model_id, requested_tokens, limits,
+            limits.get("windows", ()) if windows is None else windows, token_bucket=token_bucket
+        )
+
+    return check
+
+
+def rate_limit_headers(decision):
+    headers = []
+    if decision.get("remaining") is not None:
+        headers.append((b"x-ratelimit-remaining", str(decision["remaining"]).encode()))
+    if decision.get("reset_at") is not None:
+        headers.append((b"x-ratelimit-reset", str(math.ceil(decision["reset_at"])).encode()))
+    return headers
+
+
+class RateLimitMiddleware:
+    def __init__(self, app, check, extract_ids, requested_tokens=None):
+        """
+        Rate limiting as a pure ASGI middleware, in place of @app.middleware("http")
+        (BaseHTTPMiddleware, which runs the app in an extra task and copies the response stream):
+            app.add_middleware(RateLimitMiddleware, check=bucket_check(engine, policies),
+                               extract_ids=helper_ids(request_helper))
+
+        extract_ids(scope) -> (app_id, model_id); the ids are stored in scope["state"], so route
+        handlers read request.state.app_id / model_id without extracting again. (None, None) skips limiting
+        check(app_id, model_id, requested_tokens) -> decision dict as returned by RedisTokenBucket.check,
+        sync or async (a sync check runs on the event loop, so anything doing I/O should be async);
+        check None only stores the ids
+        requested_tokens(scope) -> tokens to charge, 1 by default
+
+        A denied request gets a 429 straight from here and never reaches the app. Allowed responses
+        get X-RateLimit-Remaining / X-RateLimit-Reset (epoch seconds) when the decision has them,
+        and a 429 also gets Retry-After
+        """
+        self.app = app
+        self.check = check
+        self.extract_ids = extract_ids
+        self.requested_tokens = requested_tokens
+        self._check_is_async = inspect.iscoroutinefunction(check)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        app_id, model_id = self.extract_ids(scope)
+        if app_id is None:
+            await self.app(scope, receive, send)
+            return
+        state = scope.setdefault("state", {})
+        state["app_id"] = app_id
+        state["model_id"] = model_id
+        if self.check is None:
+            await self.app(scope, receive, send)
+            return
+
+        requested_tokens = self.requested_tokens(scope) if self.requested_tokens is not None else 1
+        if self._check_is_async:
+            decision = await self.check(app_id, model_id, requested_tokens)
+        else:
+            decision = self.check(app_id, model_id, requested_tokens)
+        headers = rate_limit_headers(decision)
+
+        if not decision["allowed"]:
+            body = json.dumps({"error": decision.get("message", "Rate limit exceeded")}).encode()
+            if decision.get("reset_at") is not None:
+                retry_after = max(0, math.ceil(decision["reset_at"] - time.time()))
+                headers.append((b"retry-after", str(retry_after).encode()))
+            await send({
+                "type": "http.response.start",
+                "status": 429,
+                "headers": [(b"content-type", b"application/json"),
+                            (b"content-length", str(len(body)).encode()), *headers]
+            })
+            await send({"type": "http.response.body", "body": body})
+            return
+
+        if not headers:
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_headers(message):
+            if message["type"] == "http.response.start":
+                message = {**message, "headers": [*message.get("headers", []), *headers]}
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
+
+
+# Per-request overhead against the @app.middleware("http") version (needs starlette):
+#   python asgi_limiter.py [request count]
+if __name__ == "__main__":
+    import asyncio
+    import sys
+
+    from starlette.applications import Starlette
+    from starlette.middleware import Middleware
+    from starlette.middleware.base import BaseHTTPMiddleware
+    from starlette.responses import JSONResponse
+    from starlette.routing import Route
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    def check(app_id, model_id, requested_tokens):
+        return {"allowed": True, "message": "Allowed via token quota", "remaining": 9, "reset_at": 1.7e9}
+
+    def extract_ids(scope):
+        return scope["path"].strip("/").split("/")[0], "gpt-4.1-mini"
+
+    async def route(request):
+        return JSONResponse({"status": "allowed"})
+
+    async def http_middleware(request, call_next):
+        request.state.app_id, request.state.model_id = extract_ids(request.scope)
+        decision = check(request.state.app_id, request.state.model_id, 1)
+        if not decision["allowed"]:
+            return JSONResponse({"error": decision["message"]}, status_code=429)
+        response = await call_next(request)
+        response.headers["X-RateLimit-Remaining"] = str(decision["remaining"])
+        return response
+
+    routes = [Route("/{app_id}/chat", route)]
+    apps = {
+        "route only": Starlette(routes=routes),
+        "@app.middleware(\"http\")": Starlette(
+            routes=routes, middleware=[Middleware(BaseHTTPMiddleware, dispatch=http_middleware)]
+        ),
+        "RateLimitMiddleware": Starlette(
+            routes=routes, middleware=[Middleware(RateLimitMiddleware, check=check, extract_ids=extract_ids)]
+        )
+    }
+
+    async def call(app):
+        scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+                 "scheme": "http", "path": "/app_001/chat", "raw_path": b"/app_001/chat", "query_string": b"",
+                 "root_path": "", "headers": [(b"host", b"localhost")], "server": ("localhost", 80),
+                 "client": ("127.0.0.1", 1234)}
+
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message):
+            pass
+
+        await app(scope, receive, send)
+
+    async def bench(app):
+        for _ in range(200):
+            await call(app)
+        start = time.perf_counter()
+        for _ in range(count):
+            await call(app)
+        return (time.perf_counter() - start) / count * 1e6
+
+    async def main():
+        results = {name: min([await bench(app) for _ in range(3)]) for name, app in apps.items()}
+        base = results["route only"]
+        for name, per_request in results.items():
+            print(f"{name:>26}: {per_request:6.1f} us/request ({per_request - base:+.1f} us vs route only)")
+
+    asyncio.run(main())
@@ -0,0 +1,169 @@
+import re
+import time
+
+from token_bucket import BUCKET_FIELDS, compile_slot_table
+
+# Fields read per key kind; None reads the whole hash, since each pair has its own request and
+# token windows (policy_spec, redis_token_bucket.window_fields)
+KEY_FIELDS = {"dynamic": BUCKET_FIELDS, "api_rate": None}
+
+# One bucket adjustment; a top-up is refilled to `now` first so it lands on the current balance
+#
+# KEYS[1] dynamic:{app_id:model_id}
+# ARGV    now, op (top_up / reset / drain), tokens, max_tokens, refill_rate (both unused by drain)
+# Returns the new available_tokens
+ADJUST_LUA = """
+local now = tonumber(ARGV[1])
+local op = ARGV[2]
+
+local available = 0
+if op == 'top_up' then
+    local max_tokens = tonumber(ARGV[4])
+    local bucket = redis.call('HMGET', KEYS[1], 'available_tokens', 'last_refill_ts')
+    available = tonumber(bucket[1]) or max_tokens
+    local last_refill = tonumber(bucket[2]) or now
+    available = math.min(max_tokens, available + (now - last_refill) * tonumber(ARGV[5]))
+    available = math.min(max_tokens, available + tonumber(ARGV[3]))
+elseif op == 'reset' then
+    available = tonumber(ARGV[4])
+    redis.call('HSET', KEYS[1], 'burst_tokens_used', 0, 'burst_window_start', tostring(now))
+end
+redis.call('HSET', KEYS[1], 'available_tokens', tostring(available), 'last_refill_ts', tostring(now))
+return tostring(available)
+"""
+
+
+def _text(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def _float_or_none(value):
+    return float(value) if value is not None else None
+
+
+class BucketAdmin:
+    def __init__(self, redis_client, config=None, batch_size=1000, pause=0):
+        """
+        Bulk admin operations over the dynamic:* / api_rate:* keys
+        Keys are walked with SCAN (COUNT batch_size) and read or adjusted in pipelined batches
+        of batch_size, so even a 1M-key keyspace never holds Redis for more than one small
+        batch; pause sleeps between batches to leave room for live traffic.
+        config (RATE_LIMITS_DYNAMIC_INIT format) supplies max_tokens/refill_rate for top-up caps
+        and resets, so those two need it; keys of pairs missing from it (striped sub-buckets
+        "model#sN" included, see hot_key_striping) are left alone rather than sized by a guess
+        """
+        self.redis_client = redis_client
+        self.batch_size = batch_size
+        self.pause = pause
+        self.limits = None
+        if config is not None:
+            slots, limits, _ = compile_slot_table(config)
+            self.limits = {key: limits[slot] for key, slot in slots.items()}
+        self._adjust = redis_client.register_script(ADJUST_LUA)
+
+    def _sized_pairs(self, op):
+        """
+        (app_id, model_id) -> limits for an operation that depends on bucket sizes
+        """
+        if self.limits is None:
+            raise ValueError(f"{op} needs the rate limit config for bucket sizes, pass config=")
+        return self.limits
+
+    def _scan_batches(self, kind, app_id=None, model_id=None):
+        """
+        Yield lists of (key, app_id, model_id) of up to batch_size keys
+        """
+        if kind not in KEY_FIELDS:
+            raise ValueError(f"Unknown key kind {kind!r}, expected one of {sorted(KEY_FIELDS)}")
+        app_pattern = re.sub(r"([*?\[\]\\])", r"\\\1", app_id) if app_id is not None else "*"
+        model_pattern = re.sub(r"([*?\[\]\\])", r"\\\1", model_id) if model_id is not None else "*"
+
+        batch = []
+        match = f"{kind}:{{{app_pattern}:{model_pattern}}}"
+        for key in self.redis_client.scan_iter(match=match, count=self.batch_size):
+            key = _text(key)
+            # "{kind}:{app_id:model_id}", see redis_token_bucket.pair_tag
+            key_app, _, key_model = key[len(kind) + 2:-1].partition(":")
+            # "*" also matches ":", so an app filter could catch "{app:x:model}" keys
+            if (app_id is not None and key_app != app_id) or (model_id is not None and key_model != model_id):
+                continue
+            batch.append((key, key_app, key_model))
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _between_batches(self):
+        if self.pause:
+            time.sleep(self.pause)
+
+    def scan_states(self, kind="dynamic", app_id=None, model_id=None):
+        """
+        Stream every bucket's state: yields (app_id, model_id, state dict)
+        kind is "dynamic" (token buckets) or "api_rate" (every request/token window of the pair)
+        """
+        fields = KEY_FIELDS.get(kind)
+        for batch in self._scan_batches(kind, app_id, model_id):
+            pipe = self.redis_client.pipeline(transaction=False)
+            for key, _, _ in batch:
+                if fields is None:
+                    pipe.hgetall(key)
+                else:
+                    pipe.hmget(key, fields)
+            for (_, key_app, key_model), values in zip(batch, pipe.execute()):
+                if fields is None:
+                    state = {_text(field): _float_or_none(value) for field, value in values.items()}
+                else:
+                    state = {field: _float_or_none(value) for field, value in zip(fields, values)}
+                # Deleted between SCAN and the read
+                if not any(value is not None for value in state.values()):
+                    continue
+                yield key_app, key_model, state
+            self._between_batches()
+
+    def _adjust_all(self, op, tokens=0, app_id=None, model_id=None, now=None):
+        pairs = self._sized_pairs(op) if op != "drain" else None
+        adjusted = 0
+        for batch in self._scan_batches("dynamic", app_id, model_id):
+            batch_now = now if now is not None else time.time()
+            pipe = self.redis_client.pipeline(transaction=False)
+            for key, key_app, key_model in batch:
+                if pairs is None:
+                    args = [batch_now, op, tokens, "", ""]
+                elif (key_app, key_model) in pairs:
+                    limits = pairs[(key_app, key_model)]
+                    args = [batch_now, op, tokens, limits["max_tokens"], limits["refill_rate"]]
+                else:
+                    continue
+                self._adjust(keys=[key], args=args, client=pipe)
+            adjusted += len(pipe.execute())
+            self._between_batches()
+        return adjusted
+
+    def top_up(self, tokens, app_id=None, model_id=None, now=None):
+        """
+        Add tokens to every matching bucket of the config (capped at max_tokens); returns the number of buckets
+        Raises ValueError without a config
+        """
+        return self._adjust_all("top_up", tokens, app_id, model_id, now)
+
+    def drain(self, app_id=None, model_id=None, now=None):
+        """
+        Empty every matching bucket; it refills at refill_rate from now on
+        """
+        return self._adjust_all("drain", 0, app_id, model_id, now)
+
+    def reset(self, app_id=None, model_id=None, now=None):
+        """
+        Refill every matching bucket of the config to max_tokens, clear its burst usage and its request windows
+        Unlike init_redis_dynamic_state this only touches the matching keys. Raises ValueError without a config
+        """
+        adjusted = self._adjust_all("reset", 0, app_id, model_id, now)
+        pairs = self._sized_pairs("reset")
+        for batch in self._scan_batches("api_rate", app_id, model_id):
+            keys = [key for key, key_app, key_model in batch if (key_app, key_model) in pairs]
+            if keys:
+                self.redis_client.delete(*keys)
+            self._between_batches()
+        return adjusted
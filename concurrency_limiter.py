@@ -0,0 +1,100 @@
+import time
+import uuid
+
+# In-flight leases per (app_id, model_id) live in a sorted set scored by expiry time,
+# so a worker that crashes mid-stream leaks its slot for at most lease_ttl seconds
+#
+# KEYS[1] inflight:{app_id}:{model_id}
+# ARGV    now, lease id, lease expiry, max in flight, key ttl (ms)
+# Returns 1 and the number in flight if the slot was taken, else 0 and the number in flight
+ACQUIRE_LUA = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+local in_flight = redis.call('ZCARD', KEYS[1])
+if in_flight >= tonumber(ARGV[4]) then
+    return {0, in_flight}
+end
+redis.call('ZADD', KEYS[1], ARGV[3], ARGV[2])
+redis.call('PEXPIRE', KEYS[1], ARGV[5])
+return {1, in_flight + 1}
+"""
+
+# Extends a lease only if it is still held (XX), for streams running longer than lease_ttl
+RENEW_LUA = """
+local renewed = redis.call('ZADD', KEYS[1], 'XX', 'CH', ARGV[2], ARGV[1])
+if renewed == 1 then
+    redis.call('PEXPIRE', KEYS[1], ARGV[3])
+end
+return renewed
+"""
+
+
+def inflight_key(app_id, model_id):
+    return f"inflight:{app_id}:{model_id}"
+
+
+class ConcurrencyLimiter:
+    def __init__(self, redis_client):
+        """
+        Distributed cap on concurrent (in-flight) calls per (app_id, model_id)
+        Rate limits bound how fast requests arrive; this bounds how many long or streaming
+        calls are open at once across all workers
+        """
+        self.redis_client = redis_client
+        self._acquire = redis_client.register_script(ACQUIRE_LUA)
+        self._renew = redis_client.register_script(RENEW_LUA)
+
+    def acquire(self, app_id, model_id, max_in_flight, lease_ttl=300, now=None):
+        """
+        Take a slot. Returns a lease dict for release()/renew(), or None if all slots are taken
+        """
+        if now is None:
+            now = time.time()
+        lease_id = uuid.uuid4().hex
+        acquired, in_flight = self._acquire(
+            keys=[inflight_key(app_id, model_id)],
+            args=[now, lease_id, now + lease_ttl, max_in_flight, int(lease_ttl * 1000)]
+        )
+        if not acquired:
+            return None
+        return {
+            "app_id": app_id,
+            "model_id": model_id,
+            "lease_id": lease_id,
+            "lease_ttl": lease_ttl,
+            "in_flight": in_flight
+        }
+
+    def renew(self, lease, now=None):
+        """
+        Push the lease expiry out by another lease_ttl; False if it already expired
+        """
+        if now is None:
+            now = time.time()
+        renewed = self._renew(
+            keys=[inflight_key(lease["app_id"], lease["model_id"])],
+            args=[lease["lease_id"], now + lease["lease_ttl"], int(lease["lease_ttl"] * 1000)]
+        )
+        return bool(renewed)
+
+    def release(self, lease):
+        """
+        Give the slot back when the response has completed
+        """
+        self.redis_client.zrem(inflight_key(lease["app_id"], lease["model_id"]), lease["lease_id"])
+
+    def in_flight(self, app_id, model_id, now=None):
+        if now is None:
+            now = time.time()
+        return self.redis_client.zcount(inflight_key(app_id, model_id), f"({now}", "+inf")
+
+
+async def release_after_stream(body_iterator, release):
+    """
+    Wrap a StreamingResponse body so the slot is released when the stream ends,
+    including when the client disconnects halfway
+    """
+    try:
+        async for chunk in body_iterator:
+            yield chunk
+    finally:
+        release()
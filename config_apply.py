@@ -0,0 +1,228 @@
+import json
+import time
+import uuid
+
+from gcra import gcra_key
+from hot_key_striping import STRIPE_DIRECTORY_KEY, stripe_limits, stripe_suffix
+from redis_token_bucket import api_rate_key, dynamic_key, shadow_key
+from token_bucket import compile_slot_table
+
+# The last config rolled out, so the next rollout diffs against what the buckets actually hold
+APPLIED_CONFIG_KEY = "rate_limits_dynamic_applied"
+ROLLOUT_LOCK_KEY = "rate_limits_dynamic_rollout"
+ROLLOUT_LOCK_TTL = 300
+
+# Release the rollout lock only if this rollout still holds it; one that ran past the TTL
+# must not delete the lock of the rollout that took over
+#
+# KEYS[1] ROLLOUT_LOCK_KEY
+# ARGV    owner token
+RELEASE_LOCK_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# Limit fields that affect the dynamic:* hash; rpm/rps changes need no state migration
+TOKEN_LIMIT_FIELDS = ("max_tokens", "refill_rate", "burst_capacity", "burst_window")
+
+# Move a live bucket to new limits: refill it to `now` under the old limits, then scale
+# available_tokens (and burst_tokens_used) by new/old capacity so an app keeps the same
+# fraction of its quota instead of being reset to full
+#
+# KEYS[1] dynamic:{app_id:model_id}
+# ARGV    now, old max_tokens, old refill_rate, new max_tokens, old burst_capacity, new burst_capacity
+RESCALE_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+local now = tonumber(ARGV[1])
+local old_max = tonumber(ARGV[2])
+local old_refill = tonumber(ARGV[3])
+local new_max = tonumber(ARGV[4])
+local old_burst = tonumber(ARGV[5])
+local new_burst = tonumber(ARGV[6])
+
+local bucket = redis.call('HMGET', KEYS[1], 'available_tokens', 'last_refill_ts', 'burst_tokens_used')
+local available = tonumber(bucket[1]) or old_max
+local last_refill = tonumber(bucket[2]) or now
+local burst_used = tonumber(bucket[3]) or 0
+
+available = math.min(old_max, available + (now - last_refill) * old_refill)
+if old_max > 0 then
+    available = available * new_max / old_max
+else
+    available = new_max
+end
+if old_burst > 0 then
+    burst_used = burst_used * new_burst / old_burst
+end
+
+redis.call('HSET', KEYS[1], 'available_tokens', tostring(available), 'last_refill_ts', tostring(now),
+    'burst_tokens_used', tostring(burst_used))
+return 1
+"""
+
+# Full bucket for a newly added pair; an existing hash (e.g. a model re-added) is left alone
+#
+# KEYS[1] dynamic:{app_id:model_id}
+# ARGV    now, max_tokens
+CREATE_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'available_tokens', ARGV[2], 'last_refill_ts', ARGV[1],
+    'burst_tokens_used', 0, 'burst_window_start', ARGV[1])
+return 1
+"""
+
+
+def _token_limits(config):
+    slots, limits, _ = compile_slot_table(config)
+    return {key: {field: limits[slot][field] for field in TOKEN_LIMIT_FIELDS} for key, slot in slots.items()}
+
+
+def diff_policies(old_config, new_config):
+    """
+    Compare two RATE_LIMITS_DYNAMIC_INIT configs on the token limits only
+    Returns (added, removed, changed): added/removed map (app_id, model_id) to limits,
+    changed maps it to (old limits, new limits)
+    """
+    old = _token_limits(old_config)
+    new = _token_limits(new_config)
+    added = {key: new[key] for key in new.keys() - old.keys()}
+    removed = {key: old[key] for key in old.keys() - new.keys()}
+    changed = {key: (old[key], new[key]) for key in old.keys() & new.keys() if old[key] != new[key]}
+    return added, removed, changed
+
+
+def _text(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def _stripe_counts(redis_client, pairs):
+    """
+    Stripe count of each (app_id, model_id) from the stripe directory, 0 for pairs that aren't striped
+    """
+    fields = [f"{app_id}:{model_id}" for app_id, model_id in pairs]
+    # Directory entries are "{stripe_count}:{expires_at}"
+    entries = redis_client.hmget(STRIPE_DIRECTORY_KEY, fields) if fields else []
+    return [int(_text(entry).split(":")[0]) if entry is not None else 0 for entry in entries]
+
+
+def _leftover_keys(app_id, model_id, shadow_names, stripe_count):
+    """
+    Every key besides dynamic:* a removed pair may have left behind
+    """
+    keys = [api_rate_key(app_id, model_id), gcra_key(app_id, model_id)]
+    keys += [shadow_key(name, app_id, model_id) for name in shadow_names]
+    for index in range(stripe_count):
+        keys += [dynamic_key(app_id, model_id + stripe_suffix(index)), api_rate_key(app_id, model_id + stripe_suffix(index))]
+    return keys
+
+
+def _batches(items, batch_size):
+    items = sorted(items)
+    for i in range(0, len(items), batch_size):
+        yield items[i:i + batch_size]
+
+
+def apply_config_diff(redis_client, old_config, new_config, batch_size=1000, now=None):
+    """
+    Roll a config change out to the live dynamic:* buckets, touching only the pairs that changed:
+    changed limits are rescaled in place (the stripes too while a pair is striped, each at its
+    share of the limits, see hot_key_striping), added pairs get a full bucket, removed pairs are deleted
+    with their request windows, GCRA and shadow policy state, and stripes (see hot_key_striping).
+    Work is O(changes), in pipelined batches of batch_size
+    Returns {"added": n, "removed": n, "rescaled": n}
+    """
+    if now is None:
+        now = time.time()
+    added, removed, changed = diff_policies(old_config, new_config)
+    rescale = redis_client.register_script(RESCALE_LUA)
+    create = redis_client.register_script(CREATE_LUA)
+    summary = {"added": 0, "removed": 0, "rescaled": 0}
+
+    for batch in _batches(changed.items(), batch_size):
+        stripe_counts = _stripe_counts(redis_client, [key for key, _ in batch])
+        pipe = redis_client.pipeline(transaction=False)
+        for ((app_id, model_id), (old, new)), stripe_count in zip(batch, stripe_counts):
+            buckets = [(dynamic_key(app_id, model_id), old, new)]
+            if stripe_count:
+                old_stripe, new_stripe = stripe_limits(old, stripe_count), stripe_limits(new, stripe_count)
+                buckets += [(dynamic_key(app_id, model_id + stripe_suffix(index)), old_stripe, new_stripe)
+                            for index in range(stripe_count)]
+            for key, old_limits, new_limits in buckets:
+                rescale(
+                    keys=[key],
+                    args=[now, old_limits["max_tokens"], old_limits["refill_rate"], new_limits["max_tokens"],
+                          old_limits["burst_capacity"], new_limits["burst_capacity"]],
+                    client=pipe
+                )
+        results = iter(pipe.execute())
+        for stripe_count in stripe_counts:
+            # A pair counts once, by its main bucket
+            summary["rescaled"] += next(results)
+            for _ in range(stripe_count):
+                next(results)
+
+    for batch in _batches(added.items(), batch_size):
+        pipe = redis_client.pipeline(transaction=False)
+        for (app_id, model_id), limits in batch:
+            create(keys=[dynamic_key(app_id, model_id)], args=[now, limits["max_tokens"]], client=pipe)
+        summary["added"] += sum(pipe.execute())
+
+    if removed:
+        old_slots, old_limits, _ = compile_slot_table(old_config)
+    for batch in _batches(removed, batch_size):
+        # One key per DEL, since the keys of a batch span many cluster slots
+        pipe = redis_client.pipeline(transaction=False)
+        for app_id, model_id in batch:
+            pipe.delete(dynamic_key(app_id, model_id))
+        summary["removed"] += sum(pipe.execute())
+
+        stripe_counts = _stripe_counts(redis_client, batch)
+        pipe = redis_client.pipeline(transaction=False)
+        for (app_id, model_id), stripe_count in zip(batch, stripe_counts):
+            shadow_names = [policy["name"] for policy in old_limits[old_slots[(app_id, model_id)]]["shadow"]]
+            for key in _leftover_keys(app_id, model_id, shadow_names, stripe_count):
+                pipe.delete(key)
+        pipe.hdel(STRIPE_DIRECTORY_KEY, *[f"{app_id}:{model_id}" for app_id, model_id in batch])
+        pipe.execute()
+
+    return summary
+
+
+def load_applied_config(redis_client):
+    """
+    The config of the last rollout (or init), None if none was recorded
+    """
+    raw = redis_client.get(APPLIED_CONFIG_KEY)
+    return json.loads(raw) if raw is not None else None
+
+
+def save_applied_config(redis_client, config):
+    redis_client.set(APPLIED_CONFIG_KEY, json.dumps(config, sort_keys=True))
+
+
+def rollout_config(redis_client, new_config, batch_size=1000, now=None):
+    """
+    apply_config_diff from the last applied config (APPLIED_CONFIG_KEY) to new_config, then record
+    new_config as applied. One rollout runs at a time: rescaling is relative, so two workers applying
+    the same diff would rescale the buckets twice
+    Without a recorded config every pair counts as added, which only creates missing buckets
+    Returns the apply_config_diff summary, or None if another rollout holds the lock
+    """
+    owner = uuid.uuid4().hex
+    if not redis_client.set(ROLLOUT_LOCK_KEY, owner, nx=True, ex=ROLLOUT_LOCK_TTL):
+        return None
+    try:
+        old_config = load_applied_config(redis_client) or {"apps": []}
+        if old_config == new_config:
+            return {"added": 0, "removed": 0, "rescaled": 0}
+        summary = apply_config_diff(redis_client, old_config, new_config, batch_size, now)
+        save_applied_config(redis_client, new_config)
+        return summary
+    finally:
+        redis_client.register_script(RELEASE_LOCK_LUA)(keys=[ROLLOUT_LOCK_KEY], args=[owner])
@@ -0,0 +1,235 @@
+import hashlib
+import json
+import marshal
+import os
+import re
+import struct
+import sys
+import threading
+import time
+
+from policy_spec import parse_policy
+from token_bucket import BURST_DECAY_MODES, DEFAULT_PRIORITY_CLASSES, compile_slot_table
+
+# Artifact file: header, then a marshal payload of the compiled slot table
+# marshal is the fastest loader in the stdlib but its format is tied to the Python version,
+# so the version is part of the cache key
+ARTIFACT_HEADER = struct.Struct("<4sI32s")  # magic, version, sha256 of the source
+ARTIFACT_MAGIC = b"RLCA"
+ARTIFACT_VERSION = 1
+
+# rate_limit/burst fields that aren't limits (everything else must be a number >= 0)
+NON_NUMERIC_FIELDS = ("algorithm", "windows", "decay")
+
+# Strings are matched first so a "//" inside a quoted value is left alone
+_COMMENT_RE = re.compile(r'("(?:\\.|[^"\\])*")|//[^\n]*')
+
+
+def strip_comments(text):
+    """
+    Drop // comments from a JSON document (load_test_config.txt style)
+    """
+    return _COMMENT_RE.sub(lambda match: match.group(1) or "", text)
+
+
+def normalize_config(config):
+    """
+    Validate a rate limit config and rewrite it in canonical form:
+    "app_id" (not "application-id") and burst "burst_capacity"/"burst_window" (not "capacity"/"window")
+    Raises ValueError listing every problem found
+    """
+    errors = []
+    seen = set()
+    apps = []
+    priority_classes = {**DEFAULT_PRIORITY_CLASSES, **config.get("priority_classes", {})}
+    for i, app in enumerate(config.get("apps", [])):
+        app_id = app.get("app_id", app.get("application-id"))
+        if not app_id:
+            errors.append(f"apps[{i}]: missing app_id/application-id")
+            continue
+        if app.get("priority", "standard") not in priority_classes:
+            errors.append(f"apps[{i}] ({app_id}): priority must be one of {sorted(priority_classes)}, got {app['priority']!r}")
+        models = []
+        for j, model in enumerate(app.get("models", [])):
+            where = f"apps[{i}] ({app_id}) models[{j}]"
+            model_id = model.get("model_id")
+            if not model_id:
+                errors.append(f"{where}: missing model_id")
+                continue
+            if (app_id, model_id) in seen:
+                errors.append(f"{where}: duplicate {app_id}:{model_id}")
+                continue
+            seen.add((app_id, model_id))
+
+            rate_limit = dict(model.get("rate_limit", {}))
+            burst = dict(model.get("burst", {}))
+            if "capacity" in burst:
+                burst.setdefault("burst_capacity", burst.pop("capacity"))
+            if "window" in burst:
+                burst.setdefault("burst_window", burst.pop("window"))
+            if "windows" in rate_limit:
+                try:
+                    parse_policy(rate_limit["windows"])
+                except (TypeError, ValueError) as e:
+                    errors.append(f"{where}: rate_limit.windows: {e}")
+            if burst.get("decay") not in BURST_DECAY_MODES:
+                errors.append(f"{where}: burst.decay must be one of {BURST_DECAY_MODES}, got {burst['decay']!r}")
+            for section, values in (("rate_limit", rate_limit), ("burst", burst)):
+                for field, value in values.items():
+                    if field in NON_NUMERIC_FIELDS:
+                        continue
+                    if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+                        errors.append(f"{where}: {section}.{field} must be a number >= 0, got {value!r}")
+            models.append({**model, "rate_limit": rate_limit, "burst": burst})
+
+        canonical = {k: v for k, v in app.items() if k != "application-id"}
+        apps.append({**canonical, "app_id": app_id, "models": models})
+
+    if errors:
+        raise ValueError("Invalid rate limit config:\n  " + "\n  ".join(errors))
+    return {**config, "apps": apps}
+
+
+def compile_config(config):
+    """
+    Normalized config -> artifact payload: slot keys, limits, and initial states whose
+    timestamps are None unless the config pins them (filled with load time on load)
+    """
+    config = normalize_config(config)
+    slots, limits, initial_states = compile_slot_table(config)
+    keys = sorted(slots, key=slots.get)
+
+    pinned = {}
+    for app in config["apps"]:
+        for model in app["models"]:
+            pinned[(app["app_id"], model["model_id"])] = (
+                "last_refill_ts" in model["rate_limit"], "burst_window_start" in model["burst"]
+            )
+    initial = []
+    for key, state in zip(keys, initial_states):
+        refill_pinned, burst_pinned = pinned[key]
+        initial.append((
+            state["available_tokens"],
+            state["last_refill_ts"] if refill_pinned else None,
+            state["burst_tokens_used"],
+            state["burst_window_start"] if burst_pinned else None
+        ))
+    return {"keys": keys, "limits": limits, "initial": initial}
+
+
+def _source_hash(raw):
+    return hashlib.sha256(raw + f"|{ARTIFACT_VERSION}|{sys.version_info[:2]}".encode()).digest()
+
+
+def _from_payload(payload, now=None):
+    if now is None:
+        now = time.time()
+    keys = [tuple(key) for key in payload["keys"]]
+    slots = {key: slot for slot, key in enumerate(keys)}
+    initial_states = [
+        {
+            "available_tokens": available,
+            "last_refill_ts": now if last_refill is None else last_refill,
+            "burst_tokens_used": burst_used,
+            "burst_window_start": now if burst_start is None else burst_start
+        }
+        for available, last_refill, burst_used, burst_start in payload["initial"]
+    ]
+    return slots, payload["limits"], initial_states
+
+
+def load_compiled_config(path, cache_dir=".rate_limit_cache"):
+    """
+    compile_slot_table for a config file (JSON, // comments allowed), cached by content hash
+    The first worker to see a config parses, validates and compiles it and writes the artifact;
+    every other worker (and every restart) just loads the artifact
+    Returns (slots, limits, initial_states) like compile_slot_table
+    """
+    with open(path, "rb") as f:
+        return load_compiled_source(f.read(), cache_dir)
+
+
+def load_compiled_source(raw, cache_dir=".rate_limit_cache"):
+    """
+    load_compiled_config for a config held in memory (e.g. the RATE_LIMITS_DYNAMIC_INIT iConfig value)
+    """
+    if isinstance(raw, str):
+        raw = raw.encode("utf-8")
+    digest = _source_hash(raw)
+    artifact_path = os.path.join(cache_dir, f"{digest.hex()}.rlc")
+
+    try:
+        with open(artifact_path, "rb") as f:
+            magic, version, stored_digest = ARTIFACT_HEADER.unpack(f.read(ARTIFACT_HEADER.size))
+            if magic == ARTIFACT_MAGIC and version == ARTIFACT_VERSION and stored_digest == digest:
+                return _from_payload(marshal.loads(f.read()))
+    except (OSError, EOFError, ValueError, struct.error):
+        pass
+
+    payload = compile_config(json.loads(strip_comments(raw.decode("utf-8"))))
+    os.makedirs(cache_dir, exist_ok=True)
+    # Write then rename, so a worker never loads a half-written artifact
+    tmp_path = f"{artifact_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(ARTIFACT_HEADER.pack(ARTIFACT_MAGIC, ARTIFACT_VERSION, digest))
+        f.write(marshal.dumps(payload))
+    os.replace(tmp_path, artifact_path)
+    return _from_payload(payload)
+
+
+class LazyRedis:
+    def __init__(self, factory):
+        """
+        Redis client created on first use instead of at import, so starting a worker
+        costs no connection and a Redis outage doesn't stop the worker from booting
+            redis_client = LazyRedis(lambda: redis.Redis(host="localhost", port=6379, db=0))
+        """
+        self._factory = factory
+        self._client = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        with self._lock:
+            if self._client is None:
+                self._client = self._factory()
+        return self._client
+
+    def __getattr__(self, name):
+        client = self._client if self._client is not None else self._connect()
+        return getattr(client, name)
+
+
+# Cold start measurement: python config_compiler.py [app count]
+if __name__ == "__main__":
+    import shutil
+    import tempfile
+
+    app_count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    work_dir = tempfile.mkdtemp(prefix="rl_config_")
+    try:
+        config_path = os.path.join(work_dir, "rate_limits.json")
+        with open(config_path, "w") as f:
+            f.write("// generated load test config\n")
+            json.dump({"apps": [
+                {"application-id": f"app_{i:06d}", "models": [
+                    {"model_id": model_id, "rate_limit": {"max_tokens": 100000, "refill_rate": 1000},
+                     "burst": {"capacity": 20000, "window": 60}}
+                    for model_id in ("gpt-4.1-mini", "gemini-1.5-flash-002", "claude-sonnet")
+                ]} for i in range(app_count)
+            ]}, f)
+        cache_dir = os.path.join(work_dir, "cache")
+
+        start = time.perf_counter()
+        with open(config_path) as f:
+            compile_slot_table(json.loads(strip_comments(f.read())))
+        print(f"parse + compile per worker, no artifact: {(time.perf_counter() - start) * 1000:.1f}ms")
+
+        start = time.perf_counter()
+        slots, _, _ = load_compiled_config(config_path, cache_dir)
+        print(f"first worker (validate + compile + write artifact): {(time.perf_counter() - start) * 1000:.1f}ms")
+
+        start = time.perf_counter()
+        load_compiled_config(config_path, cache_dir)
+        print(f"other workers (load artifact, {len(slots)} buckets): {(time.perf_counter() - start) * 1000:.1f}ms")
+    finally:
+        shutil.rmtree(work_dir)
@@ -0,0 +1,114 @@
+import asyncio
+import itertools
+import json
+import random
+import time
+
+
+class DecisionTracer:
+    def __init__(self, capacity=65536, sample_rate=0.01):
+        """
+        Sampled trace of limiter decisions (key, before/after state, reason, timing)
+        Records go into a fixed ring buffer without a lock: the slot index comes from
+        itertools.count and a slot is written with one list assignment, both atomic under
+        the GIL. When writers lap the flusher the oldest records are overwritten and counted
+        in `dropped`. Leave the tracer unset (None) on the limiter to disable tracing
+        """
+        self.capacity = capacity
+        self.sample_rate = sample_rate
+        self._slots = [None] * capacity
+        self._counter = itertools.count()
+        self._flushed_seq = -1
+        self.dropped = 0
+
+    def start(self):
+        """
+        Decide whether to trace this decision; returns a start timestamp (ns) or None
+        """
+        if random.random() >= self.sample_rate:
+            return None
+        return time.perf_counter_ns()
+
+    def record(self, key, requested_tokens, before, after, allowed, reason, started_ns):
+        seq = next(self._counter)
+        self._slots[seq % self.capacity] = (seq, {
+            "ts": time.time(),
+            "key": key,
+            "requested_tokens": requested_tokens,
+            "before": before,
+            "after": dict(after),
+            "allowed": allowed,
+            "reason": reason,
+            "duration_us": (time.perf_counter_ns() - started_ns) / 1000
+        })
+
+    def drain(self):
+        """
+        Records written since the previous drain, oldest first
+        """
+        records = sorted(
+            (slot for slot in self._slots if slot is not None and slot[0] > self._flushed_seq),
+            key=lambda slot: slot[0]
+        )
+        if not records:
+            return []
+        # Gaps in the sequence were overwritten before they could be drained
+        self.dropped += records[-1][0] - self._flushed_seq - len(records)
+        self._flushed_seq = records[-1][0]
+        return [record for _, record in records]
+
+    def write_jsonl(self, path):
+        """
+        Append the drained records to a JSONL file; returns how many were written
+        """
+        records = self.drain()
+        if records:
+            with open(path, "a") as f:
+                f.writelines(json.dumps(record) + "\n" for record in records)
+        return len(records)
+
+    async def flush(self, path):
+        """
+        write_jsonl off the event loop
+        """
+        return await asyncio.to_thread(self.write_jsonl, path)
+
+    async def run_flusher(self, path, interval=5):
+        """
+        Background task: asyncio.create_task(tracer.run_flusher("decisions.jsonl"))
+        """
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                await self.flush(path)
+        finally:
+            self.write_jsonl(path)
+
+
+# Tracing overhead on the in-process token bucket: python decision_trace.py
+if __name__ == "__main__":
+    from token_bucket import apply_token_bucket
+
+    limits = {"max_tokens": 1000, "refill_rate": 10, "burst_capacity": 100, "burst_window": 60}
+    n = 500_000
+
+    def bench(tracer):
+        state = {"available_tokens": 1000.0, "last_refill_ts": 0.0, "burst_tokens_used": 0, "burst_window_start": 0.0}
+        start = time.perf_counter()
+        for i in range(n):
+            now = i * 0.001
+            started_ns = tracer.start() if tracer is not None else None
+            before = dict(state) if started_ns is not None else None
+            allowed, message = apply_token_bucket(state, limits, 20, now)
+            if started_ns is not None:
+                tracer.record("dynamic:app_001:gpt-4.5", 20, before, state, allowed, message, started_ns)
+        return (time.perf_counter() - start) / n * 1e9
+
+    def best_of(tracer, runs=5):
+        return min(bench(tracer) for _ in range(runs))
+
+    baseline = best_of(None)
+    for label, tracer in [("disabled", None), ("1% sampled", DecisionTracer(sample_rate=0.01)),
+                          ("100% sampled", DecisionTracer(sample_rate=1.0))]:
+        per_decision = best_of(tracer)
+        print(f"{label:>12}: {per_decision:7.0f} ns/decision ({per_decision - baseline:+.0f} ns vs untraced)")
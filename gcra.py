@@ -0,0 +1,107 @@
+import time
+
+# Generic cell rate algorithm: the whole state is one theoretical arrival time (TAT) per key,
+# stored as integer microseconds so float formatting in Lua can't drop precision
+#
+# KEYS[1] gcra:{app_id}:{model_id}
+# ARGV    now_us, emission interval (us per token), burst tolerance (us), cost in tokens, dry_run
+# Returns allowed, retry after (us), remaining tokens
+GCRA_LUA = """
+local now = tonumber(ARGV[1])
+local emission = tonumber(ARGV[2])
+local tolerance = tonumber(ARGV[3])
+local cost = tonumber(ARGV[4])
+
+local tat = tonumber(redis.call('GET', KEYS[1])) or now
+if tat < now then
+    tat = now
+end
+
+local new_tat = tat + cost * emission
+local allow_at = new_tat - tolerance
+if now < allow_at then
+    local remaining = math.floor((tolerance - (tat - now)) / emission)
+    return {0, string.format('%.0f', allow_at - now), math.max(remaining, 0)}
+end
+
+if ARGV[5] ~= '1' then
+    -- Key expires once the bucket would be full again, so idle apps cost no memory
+    redis.call('SET', KEYS[1], string.format('%.0f', new_tat), 'PX', math.ceil((new_tat - now) / 1000) + 1)
+end
+return {1, '0', math.floor((tolerance - (new_tat - now)) / emission)}
+"""
+
+# Take an allowed request's cost back off the TAT, when a limit checked after GCRA denies it
+#
+# KEYS[1] gcra:{app_id}:{model_id}
+# ARGV    now_us, emission interval (us per token), cost in tokens
+GCRA_REFUND_LUA = """
+local tat = tonumber(redis.call('GET', KEYS[1]))
+if not tat then
+    return 0
+end
+local now = tonumber(ARGV[1])
+local new_tat = tat - tonumber(ARGV[3]) * tonumber(ARGV[2])
+if new_tat <= now then
+    redis.call('DEL', KEYS[1])
+else
+    redis.call('SET', KEYS[1], string.format('%.0f', new_tat), 'PX', math.ceil((new_tat - now) / 1000) + 1)
+end
+return 1
+"""
+
+
+def gcra_key(app_id, model_id):
+    return f"gcra:{app_id}:{model_id}"
+
+
+def gcra_parameters(limits):
+    """
+    Emission interval and burst tolerance (microseconds) for a token bucket config
+    refill_rate tokens/second sets the interval and burst_capacity the tolerance
+    (max_tokens when there is no burst capacity)
+    """
+    if not limits["refill_rate"]:
+        raise ValueError("GCRA mode needs a refill_rate above 0")
+    emission_us = 1_000_000 / limits["refill_rate"]
+    burst = limits.get("burst_capacity") or limits["max_tokens"]
+    return emission_us, burst * emission_us
+
+
+class GcraLimiter:
+    def __init__(self, redis_client):
+        """
+        GCRA mode for token limits: one timestamp per (app_id, model_id) instead of the four
+        token bucket fields, checked and updated in one tiny atomic script
+        """
+        self.redis_client = redis_client
+        self._script = redis_client.register_script(GCRA_LUA)
+        self._refund_script = redis_client.register_script(GCRA_REFUND_LUA)
+
+    def check(self, app_id, model_id, requested_tokens, limits, now=None, dry_run=False):
+        """
+        Returns a decision dict: allowed, message, retry_after (seconds), remaining
+        """
+        if now is None:
+            now = time.time()
+        emission_us, tolerance_us = gcra_parameters(limits)
+
+        allowed, retry_after_us, remaining = self._script(
+            keys=[gcra_key(app_id, model_id)],
+            args=[int(now * 1_000_000), emission_us, tolerance_us, requested_tokens, 1 if dry_run else 0]
+        )
+        return {
+            "allowed": bool(allowed),
+            "message": "Allowed via GCRA token quota" if allowed else "Token limit exceeded",
+            "retry_after": int(retry_after_us) / 1_000_000,
+            "remaining": remaining
+        }
+
+    def refund(self, app_id, model_id, requested_tokens, limits, now=None):
+        """
+        Give back an allowed check's requested_tokens
+        """
+        if now is None:
+            now = time.time()
+        emission_us, _ = gcra_parameters(limits)
+        self._refund_script(keys=[gcra_key(app_id, model_id)], args=[int(now * 1_000_000), emission_us, requested_tokens])
@@ -0,0 +1,409 @@
+"""
+Hot-key striping: a very popular (app_id, model_id) bucket is split into K sub-buckets
+(dynamic:{app:model#s0} .. {app:model#s<K-1>}), each holding 1/K of the capacity. Each stripe is
+its own hash tag, so the stripes land in different cluster slots and the load spreads over K
+shards instead of one.
+
+- Workers count accesses per key locally; a key above hot_rps is promoted. The one worker that
+  takes the promotion lock splits the bucket's tokens over the stripes, and only then publishes
+  the key in the "stripes" directory hash, so no worker ever reads a stripe that isn't set up yet
+  (a missing stripe would read as a full bucket).
+- Workers pick a stripe at random, and retry once on another stripe if the first one denies,
+  so an unlucky stripe doesn't reject requests the bucket as a whole could take. Request windows
+  are split with the remainder going to the first stripes, so together they allow exactly the limit;
+  promotion splits the main key's current window counts the same way, so a window that is
+  already running keeps counting what it admitted before the key was striped.
+- The app's quotas and the model's shared pool can't be striped (they are shared with other
+  pairs), so while a key is striped each worker takes them in leases of lease_requests requests
+  and spends those locally; a lease is charged up front, so this never over-admits, and what a
+  worker still holds is given back when the key is demoted.
+- A periodic rebalance moves tokens from full stripes to empty ones. Each move refills the
+  stripe to now and adds a delta in one single-key script, and the deltas sum to zero, so
+  decisions running concurrently neither lose nor create capacity.
+- Promotions hold for hot_ttl and are extended while the key stays hot. The first worker to see
+  an expired entry merges the stripes back into the main bucket.
+
+Promotion drains the main bucket into the stripes, and a merge drains the stripes back, leaving
+them empty until they expire. Workers re-read the directory every refresh_interval seconds, and
+one still on the old layout only gets what the drained side refills, so a layout change can
+overshoot by at most refill_rate * refresh_interval.
+"""
+import random
+import time
+
+from redis_token_bucket import (
+    DEFAULT_LIMITS, QUOTA_PERIODS, RedisTokenBucket, api_rate_key, as_window, dynamic_key, pair_tag, quota_period_id
+)
+
+STRIPE_DIRECTORY_KEY = "stripes"
+
+# Claims or extends a directory entry "{stripe_count}:{expires_at}"
+# ARGV field, stripe count, expires at, mode ("claim" only if absent, "extend" only if present)
+# Returns 1 if the entry was written
+DIRECTORY_LUA = """
+local exists = redis.call('HEXISTS', KEYS[1], ARGV[1]) == 1
+if (ARGV[4] == 'claim' and exists) or (ARGV[4] == 'extend' and not exists) then
+    return 0
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2] .. ':' .. ARGV[3])
+return 1
+"""
+
+
+# Refill one bucket to now, then move tokens in or out of it; single key, so cluster-safe
+# KEYS[1] dynamic:{app_id:model_id} or a stripe dynamic:{app_id:model_id#s<i>}
+# ARGV    now, max_tokens, refill_rate, delta, drain ("1" takes everything and leaves 0)
+# Returns the available tokens before the change
+MOVE_LUA = """
+local now = tonumber(ARGV[1])
+local max_tokens = tonumber(ARGV[2])
+local bucket = redis.call('HMGET', KEYS[1], 'available_tokens', 'last_refill_ts')
+local available = tonumber(bucket[1]) or max_tokens
+local last_refill = tonumber(bucket[2]) or now
+available = math.min(max_tokens, available + (now - last_refill) * tonumber(ARGV[3]))
+
+local after = math.min(max_tokens, available + tonumber(ARGV[4]))
+if ARGV[5] == '1' then
+    after = 0
+end
+redis.call('HSET', KEYS[1], 'available_tokens', tostring(after), 'last_refill_ts', tostring(now))
+return tostring(available)
+"""
+
+
+def stripe_suffix(index):
+    return f"#s{index}"
+
+
+def promotion_lock_key(app_id, model_id):
+    return f"stripes_promoting:{pair_tag(app_id, model_id)}"
+
+
+def _with_defaults(limits):
+    return {**DEFAULT_LIMITS, **{k: v for k, v in (limits or {}).items() if v is not None}}
+
+
+def stripe_limits(limits, stripe_count):
+    """
+    One stripe's share of a bucket's limits
+    """
+    limits = dict(limits)
+    for field in ("max_tokens", "refill_rate", "burst_capacity"):
+        if limits.get(field) is not None:
+            limits[field] = limits[field] / stripe_count
+    # Shadow buckets are per stripe key too, so each gets the same share
+    if limits.get("shadow"):
+        limits["shadow"] = [stripe_limits(policy, stripe_count) for policy in limits["shadow"]]
+    # Shared with other pairs, so leased instead (see StripedTokenBucket._take_lease)
+    limits.pop("quotas", None)
+    limits.pop("shared_capacity", None)
+    return limits
+
+
+def stripe_windows(windows, stripe_count, index):
+    """
+    One stripe's share of the request windows: the limit split evenly with the remainder going to the
+    first stripes, so the stripes together allow exactly the limit (a stripe may get 0 and deny)
+    """
+    sub_windows = []
+    for limit, seconds, unit in map(as_window, windows):
+        limit = int(limit)
+        sub_windows.append((limit // stripe_count + (1 if index < limit % stripe_count else 0), seconds, unit))
+    return sub_windows
+
+
+def _split_count(count, stripe_count, index):
+    # Like stripe_windows: whole counts split with the remainder on the first stripes
+    if float(count).is_integer():
+        count = int(float(count))
+        return count // stripe_count + (1 if index < count % stripe_count else 0)
+    return float(count) / stripe_count
+
+
+def _lease_period(limits, now):
+    # A lease only counts for the quota periods it was charged in
+    quotas = (limits or {}).get("quotas") or {}
+    return tuple(quota_period_id(period, now) for period in QUOTA_PERIODS if quotas.get(period) is not None)
+
+
+class HotKeyDetector:
+    def __init__(self, window=10):
+        """
+        Per-worker access rate per key over a sliding window (previous window weighted by overlap)
+        """
+        self.window = window
+        self._window_start = 0.0
+        self._current = {}
+        self._previous = {}
+
+    def record(self, key, now):
+        """
+        Count one access; returns the key's estimated rate (accesses per second)
+        """
+        if now - self._window_start >= self.window:
+            self._previous = self._current if now - self._window_start < 2 * self.window else {}
+            self._current = {}
+            self._window_start = now - (now - self._window_start) % self.window
+        self._current[key] = self._current.get(key, 0) + 1
+
+        overlap = 1 - (now - self._window_start) / self.window
+        return (self._current[key] + self._previous.get(key, 0) * overlap) / self.window
+
+
+class StripedTokenBucket:
+    def __init__(self, redis_client, stripe_count=8, hot_rps=500, hot_ttl=60,
+                 refresh_interval=5, rebalance_interval=1, detector_window=10, lease_requests=16):
+        """
+        RedisTokenBucket with automatic striping of hot keys (see module docstring)
+        hot_rps is the rate one worker has to see; with N workers sharing the traffic the
+        key is doing about N * hot_rps at promotion time
+        lease_requests is how many requests' worth of quota / shared pool a worker takes at once
+        for a striped key, so those keys see one call per lease instead of one per request
+        """
+        self.lease_requests = lease_requests
+        self._leases = {}  # (app_id, model_id) -> (quota period ids, tokens held)
+        self.redis_client = redis_client
+        self.engine = RedisTokenBucket(redis_client)
+        self.stripe_count = stripe_count
+        self.hot_rps = hot_rps
+        self.hot_ttl = hot_ttl
+        self.refresh_interval = refresh_interval
+        self.rebalance_interval = rebalance_interval
+        self.detector = HotKeyDetector(detector_window)
+        self._directory_script = redis_client.register_script(DIRECTORY_LUA)
+        self._move = redis_client.register_script(MOVE_LUA)
+
+        self.directory = {}  # (app_id, model_id) -> (stripe_count, expires_at)
+        self._last_refresh = 0.0
+        self._last_rebalance = {}
+        self._last_extend = {}
+        self._limits = {}
+
+    def refresh_directory(self, now=None):
+        """
+        Re-read the stripes directory; merges back stripes whose promotion expired
+        """
+        if now is None:
+            now = time.time()
+        directory = {}
+        for field, value in self.redis_client.hgetall(STRIPE_DIRECTORY_KEY).items():
+            field = field.decode() if isinstance(field, bytes) else field
+            value = value.decode() if isinstance(value, bytes) else value
+            app_id, _, model_id = field.partition(":")
+            stripe_count, _, expires_at = value.partition(":")
+            if float(expires_at) <= now:
+                # Only the worker whose HDEL wins merges, the others see the entry gone
+                if self.redis_client.hdel(STRIPE_DIRECTORY_KEY, field):
+                    self.merge(app_id, model_id, int(stripe_count), self._limits.get((app_id, model_id)), now)
+                continue
+            directory[(app_id, model_id)] = (int(stripe_count), float(expires_at))
+        self.directory = directory
+        self._last_refresh = now
+
+    def check(self, app_id, model_id, requested_tokens=None, limits=None, windows=(), now=None, dry_run=False):
+        """
+        Same interface and decision dict as RedisTokenBucket.check
+        """
+        if now is None:
+            now = time.time()
+        if now - self._last_refresh >= self.refresh_interval:
+            self.refresh_directory(now)
+
+        key = (app_id, model_id)
+        self._limits[key] = limits
+        rate = self.detector.record(key, now)
+        entry = self.directory.get(key)
+        if entry is None:
+            if rate >= self.hot_rps and self.promote(app_id, model_id, limits, now):
+                entry = self.directory[key]
+            else:
+                if key in self._leases:
+                    self._release_lease(app_id, model_id, limits, now)
+                return self.engine.check(app_id, model_id, requested_tokens, limits, windows, now, dry_run)
+        elif rate >= self.hot_rps and now - self._last_extend.get(key, 0) >= self.hot_ttl / 4:
+            self._extend(app_id, model_id, entry[0], now)
+
+        stripe_count = entry[0]
+        if now - self._last_rebalance.get(key, 0) >= self.rebalance_interval:
+            self._last_rebalance[key] = now
+            self.rebalance(app_id, model_id, stripe_count, limits, now)
+
+        leased = False
+        if requested_tokens is not None and limits and (limits.get("quotas") or limits.get("shared_capacity")):
+            if dry_run:
+                message = self.engine.charge_app_and_model(app_id, model_id, requested_tokens, limits, now, "check")
+            else:
+                message = self._take_lease(app_id, model_id, requested_tokens, limits, now)
+                leased = message is None
+            if message is not None:
+                return {"allowed": False, "message": message, "remaining": None, "reset_at": None,
+                        "available_tokens": None, "burst_tokens_used": None, "burst_window_start": None,
+                        "shadow": {}}
+
+        sub_limits = stripe_limits(limits or {}, stripe_count)
+        first = random.randrange(stripe_count)
+        decision = self.engine.check(app_id, model_id, requested_tokens, sub_limits,
+                                     stripe_windows(windows, stripe_count, first), now, dry_run,
+                                     stripe=stripe_suffix(first))
+        if not decision["allowed"] and stripe_count > 1:
+            second = (first + random.randrange(1, stripe_count)) % stripe_count
+            decision = self.engine.check(app_id, model_id, requested_tokens, sub_limits,
+                                         stripe_windows(windows, stripe_count, second), now, dry_run,
+                                         stripe=stripe_suffix(second))
+        if leased and not decision["allowed"]:
+            self._give_back(app_id, model_id, requested_tokens, limits, now)
+        return decision
+
+    def _take_lease(self, app_id, model_id, tokens, limits, now):
+        """
+        Spend tokens of the quotas / shared pool from this worker's lease, topping it up with
+        lease_requests requests' worth in one call when it runs short
+        Returns None, or the denial message
+        """
+        key = (app_id, model_id)
+        period = _lease_period(limits, now)
+        held_period, held = self._leases.get(key, (period, 0))
+        if held_period != period:
+            # Charged against quota periods that are over; nothing to give back
+            held = 0
+        if held >= tokens:
+            self._leases[key] = (period, held - tokens)
+            return None
+
+        chunk = tokens * self.lease_requests
+        if self.engine.charge_app_and_model(app_id, model_id, chunk, limits, now) is None:
+            self._leases[key] = (period, held + chunk - tokens)
+            return None
+        # Not enough left for a whole lease: charge just this request
+        self._leases[key] = (period, held)
+        return self.engine.charge_app_and_model(app_id, model_id, tokens, limits, now)
+
+    def _give_back(self, app_id, model_id, tokens, limits, now):
+        key = (app_id, model_id)
+        period = _lease_period(limits, now)
+        held_period, held = self._leases.get(key, (period, 0))
+        self._leases[key] = (period, (held if held_period == period else 0) + tokens)
+
+    def _release_lease(self, app_id, model_id, limits, now):
+        """
+        Return what this worker still holds of a demoted key's lease
+        """
+        held_period, held = self._leases.pop((app_id, model_id))
+        if held > 0 and held_period == _lease_period(limits, now):
+            self.engine.charge_app_and_model(app_id, model_id, held, limits, now, "refund")
+
+    def promote(self, app_id, model_id, limits=None, now=None):
+        """
+        Claim the key in the directory and split its bucket over the stripes
+        Returns True if the key is striped afterwards (by this or another worker)
+        """
+        if now is None:
+            now = time.time()
+        field = f"{app_id}:{model_id}"
+        lock_key = promotion_lock_key(app_id, model_id)
+        if (not self.redis_client.set(lock_key, 1, nx=True, ex=30)
+                or self.redis_client.hexists(STRIPE_DIRECTORY_KEY, field)):
+            self.refresh_directory(now)
+            return (app_id, model_id) in self.directory
+
+        limits = _with_defaults(limits)
+        available = float(self._move(
+            keys=[dynamic_key(app_id, model_id)],
+            args=[now, limits["max_tokens"], limits["refill_rate"], 0, 1]
+        ))
+        burst_used = float(self.redis_client.hget(dynamic_key(app_id, model_id), "burst_tokens_used") or 0)
+        windows = {
+            (field.decode() if isinstance(field, bytes) else field): value
+            for field, value in self.redis_client.hgetall(api_rate_key(app_id, model_id)).items()
+        }
+
+        pipe = self.redis_client.pipeline(transaction=False)
+        for key in self._stripe_keys(app_id, model_id, self.stripe_count):
+            pipe.hset(key, mapping={
+                "available_tokens": available / self.stripe_count,
+                "last_refill_ts": now,
+                "burst_tokens_used": burst_used / self.stripe_count,
+                "burst_window_start": now
+            })
+        # Running windows carry over split like their limits (window starts as is); stripe windows
+        # left over from an earlier merge are replaced, the main key's windows took over at that merge
+        for index, key in enumerate(self._stripe_keys(app_id, model_id, self.stripe_count, api_rate_key)):
+            pipe.delete(key)
+            if windows:
+                pipe.hset(key, mapping={
+                    field: value if "start" in field else _split_count(value, self.stripe_count, index)
+                    for field, value in windows.items()
+                })
+        # Stripes left over from an earlier merge still carry its expiry
+        for key in self._stripe_keys(app_id, model_id, self.stripe_count):
+            pipe.persist(key)
+        pipe.execute()
+
+        # Published only now that every stripe holds its share
+        expires_at = now + self.hot_ttl
+        self._directory_script(keys=[STRIPE_DIRECTORY_KEY], args=[field, self.stripe_count, expires_at, "claim"])
+        self.redis_client.delete(lock_key)
+        self.directory[(app_id, model_id)] = (self.stripe_count, expires_at)
+        self._last_extend[(app_id, model_id)] = now
+        return True
+
+    def _extend(self, app_id, model_id, stripe_count, now):
+        self._last_extend[(app_id, model_id)] = now
+        self._directory_script(
+            keys=[STRIPE_DIRECTORY_KEY], args=[f"{app_id}:{model_id}", stripe_count, now + self.hot_ttl, "extend"]
+        )
+
+    def _stripe_keys(self, app_id, model_id, stripe_count, key=dynamic_key):
+        return [key(app_id, model_id + stripe_suffix(index)) for index in range(stripe_count)]
+
+    def rebalance(self, app_id, model_id, stripe_count, limits=None, now=None):
+        """
+        Even out available tokens across the stripes with zero-sum moves
+        """
+        if now is None:
+            now = time.time()
+        sub_limits = stripe_limits(_with_defaults(limits), stripe_count)
+        keys = self._stripe_keys(app_id, model_id, stripe_count)
+
+        # Read pass: a zero move returns each stripe's balance refilled to now
+        pipe = self.redis_client.pipeline(transaction=False)
+        for key in keys:
+            self._move(keys=[key], args=[now, sub_limits["max_tokens"], sub_limits["refill_rate"], 0, 0], client=pipe)
+        balances = [float(available) for available in pipe.execute()]
+        target = sum(balances) / stripe_count
+
+        pipe = self.redis_client.pipeline(transaction=False)
+        for key, available in zip(keys, balances):
+            if available != target:
+                self._move(keys=[key], args=[now, sub_limits["max_tokens"], sub_limits["refill_rate"],
+                                             target - available, 0], client=pipe)
+        pipe.execute()
+
+    def merge(self, app_id, model_id, stripe_count, limits=None, now=None):
+        """
+        Drain the stripes back into the main bucket; the empty stripes expire once every
+        worker has had time to see the demotion
+        """
+        if now is None:
+            now = time.time()
+        limits = _with_defaults(limits)
+        sub_limits = stripe_limits(limits, stripe_count)
+        keys = self._stripe_keys(app_id, model_id, stripe_count)
+
+        pipe = self.redis_client.pipeline(transaction=False)
+        for key in keys:
+            self._move(keys=[key], args=[now, sub_limits["max_tokens"], sub_limits["refill_rate"], 0, 1], client=pipe)
+            pipe.expire(key, int(self.refresh_interval * 2) + 1)
+        available = sum(float(result) for result in pipe.execute()[::2])
+
+        # The stripes' request windows go too; the main key's windows take over
+        pipe = self.redis_client.pipeline(transaction=False)
+        for key in self._stripe_keys(app_id, model_id, stripe_count, api_rate_key):
+            pipe.expire(key, int(self.refresh_interval * 2) + 1)
+        pipe.execute()
+
+        self.redis_client.hset(dynamic_key(app_id, model_id), mapping={
+            "available_tokens": min(available, limits["max_tokens"]),
+            "last_refill_ts": now
+        })
+        self._last_rebalance.pop((app_id, model_id), None)
@@ -0,0 +1,43 @@
+import threading
+
+
+def _escape(label_value):
+    """
+    Label value escaped per the Prometheus text format: backslash, double quote and newline
+    """
+    return str(label_value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class LimiterMetrics:
+    def __init__(self, per_pair_labels=False):
+        """
+        In-process counters for limiter decisions, exported in Prometheus text format
+        (serve render() from a /metrics route); no client library needed
+        per_pair_labels adds app_id/model_id labels to the decision counters: one series per
+        pair, so only for deployments with a bounded number of pairs
+        """
+        self.per_pair_labels = per_pair_labels
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def get(self, name, **labels):
+        return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def snapshot(self):
+        """
+        {(name, ((label, value), ...)): count}
+        """
+        with self._lock:
+            return dict(self._counters)
+
+    def render(self):
+        lines = []
+        for (name, labels), value in sorted(self.snapshot().items()):
+            label_text = ",".join(f'{label}="{_escape(label_value)}"' for label, label_value in labels)
+            lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+        return "\n".join(lines) + "\n"
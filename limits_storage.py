@@ -0,0 +1,123 @@
+import time
+
+import redis
+from limits.storage import Storage
+from limits.strategies import STRATEGIES, RateLimiter
+from limits.util import WindowStats
+
+from redis_token_bucket import RedisTokenBucket, api_rate_key, dynamic_key, window_fields
+from token_bucket import compile_slot_table
+
+
+def policies_from_config(config):
+    """
+    {(app_id, model_id): token bucket limits} from a RATE_LIMITS_DYNAMIC_INIT / rate_limits.json config
+    """
+    slots, limits, _ = compile_slot_table(config)
+    return {key: limits[slot] for key, slot in slots.items()}
+
+
+def split_limit_key(key):
+    """
+    Limit keys are "app_id:model_id" (RequestHelper.get_unique_string); model ids may contain ":"
+    """
+    app_id, _, model_id = key.partition(":")
+    return app_id, model_id
+
+
+class TokenBucketStorage(Storage):
+    STORAGE_SCHEME = ["tokenbucket+redis"]
+
+    def __init__(self, uri, policies=None, wrap_exceptions=False, **options):
+        """
+        limits storage backed by our Redis token bucket engine
+        Use with strategy="token-bucket":
+            Limiter(key_func=..., storage_uri="tokenbucket+redis://localhost:6379",
+                    storage_options={"policies": policies_from_config(config)}, strategy="token-bucket")
+        The plain counter methods below keep it usable with the stock limits strategies too
+        """
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+        self.redis_client = redis.from_url(uri.replace("tokenbucket+", "", 1), decode_responses=True, **options)
+        self.engine = RedisTokenBucket(self.redis_client)
+        self.policies = policies or {}
+
+    @property
+    def base_exceptions(self):
+        return redis.RedisError
+
+    def acquire(self, app_id, model_id, item, cost=1, dry_run=False):
+        """
+        One atomic call for the request windows and the (app_id, model_id) token bucket
+        The windows are the model's configured policy windows when it has any, otherwise the item's
+        """
+        limits = self.policies.get((app_id, model_id))
+        windows = (limits or {}).get("windows") or [(item.amount, item.get_expiry())]
+        return self.engine.check(app_id, model_id, cost, limits, windows, dry_run=dry_run)
+
+    def incr(self, key, expiry, elastic_expiry=False, amount=1):
+        key = f"LIMITS:{key}"
+        pipeline = self.redis_client.pipeline()
+        pipeline.incrby(key, amount)
+        if elastic_expiry:
+            pipeline.expire(key, expiry)
+        else:
+            pipeline.expire(key, expiry, nx=True)
+        return pipeline.execute()[0]
+
+    def get(self, key):
+        return int(self.redis_client.get(f"LIMITS:{key}") or 0)
+
+    def get_expiry(self, key):
+        return int(max(self.redis_client.ttl(f"LIMITS:{key}"), 0) + time.time())
+
+    def check(self):
+        try:
+            return self.redis_client.ping()
+        except redis.RedisError:
+            return False
+
+    def reset(self):
+        deleted = 0
+        for key in self.redis_client.scan_iter(match="LIMITS:*", count=1000):
+            deleted += self.redis_client.delete(key)
+        return deleted
+
+    def clear(self, key):
+        self.redis_client.delete(f"LIMITS:{key}")
+
+
+class TokenBucketRateLimiter(RateLimiter):
+    def __init__(self, storage):
+        """
+        limits strategy: the rate limit item is the request window (e.g. "6/minute") and the
+        cost is the number of requested tokens, both enforced by one TokenBucketStorage call
+        """
+        if not isinstance(storage, TokenBucketStorage):
+            raise TypeError("token-bucket strategy needs a tokenbucket+redis:// storage")
+        super().__init__(storage)
+
+    def hit(self, item, *identifiers, cost=1):
+        app_id, model_id = split_limit_key(identifiers[0])
+        return self.storage.acquire(app_id, model_id, item, cost)["allowed"]
+
+    def test(self, item, *identifiers, cost=1):
+        app_id, model_id = split_limit_key(identifiers[0])
+        return self.storage.acquire(app_id, model_id, item, cost, dry_run=True)["allowed"]
+
+    def get_window_stats(self, item, *identifiers):
+        app_id, model_id = split_limit_key(identifiers[0])
+        count_field, start_field = window_fields(item.get_expiry())
+        count, start = self.storage.redis_client.hmget(api_rate_key(app_id, model_id), [count_field, start_field])
+        now = time.time()
+        start = float(start or now)
+        if now - start >= item.get_expiry():
+            return WindowStats(now, item.amount)
+        return WindowStats(start + item.get_expiry(), max(item.amount - int(count or 0), 0))
+
+    def clear(self, item, *identifiers):
+        app_id, model_id = split_limit_key(identifiers[0])
+        self.storage.redis_client.delete(api_rate_key(app_id, model_id), dynamic_key(app_id, model_id))
+
+
+# Makes Limiter(strategy="token-bucket") resolve to the strategy above
+STRATEGIES["token-bucket"] = TokenBucketRateLimiter
@@ -0,0 +1,364 @@
+"""
+asyncio load generator that replays the JMeter rate limit scenarios
+
+The three .txt reports came from manual JMeter runs; here the same user/iteration/timer setups
+are replayed against a local FastAPI app wired to the real limiter (requesthelper2.RequestHelper and
+its RedisTokenBucket) on a fakeredis server, and each scenario's allow/deny pattern is asserted.
+
+    python load_generator.py                      # all scenarios
+    python load_generator.py --scenario burst_capacity --csv results.csv
+    python load_generator.py --scenario rpm_tiers --users 6 --iterations 10 --tokens 20:5
+
+Requests go straight into the app's ASGI interface, so no server or HTTP client is needed, and
+timers run on a scaled clock (--time-scale 0.01 plays a 60s test in 0.6s of wall time). The limiter
+itself keeps the wall clock, so buckets refill and windows roll over at wall speed; the expected
+patterns hold at any scale up to 1.
+"""
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import random
+import sys
+import time
+from types import SimpleNamespace
+
+from redis_token_bucket import dynamic_key
+
+
+MODEL_ID = "gpt-4.1-mini"
+API_VERSION = "2024-06-01"
+
+
+def _apps(*apps):
+    """
+    RATE_LIMITS_DYNAMIC_INIT and RATE_LIMITS iConfig values for (app_id, max_tokens, refill_rate, rpm,
+    burst_capacity) apps with one model each
+    """
+    dynamic = {"apps": [
+        {"application-id": app_id, "models": [{
+            "model_id": MODEL_ID,
+            "rate_limit": {"max_tokens": max_tokens, "refill_rate": refill_rate},
+            "burst": {"capacity": burst_capacity, "window": 60}
+        }]}
+        for app_id, max_tokens, refill_rate, _, burst_capacity in apps
+    ]}
+    api = {"apps": [
+        {"application-id": app_id, "models": [{"model_id": MODEL_ID, "rate_limit": {"windows": [f"{rpm}/minute"]}}]}
+        for app_id, _, _, rpm, _ in apps
+    ]}
+    return {"RATE_LIMITS_DYNAMIC_INIT": dynamic, "RATE_LIMITS": api}
+
+
+# RequestHelper charges the tokens a request asks for before it goes out (the JMeter runs charged
+# the response's usage afterwards), drawing on the burst capacity once the bucket runs short
+SCENARIOS = {
+    # burst_limit_basic_app_multiple_users.txt: burst capacity 150, 61 tokens per request; with a
+    # 100 token bucket the first request comes out of the bucket and the next two out of the burst
+    # capacity (61 -> 122), so requests 4-6 of every user are denied
+    "burst_capacity": {
+        "config": _apps(*((f"basic_app_{i}", 100, 1, 60, 150) for i in (1, 2, 3))),
+        "users": [{"name": f"dummy_user_{i}", "app_id": f"basic_app_{i}", "tokens": "61"} for i in (1, 2, 3)],
+        "iterations": 6,
+        "timer": 1,
+        "concurrent": False,
+        "expected": ["allowed"] * 3 + ["denied"] * 3
+    },
+    # max_token_limit_basic_app_multiple_uers.txt: max_tokens 200 refilling 1/s, burst 150, one
+    # request every 10s; the first request exhausts the app and the burst capacity can't cover the
+    # next ones. The report's 214 and 236 token responses would never fit the 200 token bucket,
+    # so users 1 and 3 ask for 170 and 195 instead; user 2 keeps the report's 188
+    "max_token_exhaustion": {
+        "config": _apps(*((f"basic_app_{i}", 200, 1, 60, 150) for i in (1, 2, 3))),
+        "users": [
+            {"name": "dummy_user_1", "app_id": "basic_app_1", "tokens": "170"},
+            {"name": "dummy_user_2", "app_id": "basic_app_2", "tokens": "188"},
+            {"name": "dummy_user_3", "app_id": "basic_app_3", "tokens": "195"}
+        ],
+        "iterations": 6,
+        "timer": 10,
+        "concurrent": False,
+        "expected": ["allowed"] + ["denied"] * 5
+    },
+    # rpm_limit_different_apps_multiple_users.txt: Basic/Standard/Premium apps, 6 RPM each,
+    # 8 requests per user sent at the same time; 6 get through per user, in any order
+    "rpm_tiers": {
+        "config": _apps(
+            ("basic_app", 200, 10, 6, 0), ("standard_app", 1000, 10, 6, 0), ("premium_app", 2000, 10, 6, 0)
+        ),
+        "users": [
+            {"name": "dummy_user_1", "app_id": "basic_app", "tokens": "25:5"},
+            {"name": "dummy_user_2", "app_id": "standard_app", "tokens": "25:5"},
+            {"name": "dummy_user_3", "app_id": "premium_app", "tokens": "25:5"}
+        ],
+        "iterations": 8,
+        "timer": 0,
+        "concurrent": True,
+        "expected": {"allowed": 6, "denied": 2}
+    }
+}
+
+
+class ScaledClock:
+    def __init__(self, time_scale):
+        """
+        Test clock running 1 / time_scale times faster than the wall clock
+        """
+        self.time_scale = time_scale
+        self.start = time.time()
+        self._monotonic_start = time.monotonic()
+
+    def now(self):
+        return self.start + (time.monotonic() - self._monotonic_start) / self.time_scale
+
+    async def sleep(self, seconds):
+        await asyncio.sleep(seconds * self.time_scale)
+
+
+class ProxyRequest:
+    def __init__(self, request, body):
+        """
+        The request as RequestHelper.data_extraction_from_request reads it: url, query_params and
+        the body as bytes (a Starlette Request only has the body() coroutine)
+        """
+        self.url = request.url
+        self.query_params = request.query_params
+        self.body = body
+
+
+def build_limiter(config):
+    """
+    RequestHelper (requesthelper2) and its RedisTokenBucket on a fakeredis server, with iConfig
+    serving the scenario's config; the buckets and windows are created full on first use
+    """
+    import fakeredis
+    import requesthelper2
+
+    # The helper serves /{app_id}/{ai_service}/{model_id}/... paths with an api-version query parameter
+    endpoint_config = {app["application-id"]: {"openai": {API_VERSION: {}}}
+                       for app in config["RATE_LIMITS_DYNAMIC_INIT"]["apps"]}
+    configurations = {
+        "RATE_LIMITS_DYNAMIC_INIT": json.dumps(config["RATE_LIMITS_DYNAMIC_INIT"]),
+        "RATE_LIMITS": json.dumps(config["RATE_LIMITS"]),
+        "ENDPOINT_CONFIG": json.dumps(endpoint_config),
+        "ENVIRONMENT": "load_test"
+    }
+    redis_client = fakeredis.FakeRedis(decode_responses=True)
+    requesthelper2.redis_client = redis_client
+    requesthelper2.get_iconfig = lambda: SimpleNamespace(configurations=configurations)
+    requesthelper2.amt_logger = SimpleNamespace(logger=logging.getLogger("load_generator"))
+    return requesthelper2.RequestHelper(), redis_client
+
+
+def build_app(request_helper, redis_client, clock, llm_latency=0.2):
+    """
+    Local FastAPI app: POST /{app_id}/openai/{model_id}/chat/completions?api-version=... with {"tokens": n},
+    where n is how many tokens the request asks the limiter for
+    """
+    from fastapi import FastAPI, Request
+    from fastapi.responses import JSONResponse
+
+    app = FastAPI()
+
+    @app.post("/{app_id}/{ai_service}/{model_id}/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.body()
+        tokens = json.loads(body)["tokens"]
+        # allow_request doesn't await, so app_id/model_id are still this request's when the state is read
+        allowed, message = request_helper.allow_request(ProxyRequest(request, body), tokens)
+        available, burst_used = redis_client.hmget(
+            dynamic_key(request_helper.app_id, request_helper.model_id), ["available_tokens", "burst_tokens_used"]
+        )
+        state = {
+            "available_tokens": float(available) if available is not None else None,
+            "burst_tokens_used": float(burst_used) if burst_used is not None else None
+        }
+        if not allowed:
+            return JSONResponse({"error": message, **state}, status_code=429)
+
+        await clock.sleep(llm_latency)
+        return {"usage": {"total_tokens": tokens}, **state}
+
+    return app
+
+
+async def asgi_post(app, path, payload, query_string=""):
+    """
+    Minimal in-process HTTP POST against an ASGI app; returns (status, json body)
+    """
+    body = json.dumps(payload).encode()
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+        "scheme": "http", "path": path, "raw_path": path.encode(), "root_path": "", "query_string": query_string.encode(),
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        "client": ("127.0.0.1", 0), "server": ("testserver", 80)
+    }
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    response = {"status": None, "body": b""}
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+        elif message["type"] == "http.response.body":
+            response["body"] += message.get("body", b"")
+
+    await app(scope, receive, send)
+    return response["status"], json.loads(response["body"] or b"{}")
+
+
+def token_sampler(spec, rng):
+    """
+    "61" is a fixed size, "25:5" a normal distribution (mean:stdev), "10-300" uniform
+    """
+    spec = str(spec)
+    if ":" in spec:
+        mean, stdev = (float(part) for part in spec.split(":"))
+        return lambda: max(1, int(rng.gauss(mean, stdev)))
+    if "-" in spec:
+        low, high = (int(part) for part in spec.split("-"))
+        return lambda: rng.randint(low, high)
+    return lambda: int(spec)
+
+
+async def run_user(app, clock, scenario_name, scenario, user, rows, rng):
+    sample_tokens = token_sampler(user["tokens"], rng)
+    model_id = user.get("model_id", MODEL_ID)
+    path = f"/{user['app_id']}/openai/{model_id}/chat/completions"
+
+    async def one_request(iteration):
+        tokens = sample_tokens()
+        start = time.perf_counter()
+        status, body = await asgi_post(app, path, {"tokens": tokens}, f"api-version={API_VERSION}")
+        rows.append({
+            "timeStamp": int(time.time() * 1000),
+            "elapsed_ms": round((time.perf_counter() - start) * 1000, 3),
+            "scenario": scenario_name,
+            "threadName": user["name"],
+            "iteration": iteration,
+            "app_id": user["app_id"],
+            "model_id": model_id,
+            "responseCode": status,
+            "success": status == 200,
+            "tokens": tokens,
+            "available_tokens": body.get("available_tokens"),
+            "burst_tokens_used": body.get("burst_tokens_used"),
+            "message": body.get("error", "")
+        })
+
+    if scenario["concurrent"]:
+        await asyncio.gather(*(one_request(i) for i in range(1, scenario["iterations"] + 1)))
+        return
+    for iteration in range(1, scenario["iterations"] + 1):
+        await one_request(iteration)
+        if iteration < scenario["iterations"]:
+            await clock.sleep(scenario["timer"])
+
+
+def check_expected(scenario, rows):
+    """
+    Compare each user's allow/deny pattern to the scenario's expectation; returns a list of failures
+    """
+    failures = []
+    expected = scenario["expected"]
+    for user in scenario["users"]:
+        user_rows = sorted((r for r in rows if r["threadName"] == user["name"]), key=lambda r: r["iteration"])
+        outcomes = ["allowed" if r["success"] else "denied" for r in user_rows]
+        if isinstance(expected, dict):
+            counts = {outcome: outcomes.count(outcome) for outcome in expected}
+            if counts != expected:
+                failures.append(f"{user['name']}: expected {expected}, got {counts}")
+        elif outcomes != expected[:len(outcomes)] or len(outcomes) != min(len(expected), scenario["iterations"]):
+            failures.append(f"{user['name']}: expected {expected}, got {outcomes}")
+    return failures
+
+
+def summarize(name, rows, wall_time):
+    latencies = sorted(r["elapsed_ms"] for r in rows)
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))] if latencies else 0
+
+    allowed = sum(r["success"] for r in rows)
+    print(f"[{name}] {len(rows)} requests, {allowed} allowed, {len(rows) - allowed} denied, "
+          f"{len(rows) / wall_time:.1f} req/s, latency p50 {percentile(50):.2f}ms "
+          f"p95 {percentile(95):.2f}ms p99 {percentile(99):.2f}ms")
+
+
+async def run_scenario(name, scenario, time_scale, seed):
+    clock = ScaledClock(time_scale)
+    request_helper, redis_client = build_limiter(scenario["config"])
+    app = build_app(request_helper, redis_client, clock)
+    rng = random.Random(seed)
+    rows = []
+
+    start = time.perf_counter()
+    await asyncio.gather(*(run_user(app, clock, name, scenario, user, rows, rng) for user in scenario["users"]))
+    wall_time = time.perf_counter() - start
+
+    summarize(name, rows, wall_time)
+    return rows
+
+
+def apply_overrides(scenario, args):
+    """
+    Command line overrides for users, iterations, timer and token distribution
+    """
+    scenario = dict(scenario)
+    if args.users is not None:
+        templates = scenario["users"]
+        scenario["users"] = [
+            {**templates[i % len(templates)], "name": f"dummy_user_{i + 1}"} for i in range(args.users)
+        ]
+    if args.iterations is not None:
+        scenario["iterations"] = args.iterations
+    if args.timer is not None:
+        scenario["timer"] = args.timer
+    if args.tokens is not None:
+        scenario["users"] = [{**user, "tokens": args.tokens} for user in scenario["users"]]
+    return scenario
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay the JMeter rate limit scenarios")
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), action="append",
+                        help="scenario to run (repeatable, default: all)")
+    parser.add_argument("--users", type=int, help="number of users (cycles over the scenario's apps)")
+    parser.add_argument("--iterations", type=int, help="requests per user")
+    parser.add_argument("--timer", type=float, help="constant timer between a user's requests, seconds")
+    parser.add_argument("--tokens", help='tokens per response: "61", "25:5" (mean:stdev) or "10-300"')
+    parser.add_argument("--time-scale", type=float, default=0.01, help="wall seconds per test second")
+    parser.add_argument("--csv", help="write one row per request to this CSV file")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--no-assert", action="store_true", help="don't check the expected allow/deny pattern")
+    args = parser.parse_args(argv)
+
+    overridden = any(value is not None for value in (args.users, args.iterations, args.timer, args.tokens))
+    all_rows = []
+    failures = []
+    for name in args.scenario or sorted(SCENARIOS):
+        scenario = apply_overrides(SCENARIOS[name], args)
+        rows = asyncio.run(run_scenario(name, scenario, args.time_scale, args.seed))
+        all_rows += rows
+        # The expected patterns only hold for the scenarios as the reports ran them
+        if not args.no_assert and not overridden:
+            failures += [f"[{name}] {failure}" for failure in check_expected(scenario, rows)]
+
+    if args.csv:
+        with open(args.csv, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(all_rows[0]))
+            writer.writeheader()
+            writer.writerows(all_rows)
+
+    for failure in failures:
+        print(f"FAIL {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
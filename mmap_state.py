@@ -0,0 +1,134 @@
+import fcntl
+import mmap
+import os
+import struct
+import threading
+
+from token_bucket import BUCKET_FIELDS, apply_token_bucket, compile_slot_table
+
+# File layout: 16 byte header, then one fixed-size record per (app_id, model_id) slot
+HEADER = struct.Struct("<4sIQ")          # magic, version, slot count
+MAGIC = b"RLMM"
+VERSION = 1
+KEY_SIZE = 64
+RECORD = struct.Struct(f"<{KEY_SIZE}s4d")  # key + BUCKET_FIELDS
+STATE = struct.Struct("<4d")               # BUCKET_FIELDS only
+
+
+def _encode_key(app_id, model_id):
+    """
+    Record key stored in front of each record so state can be matched up after a config change
+    """
+    key = f"{app_id}\x1f{model_id}".encode("utf-8")
+    if len(key) > KEY_SIZE:
+        raise ValueError(f"app_id + model_id too long for state record: {app_id}:{model_id}")
+    return key
+
+
+class MmapBucketStore:
+    def __init__(self, path, config):
+        """
+        Memory-mapped bucket state for single-host deployments without Redis
+        Each (app_id, model_id) gets a fixed record, so an update touches one record under a
+        byte-range lock instead of rewriting the whole JSON file under one global lock
+        """
+        self.path = path
+        self.slots, self.limits, initial_states = compile_slot_table(config)
+        self.keys = [None] * len(self.limits)
+        for (app_id, model_id), slot in self.slots.items():
+            self.keys[slot] = _encode_key(app_id, model_id)
+
+        # fcntl locks are per process, so threads in the same worker also need a lock per slot
+        self._thread_locks = [threading.Lock() for _ in self.limits]
+
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.mm = None
+        self._open(initial_states)
+
+    def _offset(self, slot):
+        return HEADER.size + slot * RECORD.size
+
+    def _read_existing(self):
+        """
+        Read records from a previous run, keyed by record key
+        Returns {} for a new, truncated or foreign file
+        """
+        header = os.pread(self.fd, HEADER.size, 0)
+        if len(header) < HEADER.size:
+            return {}
+        magic, version, count = HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION:
+            return {}
+
+        data = os.pread(self.fd, RECORD.size * count, HEADER.size)
+        existing = {}
+        for i in range(len(data) // RECORD.size):
+            record = RECORD.unpack_from(data, i * RECORD.size)
+            existing[record[0].rstrip(b"\x00")] = record[1:]
+        return existing
+
+    def _open(self, initial_states):
+        """
+        Map the state file, keeping the state of every (app_id, model_id) that survived a restart
+        """
+        size = HEADER.size + RECORD.size * len(self.limits)
+
+        # Whole-file lock only while the layout is checked or rebuilt at startup
+        fcntl.lockf(self.fd, fcntl.LOCK_EX)
+        try:
+            existing = self._read_existing()
+            layout_matches = list(existing) == self.keys
+
+            if not layout_matches:
+                os.ftruncate(self.fd, size)
+            self.mm = mmap.mmap(self.fd, size)
+
+            if not layout_matches:
+                HEADER.pack_into(self.mm, 0, MAGIC, VERSION, len(self.limits))
+                for slot, key in enumerate(self.keys):
+                    state = existing.get(key)
+                    if state is None:
+                        state = [initial_states[slot][field] for field in BUCKET_FIELDS]
+                    RECORD.pack_into(self.mm, self._offset(slot), key, *state)
+                self.mm.flush()
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+    def apply(self, app_id, model_id, requested_tokens=1, now=None):
+        """
+        Apply the token bucket to one record under a per-record lock
+        Raises KeyError if the (app_id, model_id) is not in the config
+        Returns (allowed, message)
+        """
+        slot = self.slots[(app_id, model_id)]
+        offset = self._offset(slot) + KEY_SIZE
+
+        with self._thread_locks[slot]:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, STATE.size, offset, os.SEEK_SET)
+            try:
+                state = dict(zip(BUCKET_FIELDS, STATE.unpack_from(self.mm, offset)))
+                allowed, message = apply_token_bucket(state, self.limits[slot], requested_tokens, now)
+                if allowed:
+                    STATE.pack_into(self.mm, offset, *(state[field] for field in BUCKET_FIELDS))
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, STATE.size, offset, os.SEEK_SET)
+        return allowed, message
+
+    def get_state(self, app_id, model_id):
+        """
+        Current state for one (app_id, model_id), for inspection
+        """
+        slot = self.slots[(app_id, model_id)]
+        return dict(zip(BUCKET_FIELDS, STATE.unpack_from(self.mm, self._offset(slot) + KEY_SIZE)))
+
+    def flush(self):
+        """
+        Push dirty pages to disk. Records already survive a process restart without this,
+        it only matters for a host crash
+        """
+        self.mm.flush()
+
+    def close(self):
+        self.mm.flush()
+        self.mm.close()
+        os.close(self.fd)
@@ -0,0 +1,219 @@
+"""
+Approximate global limits across regions that each run their own limiter
+
+Each region decides locally against its share of every (app_id, model_id) bucket: its local
+bucket gets share * max_tokens / refill_rate / burst_capacity. Regions periodically exchange
+grow-only counters (G-counters, merged by per-region max, so exchanges can be repeated,
+reordered or relayed) of requested tokens, and every region then recomputes the shares from
+the requested-token deltas since the previous round.
+
+Global overshoot bound:
+- When every sync round completes, all regions compute shares from the same merged counters,
+  so the shares sum to 1 and the local refill rates sum to the global one. On a share change
+  each bucket is first refilled up to now at its old share; a region whose share shrinks then
+  scales its tokens (and its burst room) down with it, while a region whose share grows keeps
+  what it holds and only refills faster from then on. Rebalancing never adds tokens, so the
+  local buckets together never hold more than one global bucket: over any interval T the regions
+  together admit at most max_tokens + refill_rate * T (+ burst_capacity), the single-bucket limit.
+- A region that misses rounds keeps a share the others no longer assume for it. The excess is at
+  most 1 - R * min_share of the limit, and only until stale_after seconds without a sync, after
+  which the region falls back to min_share. Worst case overshoot is therefore
+  (1 - R * min_share) * (max_tokens + refill_rate * stale_after).
+"""
+import time
+
+from token_bucket import apply_token_bucket, compile_slot_table
+
+
+class GCounter:
+    def __init__(self, counts=None):
+        """
+        Grow-only counter with one entry per region
+        """
+        self.counts = dict(counts or {})
+
+    def increment(self, region, amount):
+        self.counts[region] = self.counts.get(region, 0) + amount
+
+    def merge(self, counts):
+        for region, value in counts.items():
+            if value > self.counts.get(region, 0):
+                self.counts[region] = value
+
+    def value(self):
+        return sum(self.counts.values())
+
+
+class RegionNode:
+    def __init__(self, region_id, regions, config, min_share=0.05, stale_after=30, now=None):
+        """
+        One region's view: local buckets at its current share plus the merged counters
+        """
+        if now is None:
+            now = time.time()
+        self.region_id = region_id
+        self.regions = sorted(regions)
+        self.min_share = min_share
+        self.stale_after = stale_after
+        self.last_sync = now
+
+        self.slots, self.limits, _ = compile_slot_table(config)
+        equal_share = 1 / len(self.regions)
+        self.shares = {}
+        self.states = {}
+        self.requested = {}
+        self._last_round = {}
+        for key, slot in self.slots.items():
+            self.shares[key] = {region: equal_share for region in self.regions}
+            self.states[key] = {
+                "available_tokens": self.limits[slot]["max_tokens"] * equal_share,
+                "last_refill_ts": now,
+                "burst_tokens_used": 0,
+                "burst_window_start": now
+            }
+            self.requested[key] = GCounter()
+            self._last_round[key] = {}
+
+    def local_share(self, key, now=None):
+        """
+        This region's share of a bucket; min_share once it hasn't synced for stale_after
+        """
+        if now is None:
+            now = time.time()
+        if now - self.last_sync > self.stale_after:
+            return self.min_share
+        return self.shares[key][self.region_id]
+
+    def local_limits(self, key, now=None):
+        share = self.local_share(key, now)
+        limits = dict(self.limits[self.slots[key]])
+        for field in ("max_tokens", "refill_rate", "burst_capacity"):
+            limits[field] = limits[field] * share
+        return limits
+
+    def apply(self, app_id, model_id, requested_tokens=1, now=None):
+        """
+        Local decision against this region's share, no cross-region call
+        Returns (allowed, message)
+        """
+        if now is None:
+            now = time.time()
+        key = (app_id, model_id)
+        limits = self.local_limits(key, now)
+
+        # A region that fell back to min_share may hold more than its bucket now allows
+        state = self.states[key]
+        state["available_tokens"] = min(state["available_tokens"], limits["max_tokens"])
+
+        self.requested[key].increment(self.region_id, requested_tokens)
+        return apply_token_bucket(state, limits, requested_tokens, now)
+
+    def export_state(self):
+        """
+        Counters to send to the other regions
+        """
+        return {key: {"requested": dict(self.requested[key].counts)} for key in self.slots}
+
+    def merge(self, remote_state):
+        for key, counters in remote_state.items():
+            if key in self.slots:
+                self.requested[key].merge(counters["requested"])
+
+    def rebalance(self, now=None):
+        """
+        Recompute every region's share from requested tokens since the previous round
+        Shares are a pure function of the merged counters, so regions with the same view agree
+        """
+        if now is None:
+            now = time.time()
+        region_count = len(self.regions)
+        spare = 1 - region_count * self.min_share
+
+        for key, slot in self.slots.items():
+            counts = self.requested[key].counts
+            last_round = self._last_round[key]
+            deltas = {region: counts.get(region, 0) - last_round.get(region, 0) for region in self.regions}
+            total = sum(deltas.values())
+            if total > 0:
+                # Settle the refill (and burst window) up to now at the share it accrued under
+                state = self.states[key]
+                old_limits = self.local_limits(key, now)
+                old_share = self.local_share(key, now)
+                apply_token_bucket(state, old_limits, 0, now)
+                self.shares[key] = {
+                    region: self.min_share + spare * deltas[region] / total for region in self.regions
+                }
+
+                # A shrinking share gives up tokens and burst room in proportion; a growing one
+                # keeps what it holds (scaling it up would create capacity), so the burst room
+                # gained only opens up at the next burst window
+                new_share = self.shares[key][self.region_id]
+                if new_share < old_share:
+                    ratio = new_share / old_share
+                    state["available_tokens"] *= ratio
+                    state["burst_tokens_used"] *= ratio
+                else:
+                    state["burst_tokens_used"] += (new_share - old_share) * self.limits[slot]["burst_capacity"]
+            self._last_round[key] = dict(counts)
+
+        self.last_sync = now
+
+
+def sync_round(nodes, now=None):
+    """
+    Full-mesh exchange: every node merges every other node's counters, then rebalances
+    """
+    exports = [node.export_state() for node in nodes]
+    for node in nodes:
+        for export in exports:
+            node.merge(export)
+    for node in nodes:
+        node.rebalance(now)
+
+
+# Simulation with in-process regions: python multi_region.py
+if __name__ == "__main__":
+    import random
+
+    config = {"apps": [{"app_id": "app_001", "models": [{
+        "model_id": "gpt-4.5",
+        "rate_limit": {"max_tokens": 6000, "refill_rate": 100},
+        "burst": {"burst_capacity": 0, "burst_window": 60}
+    }]}]}
+    key = ("app_001", "gpt-4.5")
+    traffic = {"us": 0.7, "eu": 0.25, "ap": 0.05}
+    duration, step, sync_interval, request_tokens = 300, 0.01, 5, 20
+
+    def run(partitioned=None, shift=False):
+        random.seed(7)
+        nodes = {region: RegionNode(region, traffic, config, now=0.0) for region in traffic}
+        single = {"available_tokens": 6000, "last_refill_ts": 0.0, "burst_tokens_used": 0, "burst_window_start": 0.0}
+        single_limits = compile_slot_table(config)[1][0]
+        admitted = {region: 0 for region in traffic}
+        single_admitted = 0
+
+        for i in range(1, int(duration / step)):
+            now = i * step
+            # ~2x the global refill rate in offered load, split by region
+            if random.random() < 0.1:
+                # shift: us and eu swap traffic halfway through, so shares move between full buckets
+                weights = dict(traffic, us=traffic["eu"], eu=traffic["us"]) if shift and now > duration / 2 else traffic
+                region = random.choices(list(weights), weights=weights.values())[0]
+                if nodes[region].apply(*key, request_tokens, now)[0]:
+                    admitted[region] += request_tokens
+                if apply_token_bucket(single, single_limits, request_tokens, now)[0]:
+                    single_admitted += request_tokens
+            if i % int(sync_interval / step) == 0:
+                sync_round([n for r, n in nodes.items() if r != partitioned], now)
+
+        total = sum(admitted.values())
+        label = f"'{partitioned}' partitioned" if partitioned else "all rounds complete"
+        if shift:
+            label += ", traffic shifting"
+        bound = single_limits["max_tokens"] + single_limits["refill_rate"] * duration
+        print(f"{label}: regions admitted {total} tokens vs {single_admitted} for one global bucket "
+              f"({(total / single_admitted - 1) * 100:+.1f}%, bound {bound:.0f}), per region {admitted}")
+
+    run()
+    run(shift=True)
+    run(partitioned="ap")
@@ -0,0 +1,103 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+
+
+def size_class(requested_tokens):
+    """
+    Power-of-two class of a token request: 1, 2-3, 4-7, 8-15, ...
+    """
+    return max(int(requested_tokens), 1).bit_length()
+
+
+def earliest_retry_at(state, max_tokens, refill_rate, burst_capacity, burst_window, requested_tokens,
+                      burst_decay=None):
+    """
+    Earliest time a request of requested_tokens could pass check_token_based_rate_limit,
+    given the state saved right after it was denied (burst_decay as in token_bucket.BURST_DECAY_MODES)
+    """
+    candidates = []
+
+    # Base quota: fits right away, or once the bucket has refilled up to requested_tokens
+    missing = requested_tokens - state["available_tokens"]
+    if missing <= 0:
+        candidates.append(state["last_refill_ts"])
+    elif requested_tokens <= max_tokens and refill_rate > 0:
+        candidates.append(state["last_refill_ts"] + missing / refill_rate)
+
+    # Burst quota: fits right away, or once the window elapses and burst_tokens_used is zeroed,
+    # or in a decaying mode once enough of burst_tokens_used has decayed
+    excess = state["burst_tokens_used"] + requested_tokens - burst_capacity
+    if excess <= 0:
+        candidates.append(state["last_refill_ts"])
+    elif burst_decay == "linear" and 0 < requested_tokens <= burst_capacity:
+        candidates.append(state["burst_window_start"] + excess * burst_window / burst_capacity)
+    elif burst_decay == "exponential" and requested_tokens < burst_capacity:
+        room = burst_capacity - requested_tokens
+        candidates.append(state["burst_window_start"] + burst_window * math.log(state["burst_tokens_used"] / room))
+    elif burst_decay is None and requested_tokens <= burst_capacity:
+        candidates.append(state["burst_window_start"] + burst_window)
+
+    return min(candidates) if candidates else math.inf
+
+
+class NegativeDecisionCache:
+    def __init__(self, max_entries=10000, max_ttl=60):
+        """
+        Per-worker cache of token-limit denials keyed by (app_id, model_id, token size class)
+        A cached entry holds the earliest retry time for the smallest request in its class,
+        so it can only reject requests that Redis would reject too. Other workers spending
+        the same bucket only push the real retry time later. max_ttl caps how long a denial is
+        trusted, for changes made to the bucket outside the limiter (admin top-ups, resets)
+        """
+        self.max_entries = max_entries
+        self.max_ttl = max_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+
+    def is_denied(self, app_id, model_id, requested_tokens, now=None):
+        """
+        True if a recent denial guarantees this request would be denied too
+        """
+        if now is None:
+            now = time.time()
+        key = (app_id, model_id, size_class(requested_tokens))
+
+        with self._lock:
+            retry_at = self._entries.get(key)
+            if retry_at is None:
+                return False
+            if now >= retry_at:
+                del self._entries[key]
+                return False
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True
+
+    def add(self, app_id, model_id, requested_tokens, state, max_tokens, refill_rate, burst_capacity, burst_window,
+            burst_decay=None):
+        """
+        Remember a denial until the earliest time the smallest request in its size class could pass
+        """
+        cls = size_class(requested_tokens)
+        smallest_in_class = 1 << (cls - 1)
+        retry_at = earliest_retry_at(
+            state, max_tokens, refill_rate, burst_capacity, burst_window, smallest_in_class, burst_decay
+        )
+        retry_at = min(retry_at, state["last_refill_ts"] + self.max_ttl)
+
+        key = (app_id, model_id, cls)
+        with self._lock:
+            self._entries[key] = retry_at
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self):
+        """
+        Drop everything, e.g. after the rate limit config changed
+        """
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,317 @@
+import glob
+import os
+import struct
+import threading
+import time
+from array import array
+
+from token_bucket import BUCKET_FIELDS, apply_token_bucket, compile_slot_table
+
+# Snapshot file: header, the slot keys, then all bucket fields as one array of doubles
+# Version 2 length-prefixes the ids; version 1 joined them with "\n" / "\x1f" and is still read
+SNAPSHOT_HEADER = struct.Struct("<4sIQQQ")  # magic, version, last seq, slot count, keys blob size
+SNAPSHOT_MAGIC = b"RLSN"
+SNAPSHOT_VERSION = 2
+SNAPSHOT_FILE = "snapshot.bin"
+KEY_LENGTHS = struct.Struct("<II")  # app_id bytes, model_id bytes
+
+# Write-ahead log: one fixed record per allowed decision, replayed with the same timestamp
+WAL_RECORD = struct.Struct("<QQdd")  # seq, slot, requested_tokens, now
+FIELD_COUNT = len(BUCKET_FIELDS)
+
+
+def _keys_blob(keys):
+    parts = []
+    for app_id, model_id in keys:
+        app_bytes, model_bytes = app_id.encode("utf-8"), model_id.encode("utf-8")
+        parts += [KEY_LENGTHS.pack(len(app_bytes), len(model_bytes)), app_bytes, model_bytes]
+    return b"".join(parts)
+
+
+def _parse_keys_blob(blob, version=SNAPSHOT_VERSION):
+    if not blob:
+        return []
+    if version == 1:
+        return [tuple(line.split("\x1f", 1)) for line in blob.decode("utf-8").split("\n")]
+    keys = []
+    offset = 0
+    while offset < len(blob):
+        app_length, model_length = KEY_LENGTHS.unpack_from(blob, offset)
+        offset += KEY_LENGTHS.size
+        app_id = blob[offset:offset + app_length].decode("utf-8")
+        offset += app_length
+        keys.append((app_id, blob[offset:offset + model_length].decode("utf-8")))
+        offset += model_length
+    return keys
+
+
+class PersistentBucketEngine:
+    def __init__(self, config, state_dir, snapshot_interval=60, wal_sync_interval=0.05):
+        """
+        In-memory token bucket engine whose state survives restarts
+        Every allowed decision is appended to a write-ahead log and the whole table is
+        snapshotted periodically. On startup the snapshot is loaded and the log tail replayed;
+        refill for the downtime is applied lazily from last_refill_ts like any other gap,
+        so a deploy no longer hands every app a full fresh quota
+
+        The log is flushed and fsynced every wal_sync_interval seconds (group commit: by the
+        decision that finds the interval elapsed, and by the background thread from start()
+        when traffic stops). A crash loses at most the decisions of the last wal_sync_interval
+        seconds; wal_sync_interval=0 fsyncs every decision before it returns
+        """
+        self.state_dir = state_dir
+        self.snapshot_interval = snapshot_interval
+        self.wal_sync_interval = wal_sync_interval
+
+        self.slots, self.limits, initial_states = compile_slot_table(config)
+        self.keys = sorted(self.slots, key=self.slots.get)
+        self.states = array("d", [state[field] for state in initial_states for field in BUCKET_FIELDS])
+
+        self.seq = 0
+        self._lock = threading.Lock()
+        self._wal = None
+        self._unflushed = 0
+        self._last_sync = time.monotonic()
+        self._snapshot_thread = None
+        self._sync_thread = None
+        self._stop = threading.Event()
+
+        os.makedirs(state_dir, exist_ok=True)
+        self.recover()
+
+    def _wal_segments(self):
+        """
+        WAL segment paths in seq order; each segment is named after the first seq it may hold
+        """
+        paths = glob.glob(os.path.join(self.state_dir, "wal.*.log"))
+        return sorted(paths, key=lambda path: int(os.path.basename(path).split(".")[1]))
+
+    def _open_wal_segment(self):
+        path = os.path.join(self.state_dir, f"wal.{self.seq + 1}.log")
+        self._wal = open(path, "ab")
+
+    def recover(self):
+        """
+        Load the latest snapshot, replay the log tail, then write a fresh snapshot
+        Returns the number of log records replayed
+        """
+        snapshot_seq, old_to_new = self._load_snapshot()
+        self.seq = snapshot_seq
+
+        # The log is always relative to the snapshot's slot layout (see snapshot())
+        replayed = 0
+        for path in self._wal_segments():
+            with open(path, "rb") as f:
+                data = f.read()
+            # A torn last record from a crash mid-write is ignored
+            usable = len(data) - len(data) % WAL_RECORD.size
+            for seq, old_slot, requested_tokens, now in WAL_RECORD.iter_unpack(data[:usable]):
+                if seq <= self.seq:
+                    continue
+                self.seq = seq
+                slot = old_to_new.get(old_slot) if old_to_new is not None else old_slot
+                if slot is None:
+                    continue
+                self._apply_slot(slot, requested_tokens, now)
+                replayed += 1
+
+        # Compact straight away so the log and the snapshot share this config's layout
+        self.snapshot()
+        return replayed
+
+    def _load_snapshot(self):
+        """
+        Copy snapshot state into self.states
+        Returns (last seq, old slot -> new slot map or None when the layout is unchanged)
+        """
+        path = os.path.join(self.state_dir, SNAPSHOT_FILE)
+        if not os.path.exists(path):
+            return 0, None
+
+        with open(path, "rb") as f:
+            magic, version, last_seq, count, blob_size = SNAPSHOT_HEADER.unpack(f.read(SNAPSHOT_HEADER.size))
+            if magic != SNAPSHOT_MAGIC or version not in (1, SNAPSHOT_VERSION):
+                return 0, None
+            blob = f.read(blob_size)
+            saved = array("d")
+            saved.frombytes(f.read(count * FIELD_COUNT * saved.itemsize))
+
+        # Fast path: same config as the last run, take the array as is
+        if version == SNAPSHOT_VERSION and blob == _keys_blob(self.keys):
+            self.states = saved
+            return last_seq, None
+
+        old_to_new = {}
+        for old_slot, key in enumerate(_parse_keys_blob(blob, version)):
+            slot = self.slots.get(key)
+            if slot is None:
+                continue
+            old_to_new[old_slot] = slot
+            self.states[slot * FIELD_COUNT:(slot + 1) * FIELD_COUNT] = \
+                saved[old_slot * FIELD_COUNT:(old_slot + 1) * FIELD_COUNT]
+        return last_seq, old_to_new
+
+    def _apply_slot(self, slot, requested_tokens, now):
+        base = slot * FIELD_COUNT
+        state = dict(zip(BUCKET_FIELDS, self.states[base:base + FIELD_COUNT]))
+        allowed, message = apply_token_bucket(state, self.limits[slot], requested_tokens, now)
+        if allowed:
+            self.states[base:base + FIELD_COUNT] = array("d", [state[field] for field in BUCKET_FIELDS])
+        return allowed, message
+
+    def apply(self, app_id, model_id, requested_tokens=1, now=None):
+        """
+        Apply the token bucket and log the decision if it changed state
+        Raises KeyError if the (app_id, model_id) is not in the config
+        Returns (allowed, message)
+        """
+        slot = self.slots[(app_id, model_id)]
+        if now is None:
+            now = time.time()
+
+        with self._lock:
+            allowed, message = self._apply_slot(slot, requested_tokens, now)
+            # Denied requests leave the state untouched, so only allowed ones are logged
+            if allowed:
+                self.seq += 1
+                self._wal.write(WAL_RECORD.pack(self.seq, slot, requested_tokens, now))
+                self._unflushed += 1
+                sync_due = time.monotonic() - self._last_sync >= self.wal_sync_interval
+        if allowed and sync_due:
+            self.sync()
+        return allowed, message
+
+    def sync(self):
+        """
+        Flush the log and fsync it; the fsync runs outside the lock so decisions keep going
+        """
+        with self._lock:
+            self._last_sync = time.monotonic()
+            if not self._unflushed:
+                return
+            self._wal.flush()
+            self._unflushed = 0
+            wal_fd = self._wal.fileno()
+        try:
+            os.fsync(wal_fd)
+        except OSError:
+            # The segment was closed by a snapshot meanwhile, and the snapshot covers it
+            pass
+
+    def get_state(self, app_id, model_id):
+        """
+        Current state for one (app_id, model_id), for inspection
+        """
+        base = self.slots[(app_id, model_id)] * FIELD_COUNT
+        return dict(zip(BUCKET_FIELDS, self.states[base:base + FIELD_COUNT]))
+
+    def snapshot(self):
+        """
+        Write a compact snapshot and drop the log segments it covers
+        Only the in-memory copy happens under the lock; the disk write does not block decisions
+        """
+        with self._lock:
+            states = array("d", self.states)
+            seq = self.seq
+            old_wal = self._wal
+            self._open_wal_segment()
+            self._unflushed = 0
+        if old_wal is not None:
+            old_wal.close()
+
+        blob = _keys_blob(self.keys)
+        path = os.path.join(self.state_dir, SNAPSHOT_FILE)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, seq, len(self.keys), len(blob)))
+            f.write(blob)
+            states.tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+        # Everything except the segment opened above is now covered by the snapshot
+        current = self._wal.name
+        for segment in self._wal_segments():
+            if segment != current:
+                os.remove(segment)
+
+    def start(self):
+        """
+        Snapshot every snapshot_interval seconds and sync the log every wal_sync_interval
+        seconds in background threads
+        """
+        def run():
+            while not self._stop.wait(self.snapshot_interval):
+                self.snapshot()
+
+        def sync():
+            while not self._stop.wait(max(self.wal_sync_interval, 0.001)):
+                self.sync()
+
+        self._snapshot_thread = threading.Thread(target=run, name="bucket-snapshots", daemon=True)
+        self._snapshot_thread.start()
+        self._sync_thread = threading.Thread(target=sync, name="bucket-wal-sync", daemon=True)
+        self._sync_thread.start()
+
+    def close(self):
+        """
+        Stop background snapshots and leave a final snapshot behind for a fast restart
+        """
+        self._stop.set()
+        for thread in (self._snapshot_thread, self._sync_thread):
+            if thread is not None:
+                thread.join()
+        self.snapshot()
+        self._wal.close()
+
+
+# Startup benchmark: python persistent_limiter.py [buckets] [logged decisions]
+if __name__ == "__main__":
+    import shutil
+    import sys
+    import tempfile
+
+    bucket_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    decision_count = int(sys.argv[2]) if len(sys.argv) > 2 else 100_000
+    models_per_app = 4
+
+    config = {"apps": [
+        {"app_id": f"app_{a:07d}", "models": [
+            {"model_id": f"model_{m}", "rate_limit": {"max_tokens": 100000, "refill_rate": 1000},
+             "burst": {"burst_capacity": 20000, "burst_window": 60}}
+            for m in range(models_per_app)
+        ]}
+        for a in range(bucket_count // models_per_app)
+    ]}
+    state_dir = tempfile.mkdtemp(prefix="rate_limiter_state_")
+
+    try:
+        start = time.perf_counter()
+        engine = PersistentBucketEngine(config, state_dir)
+        print(f"cold start (no state, {len(engine.keys)} buckets): {time.perf_counter() - start:.3f}s")
+
+        start = time.perf_counter()
+        keys = engine.keys
+        for i in range(decision_count):
+            app_id, model_id = keys[(i * 7919) % len(keys)]
+            engine.apply(app_id, model_id, 10)
+        elapsed = time.perf_counter() - start
+        print(f"{decision_count} logged decisions: {elapsed:.3f}s ({elapsed / decision_count * 1e6:.2f}us each)")
+
+        # Simulate a crash: sync the log but skip the final snapshot
+        engine.sync()
+        del engine
+
+        start = time.perf_counter()
+        compile_slot_table(config)
+        compile_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        engine = PersistentBucketEngine(config, state_dir)
+        elapsed = time.perf_counter() - start
+        print(f"recovery (snapshot + {decision_count} log records): {elapsed:.3f}s, "
+              f"of which ~{compile_time:.3f}s is compiling the config")
+        engine.close()
+    finally:
+        shutil.rmtree(state_dir)
@@ -0,0 +1,90 @@
+import re
+
+# Declarative rate limit windows, configured per model as
+#   "rate_limit": {"windows": ["10/s", "500/min", "20000/hour", "2M tokens/day"], ...}
+# Each window is parsed to (limit, seconds, unit) with unit "requests" or "tokens"; every window
+# of a model is checked and charged by TOKEN_BUCKET_LUA in the same call
+
+WINDOW_UNITS = ("requests", "tokens")
+
+_PERIOD_SECONDS = {
+    "s": 1, "sec": 1, "second": 1, "seconds": 1,
+    "m": 60, "min": 60, "minute": 60, "minutes": 60,
+    "h": 3600, "hr": 3600, "hour": 3600, "hours": 3600,
+    "d": 86400, "day": 86400, "days": 86400
+}
+
+_MULTIPLIERS = {"": 1, "k": 1_000, "m": 1_000_000, "b": 1_000_000_000}
+
+# "<amount>[k|M|B] [requests|tokens] / [count]<period>", e.g. "10/s", "2M tokens/day", "100/5min"
+_WINDOW_RE = re.compile(
+    r"^\s*(\d+(?:\.\d+)?)\s*([kmb]?)\s*(requests?|reqs?|tokens?)?\s*/\s*(\d+)?\s*([a-z]+)\s*$",
+    re.IGNORECASE
+)
+
+
+def parse_window(text):
+    """
+    "500/min" -> (500, 60, "requests"); "2M tokens/day" -> (2000000, 86400, "tokens")
+    Raises ValueError for anything else
+    """
+    match = _WINDOW_RE.match(text)
+    if not match:
+        raise ValueError(f"Invalid rate limit window {text!r}, expected e.g. '500/min' or '2M tokens/day'")
+    amount, multiplier, unit, count, period = match.groups()
+    seconds = _PERIOD_SECONDS.get(period.lower())
+    if seconds is None:
+        raise ValueError(f"Invalid rate limit window {text!r}: unknown period {period!r}")
+    limit = float(amount) * _MULTIPLIERS[multiplier.lower()]
+    if limit != int(limit):
+        raise ValueError(f"Invalid rate limit window {text!r}: limit must be a whole number")
+    seconds *= int(count or 1)
+    if seconds <= 0:
+        raise ValueError(f"Invalid rate limit window {text!r}: period must be at least 1 second")
+    unit = "tokens" if unit and unit.lower().startswith("token") else "requests"
+    return int(limit), seconds, unit
+
+
+def parse_policy(spec):
+    """
+    A list of window strings (or one string separated by ";" or ",") -> list of
+    (limit, seconds, unit), shortest window first
+    """
+    if isinstance(spec, str):
+        spec = [part for part in re.split(r"[;,]", spec) if part.strip()]
+    windows = [parse_window(text) for text in spec]
+    return sorted(windows, key=lambda window: (window[1], WINDOW_UNITS.index(window[2])))
+
+
+def windows_from_rate_limit(rate_limit, rpm=None, rps=None):
+    """
+    Windows of a model's rate_limit section: "windows" if set, otherwise the legacy "rpm"/"rps"
+    fields (rpm/rps arguments are the defaults for those)
+    """
+    if "windows" in rate_limit:
+        return parse_policy(rate_limit["windows"])
+    windows = []
+    rps = rate_limit.get("rps", rps)
+    rpm = rate_limit.get("rpm", rpm)
+    if rps is not None:
+        windows.append((rps, 1, "requests"))
+    if rpm is not None:
+        windows.append((rpm, 60, "requests"))
+    return windows
+
+
+def limits_string(windows):
+    """
+    Request windows in the limits library syntax, e.g. "10/second;500/minute"
+    (token windows have no equivalent there)
+    """
+    names = {1: "second", 60: "minute", 3600: "hour", 86400: "day"}
+    parts = []
+    for limit, seconds, unit in windows:
+        if unit != "requests":
+            continue
+        if seconds in names:
+            parts.append(f"{limit}/{names[seconds]}")
+        else:
+            parts.append(f"{limit}/{seconds} seconds")
+    return ";".join(parts)
@@ -0,0 +1,657 @@
+"""
+Redis token bucket, request/token windows, quotas and shared model capacity for RequestHelper
+
+A pair's own limits (request windows, token bucket, shadow policies) are decided in one script
+call, atomic and in one round trip. The app's quotas (quota:{app_id}) and the model's shared pool
+(shared:{model_id}) are shared with other pairs, so on Redis Cluster they hash to other slots,
+and one script can't touch keys in several slots (CROSSSLOT). They are charged first, in one
+pipelined round trip of their own scripts, and given back if the pair's script denies or fails.
+A request with quotas or a shared pool therefore takes two round trips, and three when the pair
+denies it after they were charged; in between, a concurrent request can see them charged.
+"""
+import time
+
+# Same defaults RequestHelper falls back to when an app/model is missing from the config
+DEFAULT_LIMITS = {
+    "max_tokens": 1000,
+    "refill_rate": 10,
+    "burst_capacity": 100,
+    "burst_window": 60
+}
+
+# check_api_rate_limit + check_token_based_rate_limit as one script, so a decision is a
+# single round trip and concurrent workers can't interleave between the read and the write
+#
+# KEYS[1] api_rate:{app_id:model_id}       request windows
+# KEYS[2] dynamic:{app_id:model_id}        token bucket
+# KEYS[3..] shadow:name:{app_id:model_id}  one token bucket per shadow policy
+# Every key carries the pair's hash tag, so the script stays in one cluster slot; the app's quotas
+# and the model's shared pool are in other slots and have their own scripts below
+# ARGV    now, requested_tokens, dry_run, max_tokens, refill_rate, burst_capacity,
+#         burst_window, window_count, then per window: limit, seconds, count field, start field, unit
+#         ("requests" counts 1 per request, "tokens" counts requested_tokens),
+#         then shadow_count, then per shadow policy: max_tokens, refill_rate, burst_capacity, burst_window,
+#         then burst decay ("", "linear" or "exponential", see token_bucket.BURST_DECAY_MODES)
+#         (max_tokens == "" skips the token bucket)
+# Returns allowed, reason, denied window, remaining requests, reset at, available tokens, burst used,
+#         the token/burst/exceeded outcome of every shadow policy, and the burst window start
+#         (the token bucket fields are "" when it didn't run)
+TOKEN_BUCKET_LUA = """
+local now = tonumber(ARGV[1])
+local requested = tonumber(ARGV[2])
+local dry_run = ARGV[3] == '1'
+local window_count = tonumber(ARGV[8])
+
+-- Request and token windows: reset when elapsed, deny when the request doesn't fit
+local counts = {}
+local costs = {}
+local starts = {}
+local remaining = -1
+local reset_at = -1
+local denied_window = 0
+for i = 1, window_count do
+    local base = 8 + (i - 1) * 5
+    local limit = tonumber(ARGV[base + 1])
+    local seconds = tonumber(ARGV[base + 2])
+    local cost = 1
+    if ARGV[base + 5] == 'tokens' then
+        cost = requested
+    end
+    local state = redis.call('HMGET', KEYS[1], ARGV[base + 3], ARGV[base + 4])
+    local count = tonumber(state[1]) or 0
+    local start = tonumber(state[2]) or now
+    if now - start >= seconds then
+        start = now
+        count = 0
+    end
+    if count + cost > limit then
+        denied_window = i
+        remaining = 0
+        reset_at = start + seconds
+        break
+    end
+    counts[i] = count
+    costs[i] = cost
+    starts[i] = start
+    if ARGV[base + 5] ~= 'tokens' and (remaining < 0 or limit - count - 1 < remaining) then
+        remaining = limit - count - 1
+    end
+    if reset_at < 0 or start + seconds < reset_at then
+        reset_at = start + seconds
+    end
+end
+
+-- Burst usage brought to now: zeroed once the window has elapsed, or decayed continuously
+local shadow_base = 9 + window_count * 5
+local burst_decay = ARGV[shadow_base + 1 + (tonumber(ARGV[shadow_base]) or 0) * 4]
+local function settle_burst(used, start, capacity, window)
+    if burst_decay == 'linear' or burst_decay == 'exponential' then
+        if window <= 0 then
+            return 0, now
+        elseif burst_decay == 'linear' then
+            return math.max(0, used - (now - start) * capacity / window), now
+        end
+        return used * math.exp(-(now - start) / window), now
+    end
+    if now - start > window then
+        return 0, now
+    end
+    return used, start
+end
+
+-- Token bucket with burst overflow, skipped once a window denied
+local allowed = 1
+local reason = 'none'
+local available = ''
+local burst_used = ''
+local burst_start = ''
+local shadow = {}
+if denied_window > 0 then
+    allowed = 0
+    reason = 'window'
+elseif ARGV[4] ~= '' then
+    local max_tokens = tonumber(ARGV[4])
+    local refill_rate = tonumber(ARGV[5])
+    local burst_capacity = tonumber(ARGV[6])
+    local burst_window = tonumber(ARGV[7])
+    local bucket = redis.call('HMGET', KEYS[2],
+        'available_tokens', 'last_refill_ts', 'burst_tokens_used', 'burst_window_start')
+    available = tonumber(bucket[1]) or max_tokens
+    local last_refill = tonumber(bucket[2]) or now
+    burst_used = tonumber(bucket[3]) or 0
+    burst_start = tonumber(bucket[4]) or now
+
+    available = math.min(max_tokens, available + (now - last_refill) * refill_rate)
+    burst_used, burst_start = settle_burst(burst_used, burst_start, burst_capacity, burst_window)
+
+    if requested <= available then
+        available = available - requested
+        reason = 'token'
+    elseif burst_used + requested <= burst_capacity then
+        burst_used = burst_used + requested
+        reason = 'burst'
+    else
+        allowed = 0
+        reason = 'exceeded'
+    end
+
+    if not dry_run then
+        redis.call('HSET', KEYS[2],
+            'available_tokens', tostring(available), 'last_refill_ts', tostring(now),
+            'burst_tokens_used', tostring(burst_used), 'burst_window_start', tostring(burst_start))
+    end
+end
+
+-- Shadow policies: the same decision on their own bucket, as if each were the enforced token bucket,
+-- reported but never enforced. They are evaluated for every request, whatever denied it, so their
+-- counts cover all the traffic; a shadow bucket is only charged when nothing but the live token
+-- bucket stood in the way (not on a window denial, nor on a dry run)
+for i = 1, tonumber(ARGV[shadow_base]) or 0 do
+    local base = shadow_base + (i - 1) * 4
+    local s_max = tonumber(ARGV[base + 1])
+    local s_refill = tonumber(ARGV[base + 2])
+    local s_burst_capacity = tonumber(ARGV[base + 3])
+    local s_burst_window = tonumber(ARGV[base + 4])
+    local s = redis.call('HMGET', KEYS[2 + i],
+        'available_tokens', 'last_refill_ts', 'burst_tokens_used', 'burst_window_start')
+    local s_available = tonumber(s[1]) or s_max
+    local s_last_refill = tonumber(s[2]) or now
+    local s_burst_used = tonumber(s[3]) or 0
+    local s_burst_start = tonumber(s[4]) or now
+
+    s_available = math.min(s_max, s_available + (now - s_last_refill) * s_refill)
+    s_burst_used, s_burst_start = settle_burst(s_burst_used, s_burst_start, s_burst_capacity, s_burst_window)
+    if requested <= s_available then
+        s_available = s_available - requested
+        shadow[i] = 'token'
+    elseif s_burst_used + requested <= s_burst_capacity then
+        s_burst_used = s_burst_used + requested
+        shadow[i] = 'burst'
+    else
+        shadow[i] = 'exceeded'
+    end
+
+    if not dry_run and denied_window == 0 then
+        redis.call('HSET', KEYS[2 + i],
+            'available_tokens', tostring(s_available), 'last_refill_ts', tostring(now),
+            'burst_tokens_used', tostring(s_burst_used), 'burst_window_start', tostring(s_burst_start))
+        -- Trials come and go; a shadow bucket nobody evaluates for a day is dropped
+        redis.call('EXPIRE', KEYS[2 + i], 86400)
+    end
+end
+
+-- Windows are only charged for requests that get through
+if allowed == 1 and not dry_run then
+    for i = 1, window_count do
+        local base = 8 + (i - 1) * 5
+        redis.call('HSET', KEYS[1], ARGV[base + 3], tostring(counts[i] + costs[i]), ARGV[base + 4], tostring(starts[i]))
+    end
+end
+
+return {allowed, reason, denied_window, remaining, tostring(reset_at), tostring(available), tostring(burst_used), shadow,
+    tostring(burst_start)}
+"""
+
+# Long-horizon quotas of one app: one used/period-id field pair per period, so the check is O(1)
+# whatever the period length; a counter restarts when the period id moves on
+#
+# KEYS[1] quota:{app_id}
+# ARGV    mode ("check", "charge", or "refund" to take a charge back), charge, quota_count,
+#         then per quota: limit, period, period id
+# Returns {1, 0}, or {0, index of the quota that denied}
+QUOTA_LUA = """
+local mode = ARGV[1]
+local charge = tonumber(ARGV[2])
+local quota_count = tonumber(ARGV[3])
+local used = {}
+local current = {}
+for i = 1, quota_count do
+    local base = 3 + (i - 1) * 3
+    local period = ARGV[base + 2]
+    local state = redis.call('HMGET', KEYS[1], period .. '_used', period .. '_id')
+    current[i] = state[2] == ARGV[base + 3]
+    used[i] = current[i] and (tonumber(state[1]) or 0) or 0
+    if mode ~= 'refund' and used[i] + charge > tonumber(ARGV[base + 1]) then
+        return {0, i}
+    end
+end
+if mode == 'check' then
+    return {1, 0}
+end
+
+for i = 1, quota_count do
+    local base = 3 + (i - 1) * 3
+    local period = ARGV[base + 2]
+    if mode == 'charge' then
+        redis.call('HSET', KEYS[1], period .. '_used', tostring(used[i] + charge), period .. '_id', ARGV[base + 3])
+    elseif current[i] then
+        -- A refund that lands after the period moved on has nothing left to give back to
+        redis.call('HSET', KEYS[1], period .. '_used', tostring(math.max(used[i] - charge, 0)))
+    end
+end
+if mode == 'charge' then
+    -- Longest period is a month, so an idle app's counters expire after it
+    redis.call('EXPIRE', KEYS[1], 2764800)
+end
+return {1, 0}
+"""
+
+# Shared model capacity: a priority class is shed once its request would take the pool below
+# the class's shed_below fraction, so what lies under a tier's floor stays for higher tiers
+#
+# KEYS[1] shared:{model_id}
+# ARGV    mode ("check", "charge", or "refund" to put tokens back), now, tokens, max_tokens, refill_rate, shed_below
+# Returns {allowed, available tokens before the change}
+SHARED_LUA = """
+local mode = ARGV[1]
+local now = tonumber(ARGV[2])
+local tokens = tonumber(ARGV[3])
+local max_tokens = tonumber(ARGV[4])
+local pool = redis.call('HMGET', KEYS[1], 'available_tokens', 'last_refill_ts')
+local available = tonumber(pool[1]) or max_tokens
+local last_refill = tonumber(pool[2]) or now
+available = math.min(max_tokens, available + (now - last_refill) * tonumber(ARGV[5]))
+
+local after = available
+if mode == 'refund' then
+    after = math.min(max_tokens, available + tokens)
+elseif available - tokens < tonumber(ARGV[6]) * max_tokens then
+    return {0, tostring(available)}
+elseif mode == 'charge' then
+    after = available - tokens
+end
+if mode ~= 'check' then
+    redis.call('HSET', KEYS[1], 'available_tokens', tostring(after), 'last_refill_ts', tostring(now))
+end
+return {1, tostring(available)}
+"""
+
+# Give back what an allowed TOKEN_BUCKET_LUA call charged, when a limit checked after it denies
+# the request. A window (or burst window) that started after the charge has nothing of it left.
+# charged_at goes through tostring like the stored window starts, so a window started by the
+# charge compares equal
+#
+# KEYS[1] api_rate:{app_id:model_id}
+# KEYS[2] dynamic:{app_id:model_id}
+# ARGV    charged_at, requested_tokens, max_tokens ("" skips the token bucket), from burst ("1"),
+#         window_count, then per window: count field, start field, unit
+REFUND_LUA = """
+local charged_at = tonumber(tostring(tonumber(ARGV[1])))
+local requested = tonumber(ARGV[2])
+local window_count = tonumber(ARGV[5])
+for i = 1, window_count do
+    local base = 5 + (i - 1) * 3
+    local state = redis.call('HMGET', KEYS[1], ARGV[base + 1], ARGV[base + 2])
+    local count = tonumber(state[1])
+    local start = tonumber(state[2])
+    if count and start and start <= charged_at then
+        local cost = 1
+        if ARGV[base + 3] == 'tokens' then
+            cost = requested
+        end
+        redis.call('HSET', KEYS[1], ARGV[base + 1], tostring(math.max(count - cost, 0)))
+    end
+end
+
+if ARGV[3] ~= '' then
+    local bucket = redis.call('HMGET', KEYS[2], 'available_tokens', 'burst_tokens_used', 'burst_window_start')
+    if ARGV[4] == '1' then
+        local burst_used = tonumber(bucket[2])
+        local burst_start = tonumber(bucket[3])
+        if burst_used and burst_start and burst_start <= charged_at then
+            redis.call('HSET', KEYS[2], 'burst_tokens_used', tostring(math.max(burst_used - requested, 0)))
+        end
+    elseif tonumber(bucket[1]) then
+        local available = math.min(tonumber(ARGV[3]), tonumber(bucket[1]) + requested)
+        redis.call('HSET', KEYS[2], 'available_tokens', tostring(available))
+    end
+end
+return 1
+"""
+
+# Long-horizon quota periods, configured per app as "quotas": {"unit": "tokens" | "cost", "day": ..., ...}
+QUOTA_PERIODS = ("hour", "day", "month")
+
+TOKEN_MESSAGES = {
+    "none": "API rate limit passed",
+    "token": "Allowed via token quota",
+    "burst": "Allowed via token burst quota",
+    "exceeded": "Token limit exceeded",
+    "priority": "Shared model capacity is reserved for higher priority apps",
+    "shared": "Shared model capacity exhausted"
+}
+
+
+# Per-pair keys carry a {app_id:model_id} hash tag, so on Redis Cluster every key of one pair
+# (and of one stripe, see hot_key_striping) lives in the same slot and a script may touch them together
+
+def pair_tag(app_id, model_id):
+    return f"{{{app_id}:{model_id}}}"
+
+
+def dynamic_key(app_id, model_id):
+    return f"dynamic:{pair_tag(app_id, model_id)}"
+
+
+def api_rate_key(app_id, model_id):
+    return f"api_rate:{pair_tag(app_id, model_id)}"
+
+
+def window_fields(seconds, unit="requests"):
+    """
+    Hash fields for a request (or token) window, matching the RequestHelper names for minute and second windows
+    """
+    if unit == "tokens":
+        return f"tokens_this_{seconds}s", f"token_window_start_{seconds}s"
+    if seconds == 60:
+        return "requests_this_minute", "minute_window_start"
+    if seconds == 1:
+        return "requests_this_second", "second_window_start"
+    return f"requests_this_{seconds}s", f"window_start_{seconds}s"
+
+
+def shadow_key(name, app_id, model_id):
+    return f"shadow:{name}:{pair_tag(app_id, model_id)}"
+
+
+def shared_key(model_id):
+    return f"shared:{model_id}"
+
+
+def quota_key(app_id):
+    return f"quota:{app_id}"
+
+
+def quota_period_id(period, now):
+    """
+    Index of the calendar period (UTC) that now falls in
+    """
+    if period == "hour":
+        return str(int(now // 3600))
+    if period == "day":
+        return str(int(now // 86400))
+    if period == "month":
+        t = time.gmtime(now)
+        return str(t.tm_year * 12 + t.tm_mon - 1)
+    raise ValueError(f"Unknown quota period {period!r}, expected one of {QUOTA_PERIODS}")
+
+
+def quota_charge(requested_tokens, quotas, cost_per_1k_tokens=None):
+    """
+    What a request counts against the app's quotas: tokens, or with "unit": "cost"
+    the model's cost_per_1k_tokens weight (1.0 when the model has none)
+    """
+    if quotas.get("unit", "tokens") == "cost":
+        weight = cost_per_1k_tokens if cost_per_1k_tokens is not None else 1.0
+        return requested_tokens * weight / 1000
+    return requested_tokens
+
+
+def configured_quotas(limits):
+    """
+    [(limit, period)] of the app's quotas in limits, shortest period first
+    """
+    app_quotas = limits.get("quotas") or {}
+    return [(app_quotas[period], period) for period in QUOTA_PERIODS if app_quotas.get(period) is not None]
+
+
+def quota_message(limits, index):
+    limit, period = configured_quotas(limits)[index - 1]
+    return f"Quota exceeded: {limit} {limits['quotas'].get('unit', 'tokens')}/{period}"
+
+
+def window_unit(seconds):
+    return {1: "second", 60: "minute", 3600: "hour", 86400: "day"}.get(seconds, f"{seconds}s")
+
+
+def as_window(window):
+    """
+    (limit, seconds) or (limit, seconds, unit) -> (limit, seconds, unit)
+    """
+    limit, seconds, *unit = window
+    return limit, seconds, unit[0] if unit else "requests"
+
+
+def window_message(window):
+    limit, seconds, unit = as_window(window)
+    return f"API rate limit exceeded: {limit} {unit}/{window_unit(seconds)}"
+
+
+def _float_or_none(value):
+    return float(value) if value not in (None, "", b"") else None
+
+
+def _no_lap(stage):
+    pass
+
+
+def _outside_denial(reason, args, result):
+    """
+    (reason, index of the denying quota) for a denied quota / shared pool call; a pool that can't
+    cover the request at all denies every priority class, so that isn't reported as priority shedding
+    """
+    if reason == "quota":
+        return reason, int(result[1])
+    if float(result[1]) < float(args[1]):
+        return "shared", 0
+    return reason, 0
+
+
+def _with_defaults(limits):
+    return {**DEFAULT_LIMITS, **{k: v for k, v in (limits or {}).items() if v is not None}}
+
+
+class RedisTokenBucket:
+    def __init__(self, redis_client, metrics=None):
+        """
+        Atomic request-window + token bucket check on the dynamic:/api_rate: keys RequestHelper uses
+        Decisions, and shadow policy outcomes, are counted in metrics (a LimiterMetrics) if given,
+        by outcome/reason (and app_id/model_id with LimiterMetrics(per_pair_labels=True))
+        """
+        self.redis_client = redis_client
+        self.metrics = metrics
+        self._script = redis_client.register_script(TOKEN_BUCKET_LUA)
+        self._quota_script = redis_client.register_script(QUOTA_LUA)
+        self._shared_script = redis_client.register_script(SHARED_LUA)
+        self._refund_script = redis_client.register_script(REFUND_LUA)
+
+    def check(self, app_id, model_id, requested_tokens=None, limits=None, windows=(), now=None, dry_run=False,
+              stripe=None, token_bucket=True, lap=None):
+        """
+        Check and charge every request window and the token bucket in one round trip
+        windows is a list of (limit, seconds) or (limit, seconds, unit) (see policy_spec); "tokens" windows
+        are charged requested_tokens. requested_tokens None, or token_bucket False, skips the token bucket
+        limits["quotas"] (the app's hour/day/month quotas) and limits["shared_capacity"] (the model's
+        capacity shared across apps, shed by priority class) live in other cluster slots: they are
+        charged first in one pipelined round trip and given back if the pair's own limits deny.
+        limits["shadow"] policies are evaluated for every request with tokens, whatever denies it, but never
+        deny (see decision["shadow"])
+        dry_run evaluates without writing anything; stripe (e.g. "#s3") selects a sub-bucket of a
+        striped hot key for the request windows and token bucket, quotas and the shared pool stay per app/model
+        lap (e.g. RequestHelper._lap) is called with the name of each round trip as it ends:
+        "outside_charge", "script" and, when a denial gives the outside charges back, "refund"
+        Returns a decision dict: allowed, message, remaining, reset_at, available_tokens, burst_tokens_used,
+        burst_window_start (the bucket fields are None when the token bucket wasn't evaluated)
+        """
+        if now is None:
+            now = time.time()
+        if lap is None:
+            lap = _no_lap
+
+        args = [now, requested_tokens or 0, 1 if dry_run else 0]
+        shadows = []
+        outside = []
+        if requested_tokens is None or not token_bucket:
+            requested_tokens = None
+            args += ["", "", "", ""]
+        else:
+            limits = _with_defaults(limits)
+            args += [limits["max_tokens"], limits["refill_rate"], limits["burst_capacity"], limits["burst_window"]]
+            shadows = limits.get("shadow") or []
+            outside = self._outside_calls(app_id, model_id, requested_tokens, limits, now)
+
+        windows = [as_window(window) for window in windows]
+        args.append(len(windows))
+        for limit, seconds, unit in windows:
+            args += [limit, seconds, *window_fields(seconds, unit), unit]
+
+        args.append(len(shadows))
+        for policy in shadows:
+            args += [policy["max_tokens"], policy["refill_rate"], policy["burst_capacity"], policy["burst_window"]]
+        args.append((limits.get("burst_decay") or "") if requested_tokens is not None else "")
+
+        bucket_id = model_id + stripe if stripe else model_id
+        keys = [api_rate_key(app_id, bucket_id), dynamic_key(app_id, bucket_id)]
+        keys += [shadow_key(policy["name"], app_id, bucket_id) for policy in shadows]
+
+        denial = self._charge_outside(outside, "check" if dry_run else "charge")
+        lap("outside_charge")
+        if denial is None:
+            try:
+                result = self._script(keys=keys, args=args)
+            except Exception:
+                # Nothing was decided, so the quotas and shared pool get their charge back
+                if not dry_run:
+                    self._refund_outside(outside)
+                raise
+            lap("script")
+            allowed, reason, denied_window, remaining, reset_at, available, burst_used = result[:7]
+            reason = reason.decode() if isinstance(reason, bytes) else reason
+            burst_start = result[8] if len(result) > 8 else None
+            if not allowed and not dry_run and outside:
+                self._refund_outside(outside)
+                lap("refund")
+        else:
+            reason, denied_window = denial
+            allowed, remaining, reset_at = 0, -1, None
+            available = burst_used = burst_start = None
+            # Shadow policies are still evaluated (without charging) on a quota or shared pool denial
+            result = self._script(keys=keys, args=[args[0], args[1], 1, *args[3:]]) if shadows else []
+            lap("script")
+        shadow_outcomes = {
+            policy["name"]: outcome.decode() if isinstance(outcome, bytes) else outcome
+            for policy, outcome in zip(shadows, result[7] if len(result) > 7 else [])
+        }
+
+        if reason == "window":
+            message = window_message(windows[denied_window - 1])
+        elif reason == "quota":
+            message = quota_message(limits, denied_window)
+        else:
+            message = TOKEN_MESSAGES[reason]
+
+        if self.metrics is not None and not dry_run:
+            # One series per pair is unbounded over millions of keys, so pair labels are opt-in
+            pair = {"app_id": app_id, "model_id": model_id} if self.metrics.per_pair_labels else {}
+            self.metrics.inc("rate_limit_decisions_total", outcome="allowed" if allowed else "denied",
+                             reason=reason, **pair)
+            for name, outcome in shadow_outcomes.items():
+                self.metrics.inc("rate_limit_shadow_decisions_total", policy=name,
+                                 outcome="denied" if outcome == "exceeded" else "allowed", reason=outcome,
+                                 enforced="allowed" if allowed else "denied", **pair)
+
+        reset_at = _float_or_none(reset_at)
+        return {
+            "allowed": bool(allowed),
+            "message": message,
+            "remaining": remaining if remaining >= 0 else None,
+            "reset_at": reset_at if reset_at is not None and reset_at >= 0 else None,
+            "available_tokens": _float_or_none(available),
+            "burst_tokens_used": _float_or_none(burst_used),
+            "burst_window_start": _float_or_none(burst_start),
+            "shadow": shadow_outcomes
+        }
+
+    def refund(self, app_id, model_id, requested_tokens, decision, limits=None, windows=(), now=None,
+               token_bucket=True):
+        """
+        Give back what an allowed check() with the same arguments charged (now is the check's now),
+        for a request denied by a limit checked after it: request/token windows, token bucket (or
+        burst usage), quotas and shared pool. Shadow policies keep the charge, they only observe
+        """
+        token_bucket = token_bucket and requested_tokens is not None
+        args = [now, requested_tokens or 0, "", ""]
+        if token_bucket:
+            limits = _with_defaults(limits)
+            args[2:] = [limits["max_tokens"], "1" if decision["message"] == TOKEN_MESSAGES["burst"] else ""]
+        windows = [as_window(window) for window in windows]
+        args.append(len(windows))
+        for _, seconds, unit in windows:
+            args += [*window_fields(seconds, unit), unit]
+        self._refund_script(keys=[api_rate_key(app_id, model_id), dynamic_key(app_id, model_id)], args=args)
+        if token_bucket:
+            self._refund_outside(self._outside_calls(app_id, model_id, requested_tokens, limits, now))
+
+    def charge_app_and_model(self, app_id, model_id, tokens, limits=None, now=None, mode="charge"):
+        """
+        Only the app's quotas and the model's shared pool, for `tokens` (StripedTokenBucket takes
+        them in leases of several requests); mode is "check", "charge" or "refund"
+        Returns None if allowed, otherwise the denial message
+        """
+        if now is None:
+            now = time.time()
+        limits = _with_defaults(limits)
+        calls = self._outside_calls(app_id, model_id, tokens, limits, now)
+        if mode == "refund":
+            self._refund_outside(calls)
+            return None
+        denial = self._charge_outside(calls, mode)
+        if denial is None:
+            return None
+        reason, index = denial
+        return quota_message(limits, index) if reason == "quota" else TOKEN_MESSAGES[reason]
+
+    def _outside_calls(self, app_id, model_id, requested_tokens, limits, now):
+        """
+        (denial reason, script, keys, args after the mode) for the app's quotas and the model's shared pool
+        """
+        calls = []
+        quotas = configured_quotas(limits)
+        if quotas:
+            charge = quota_charge(requested_tokens, limits["quotas"], limits.get("cost_per_1k_tokens"))
+            args = [charge, len(quotas)]
+            for limit, period in quotas:
+                args += [limit, period, quota_period_id(period, now)]
+            calls.append(("quota", self._quota_script, [quota_key(app_id)], args))
+
+        shared = limits.get("shared_capacity")
+        if shared:
+            args = [now, requested_tokens, shared["max_tokens"], shared.get("refill_rate", 0), limits.get("shed_below", 0)]
+            calls.append(("priority", self._shared_script, [shared_key(model_id)], args))
+        return calls
+
+    def _charge_outside(self, calls, mode):
+        """
+        Run the quota / shared pool scripts in one pipeline ("check" or "charge"); if one denies or
+        fails, whatever the others charged is given back (and a failure is raised)
+        Returns None, or (reason, index of the denying quota)
+        """
+        if not calls:
+            return None
+        pipe = self.redis_client.pipeline(transaction=False)
+        for _, script, keys, args in calls:
+            script(keys=keys, args=[mode, *args], client=pipe)
+        results = pipe.execute(raise_on_error=False)
+
+        errors = [result for result in results if isinstance(result, Exception)]
+        if errors:
+            if mode == "charge":
+                self._refund_outside([call for call, result in zip(calls, results)
+                                      if not isinstance(result, Exception) and int(result[0])])
+            raise errors[0]
+
+        denied = [_outside_denial(reason, args, result)
+                  for (reason, _, _, args), result in zip(calls, results) if not int(result[0])]
+        if not denied:
+            return None
+        if mode == "charge":
+            self._refund_outside([call for call, result in zip(calls, results) if int(result[0])])
+        return denied[0]
+
+    def _refund_outside(self, calls):
+        if not calls:
+            return
+        pipe = self.redis_client.pipeline(transaction=False)
+        for _, script, keys, args in calls:
+            script(keys=keys, args=["refund", *args], client=pipe)
+        pipe.execute()
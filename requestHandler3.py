@@ -1,7 +1,16 @@
 import time
 import json
+import hashlib
 from urllib.parse import unquote
+import redis
+from fastapi import FastAPI, HTTPException, Request
 from utils.llm_proxy_service import ROUTE_PREFIX
+from config_compiler import LazyRedis, load_compiled_source
+from policy_spec import limits_string
+
+# Hash of every config version whose Redis state was initialized (sha256 -> time), kept without a
+# TTL like config_apply.APPLIED_CONFIG_KEY, so no later worker start resets the buckets again
+INITIALIZED_CONFIG_KEY = "ratelimit_initialized"
 
 class RequestHelper:
     def __init__(self, redis_client):
@@ -13,6 +22,26 @@ class RequestHelper:
         self.app_id = None
         self.model_id = None
 
+        # Compiled RATE_LIMITS_DYNAMIC_INIT (see config_compiler), set by load_config
+        self.config_raw = None
+        self.slots = {}
+        self.limits = []
+        self.initial_states = []
+
+    def load_config(self):
+        """
+        Load the compiled RATE_LIMITS_DYNAMIC_INIT: the first worker compiles it and writes the
+        artifact, every other worker just loads the artifact
+        Called per request (see find_model_config); unchanged config is a string compare
+        """
+        try:
+            raw = get_iconfig().configurations["RATE_LIMITS_DYNAMIC_INIT"]
+            if raw != self.config_raw:
+                self.slots, self.limits, self.initial_states = load_compiled_source(raw)
+                self.config_raw = raw
+        except Exception as e:
+            amt_logger.logger.error(f"Failed to load dynamic rate limit config: {str(e)}")
+
     def data_extraction_from_request(self, request):
         """
         Extract app_id, model_id and other data from request
@@ -65,31 +94,24 @@ class RequestHelper:
 
     def find_model_config(self):
         """
-        Find model configuration for current app_id + model_id
-        [KEEP YOUR EXISTING LOGIC]
+        Find the compiled limits and initial state for current app_id + model_id
+        Returns (limits, initial_state), or None when the pair isn't configured
         """
-        dynamic_ratelimit_config = json.loads(get_iconfig().configurations["RATE_LIMITS_DYNAMIC_INIT"])
-        
-        for app in dynamic_ratelimit_config["apps"]:
-            if app["application-id"] == self.app_id:
-                for model in app["models"]:
-                    if model["model_id"] == self.model_id:
-                        return model
-        return None
+        self.load_config()
+        slot = self.slots.get((self.app_id, self.model_id))
+        if slot is None:
+            return None
+        return self.limits[slot], self.initial_states[slot]
 
     def get_rate_limiting_string(self):
         """
         Get rate limiting configuration string
         [KEEP YOUR EXISTING LOGIC]
         """
-        dynamic_ratelimit_config = json.loads(get_iconfig().configurations["RATE_LIMITS_DYNAMIC_INIT"])
-        
-        for app in dynamic_ratelimit_config["apps"]:
-            if app["application-id"] == self.app_id:
-                for model in app["models"]:
-                    if model["model_id"] == self.model_id:
-                        rpm = model["rate_limit"]["rpm"]
-                        return f"{rpm}/minute"
+        model_config = self.find_model_config()
+        if model_config:
+            # Every request window, e.g. "10/second;500/minute"
+            return limits_string(model_config[0]["windows"])
         return "Rate limit not configured"
 
     def _get_redis_state(self):
@@ -114,7 +136,7 @@ class RequestHelper:
             # Initialize with default values from config
             model_config = self.find_model_config()
             if model_config:
-                max_tokens = model_config["rate_limit"].get("available_tokens", 100)
+                max_tokens = model_config[1]["available_tokens"]
                 return {
                     "available_tokens": float(max_tokens),
                     "last_refill_ts": float(time.time()),
@@ -147,13 +169,12 @@ class RequestHelper:
             raise HTTPException(404, "Config not found")
 
         # Get configuration values
-        rate_limit = model_config["rate_limit"]
-        burst_config = model_config.get("burst", {})
+        limits, initial_state = model_config
         
-        max_tokens = rate_limit.get("available_tokens", 100)
-        refill_rate = rate_limit.get("rpm", 60) / 60.0  # Convert RPM to tokens per second
-        burst_capacity = burst_config.get("capacity", 0)
-        burst_window = burst_config.get("window", 60)
+        max_tokens = initial_state["available_tokens"]
+        refill_rate = (limits["rpm"] or 60) / 60.0  # Convert RPM to tokens per second
+        burst_capacity = limits["burst_capacity"]
+        burst_window = limits["burst_window"]
 
         now = time.time()
         state = self._get_redis_state()
@@ -194,33 +215,28 @@ class RequestHelper:
     def init_redis_dynamic_state(self):
         """
         ENHANCED: Initialize Redis state for all app_id + model_id combinations
-        Uses your existing config structure
+        Uses the compiled config from load_config; only the first worker to start with a
+        config version does it, the others would reset the buckets it has already handed out
         """
-        try:
-            dynamic_ratelimit_config = json.loads(get_iconfig().configurations["RATE_LIMITS_DYNAMIC_INIT"])
-        except Exception as e:
-            amt_logger.logger.error(f"Failed to load dynamic rate limit config: {str(e)}")
+        if self.config_raw is None:
+            return
+        config_hash = hashlib.sha256(self.config_raw.encode()).hexdigest()
+        if not self.redis_client.hsetnx(INITIALIZED_CONFIG_KEY, config_hash, time.time()):
             return
 
-        for app in dynamic_ratelimit_config["apps"]:
-            app_id = app["application-id"]
-            for model in app["models"]:
-                model_id = model["model_id"] 
-                burst = model.get("burst", {})
-                rate = model.get("rate_limit", {})
-                
-                # Create initial state for this app_id + model_id combination
-                initial_state = {
-                    "available_tokens": rate.get("available_tokens", 100),
-                    "last_refill_ts": time.time(),
-                    "burst_tokens_used": 0,
-                    "burst_window_start": time.time()
-                }
-                
-                # Store in Redis with app_id:model_id key
-                redis_key = f"ratelimit:{app_id}:{model_id}"
-                self.redis_client.set(redis_key, json.dumps(initial_state))
-                print(f"Initialized Redis state: {redis_key} -> {initial_state}")
+        for (app_id, model_id), slot in self.slots.items():
+            # Create initial state for this app_id + model_id combination
+            initial_state = {
+                "available_tokens": self.initial_states[slot]["available_tokens"],
+                "last_refill_ts": time.time(),
+                "burst_tokens_used": 0,
+                "burst_window_start": time.time()
+            }
+            
+            # Store in Redis with app_id:model_id key
+            redis_key = f"ratelimit:{app_id}:{model_id}"
+            self.redis_client.set(redis_key, json.dumps(initial_state))
+            print(f"Initialized Redis state: {redis_key} -> {initial_state}")
 
     def update_dynamic_token_state(self, tokens_requested):
         """
@@ -232,12 +248,18 @@ class RequestHelper:
 
 # HOW TO USE THIS CLASS:
 
-# 1. Initialize once (usually in your main application startup)
-redis_client = redis.Redis(host='localhost', port=6379, db=0)  # Your Redis client
+# 1. Initialize once; the Redis connection is only made on first use, so importing is free
+app = FastAPI()
+redis_client = LazyRedis(lambda: redis.Redis(host='localhost', port=6379, db=0))  # Your Redis client
 request_helper = RequestHelper(redis_client)
 
-# 2. Initialize Redis state on startup (call once)
-request_helper.init_redis_dynamic_state()
+# 2. From a startup hook, not at import time: every worker loads the compiled config,
+#    and the first one to start with a config version also initializes the Redis state;
+#    config changes after startup are picked up per request (find_model_config)
+@app.on_event("startup")
+def init_rate_limit_state():
+    request_helper.load_config()
+    request_helper.init_redis_dynamic_state()
 
 # 3. For each incoming request, use like this:
 def handle_request(request, tokens_needed=1):
@@ -0,0 +1,201 @@
+import asyncio
+import time
+
+from redis_token_bucket import (
+    DEFAULT_LIMITS, TOKEN_MESSAGES, RedisTokenBucket, api_rate_key, as_window, dynamic_key, window_fields,
+    window_message
+)
+
+# TOKEN_BUCKET_LUA for a batch of requests on one key: each is decided in arrival order against
+# the state the previous ones left, and the state is read and written once for the whole batch
+#
+# KEYS[1] api_rate:{app_id:model_id}
+# KEYS[2] dynamic:{app_id:model_id}
+# ARGV    now, max_tokens, refill_rate, burst_capacity, burst_window, window_count,
+#         per window: limit, seconds, count field, start field, unit, then request count and
+#         the requested tokens of every request
+# Returns per request: allowed, reason, denied window, remaining requests, available, burst used
+BATCH_TOKEN_BUCKET_LUA = """
+local now = tonumber(ARGV[1])
+local max_tokens = tonumber(ARGV[2])
+local refill_rate = tonumber(ARGV[3])
+local burst_capacity = tonumber(ARGV[4])
+local burst_window = tonumber(ARGV[5])
+local window_count = tonumber(ARGV[6])
+
+local limits = {}
+local counts = {}
+local starts = {}
+local per_token = {}
+for i = 1, window_count do
+    local base = 6 + (i - 1) * 5
+    limits[i] = tonumber(ARGV[base + 1])
+    per_token[i] = ARGV[base + 5] == 'tokens'
+    local seconds = tonumber(ARGV[base + 2])
+    local state = redis.call('HMGET', KEYS[1], ARGV[base + 3], ARGV[base + 4])
+    counts[i] = tonumber(state[1]) or 0
+    starts[i] = tonumber(state[2]) or now
+    if now - starts[i] >= seconds then
+        starts[i] = now
+        counts[i] = 0
+    end
+end
+
+local bucket = redis.call('HMGET', KEYS[2],
+    'available_tokens', 'last_refill_ts', 'burst_tokens_used', 'burst_window_start')
+local available = tonumber(bucket[1]) or max_tokens
+local last_refill = tonumber(bucket[2]) or now
+local burst_used = tonumber(bucket[3]) or 0
+local burst_start = tonumber(bucket[4]) or now
+available = math.min(max_tokens, available + (now - last_refill) * refill_rate)
+if now - burst_start > burst_window then
+    burst_start = now
+    burst_used = 0
+end
+
+local request_base = 7 + window_count * 5
+local results = {}
+for r = 1, tonumber(ARGV[request_base]) do
+    local requested = tonumber(ARGV[request_base + r])
+    local allowed = 1
+    local reason = 'exceeded'
+    local denied_window = 0
+    local costs = {}
+    for i = 1, window_count do
+        costs[i] = per_token[i] and requested or 1
+        if counts[i] + costs[i] > limits[i] then
+            allowed = 0
+            reason = 'window'
+            denied_window = i
+            break
+        end
+    end
+    if allowed == 1 then
+        if requested <= available then
+            available = available - requested
+            reason = 'token'
+        elseif burst_used + requested <= burst_capacity then
+            burst_used = burst_used + requested
+            reason = 'burst'
+        else
+            allowed = 0
+        end
+    end
+    local remaining = -1
+    if allowed == 1 then
+        for i = 1, window_count do
+            counts[i] = counts[i] + costs[i]
+            if not per_token[i] and (remaining < 0 or limits[i] - counts[i] < remaining) then
+                remaining = limits[i] - counts[i]
+            end
+        end
+    end
+    for _, value in ipairs({allowed, reason, denied_window, remaining, tostring(available), tostring(burst_used)}) do
+        table.insert(results, value)
+    end
+end
+
+redis.call('HSET', KEYS[2],
+    'available_tokens', tostring(available), 'last_refill_ts', tostring(now),
+    'burst_tokens_used', tostring(burst_used), 'burst_window_start', tostring(burst_start))
+for i = 1, window_count do
+    local base = 6 + (i - 1) * 5
+    redis.call('HSET', KEYS[1], ARGV[base + 3], tostring(counts[i]), ARGV[base + 4], tostring(starts[i]))
+end
+return results
+"""
+
+RESULT_WIDTH = 6
+
+
+class RequestCoalescer:
+    def __init__(self, redis_client, window=0.0005, max_batch=256):
+        """
+        Opt-in micro-batching of concurrent checks on the same (app_id, model_id) in one worker
+        The first check for a key opens a batch; checks arriving within `window` seconds join it,
+        and the batch is decided by one atomic script call in arrival order, so N concurrent
+        requests cost one Redis round trip instead of N. A batch is sent early at max_batch.
+        Requests whose limits carry quotas, a shared model pool, a decaying burst or shadow policies
+        go through RedisTokenBucket one by one, since the batch script only covers the windows and
+        the token bucket with window burst resets
+        """
+        self.window = window
+        self.max_batch = max_batch
+        self.engine = RedisTokenBucket(redis_client)
+        self._script = redis_client.register_script(BATCH_TOKEN_BUCKET_LUA)
+        self._pending = {}
+        self.batches = 0
+        self.checks = 0
+
+    async def check(self, app_id, model_id, requested_tokens, limits=None, windows=()):
+        """
+        Same decision dict as RedisTokenBucket.check (reset_at is not reported for batched checks)
+        limits and windows must be the same for every check on a key, as they are when they come from config
+        """
+        limits = {**DEFAULT_LIMITS, **{k: v for k, v in (limits or {}).items() if v is not None}}
+        if limits.get("quotas") or limits.get("shared_capacity") or limits.get("burst_decay") or limits.get("shadow"):
+            return await asyncio.to_thread(self.engine.check, app_id, model_id, requested_tokens, limits, windows)
+
+        key = (app_id, model_id)
+        future = asyncio.get_running_loop().create_future()
+        batch = self._pending.get(key)
+        if batch is None:
+            batch = self._pending[key] = {"limits": limits, "windows": [as_window(w) for w in windows], "requests": []}
+            asyncio.get_running_loop().call_later(self.window, self._send, key, batch)
+        batch["requests"].append((requested_tokens, future))
+        if len(batch["requests"]) >= self.max_batch:
+            self._send(key, batch)
+        return await future
+
+    def _send(self, key, batch):
+        # The timer can fire for a batch that already went out at max_batch
+        if self._pending.get(key) is not batch:
+            return
+        del self._pending[key]
+        asyncio.get_running_loop().create_task(self._run(key, batch))
+
+    async def _run(self, key, batch):
+        requests = batch["requests"]
+        try:
+            results = await asyncio.to_thread(self._decide, key, batch["limits"], batch["windows"], requests)
+        except Exception as e:
+            for _, future in requests:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(requests, results):
+            if not future.done():
+                future.set_result(result)
+
+    def _decide(self, key, limits, windows, requests, now=None):
+        if now is None:
+            now = time.time()
+        app_id, model_id = key
+        args = [now, limits["max_tokens"], limits["refill_rate"], limits["burst_capacity"],
+                limits["burst_window"], len(windows)]
+        for limit, seconds, unit in windows:
+            args += [limit, seconds, *window_fields(seconds, unit), unit]
+        args.append(len(requests))
+        args += [requested_tokens for requested_tokens, _ in requests]
+
+        flat = self._script(keys=[api_rate_key(app_id, model_id), dynamic_key(app_id, model_id)], args=args)
+        self.batches += 1
+        self.checks += len(requests)
+
+        decisions = []
+        for i in range(0, len(flat), RESULT_WIDTH):
+            allowed, reason, denied_window, remaining, available, burst_used = flat[i:i + RESULT_WIDTH]
+            reason = reason.decode() if isinstance(reason, bytes) else reason
+            if reason == "window":
+                message = window_message(windows[denied_window - 1])
+            else:
+                message = TOKEN_MESSAGES[reason]
+            decisions.append({
+                "allowed": bool(allowed),
+                "message": message,
+                "remaining": remaining if remaining >= 0 else None,
+                "reset_at": None,
+                "available_tokens": float(available),
+                "burst_tokens_used": float(burst_used)
+            })
+        return decisions
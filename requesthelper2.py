@@ -1,8 +1,24 @@
 import time
 import json
 import re
+import contextvars
+import functools
 from urllib.parse import unquote
 from utils.llm_proxy_service import ROUTE_PREFIX
+from negative_cache import NegativeDecisionCache
+from gcra import GcraLimiter
+from concurrency_limiter import ConcurrencyLimiter
+from reservation import CapacityReservations
+from config_apply import rollout_config, save_applied_config
+from policy_spec import limits_string, windows_from_rate_limit
+from redis_token_bucket import RedisTokenBucket, api_rate_key, dynamic_key, window_fields
+from token_bucket import BURST_DECAY_MODES, DEFAULT_BURST_CAPACITY, DEFAULT_PRIORITY_CLASSES, shadow_limits
+
+# Start of the current profiled stage; per thread / asyncio task, so concurrent decisions don't mix timings
+_lap_started_ns = contextvars.ContextVar("lap_started_ns", default=None)
+
+# Refunds for what the current decision has charged so far, run if a later limit denies it
+_app_charges = contextvars.ContextVar("app_charges", default=None)
 
 class RequestHelper:
     def __init__(self):
@@ -13,29 +29,67 @@ class RequestHelper:
         """
         self.app_id = None
         self.model_id = None
+        self.provider = None
         
         # Token-based rate limiting config (from RATE_LIMITS_DYNAMIC_INIT)
         self.max_tokens = None
         self.refill_rate = None
         self.burst_capacity = None
         self.burst_window = None
+        self.burst_decay = None
+        self.algorithm = None
+        self.token_limits = None
         self.dynamic_config = None
+        self._dynamic_config_raw = None
+        self.gcra_limiter = None
+        self.concurrency_limiter = None
+        self.capacity_reservations = None
         
         # API rate limiting config (from RATE_LIMITS) 
         self.api_rate_config = None
         self.requests_per_minute = None
         self.requests_per_second = None
+        self.rate_windows = None
+        self.api_rate_limiter = None
+
+        # Recent token-limit denials, so throttled apps are rejected without a Redis round trip
+        self.negative_cache = NegativeDecisionCache()
+
+        # Set to a DecisionTracer to sample token-limit decisions (None = tracing off)
+        self.tracer = None
+
+        # Set to a LimiterMetrics to count decisions and shadow policy outcomes (None = off)
+        self.metrics = None
+
+        # Set to an AdaptiveProviderLimits to hold each provider model to its AIMD-adapted limits
+        # across all apps; feed it with on_provider_response (None = off)
+        self.provider_limits = None
+
+        # Set to a StageProfiler to time allow_request stage by stage (None = off)
+        self.profiler = None
 
     def _load_dynamic_rate_limit_config(self):
         """
         Load dynamic/token-based rate limiting configuration from RATE_LIMITS_DYNAMIC_INIT
+        Called on every lookup: the config is only parsed again when the iConfig value changed,
+        so a change rolled out by another worker reaches this one too
         """
         try:
-            self.dynamic_config = json.loads(get_iconfig().configurations["RATE_LIMITS_DYNAMIC_INIT"])
+            raw_config = get_iconfig().configurations["RATE_LIMITS_DYNAMIC_INIT"]
+            if self.dynamic_config and raw_config == self._dynamic_config_raw:
+                return
+            self.dynamic_config = json.loads(raw_config)
+            self._dynamic_config_raw = raw_config
         except Exception as e:
             amt_logger.logger.error(f"Failed to load dynamic rate limits config: {str(e)}")
+            if self.dynamic_config:
+                # Keep enforcing the last good config
+                return
             self.dynamic_config = {"apps": []}
 
+        # Cached retry times were computed from the old limits
+        self.negative_cache.invalidate()
+
     def _load_api_rate_limit_config(self):
         """
         Load fixed API rate limiting configuration from RATE_LIMITS
@@ -50,8 +104,7 @@ class RequestHelper:
         """
         Get dynamic/token-based configuration for current app_id and model_id
         """
-        if not self.dynamic_config:
-            self._load_dynamic_rate_limit_config()
+        self._load_dynamic_rate_limit_config()
             
         for app in self.dynamic_config["apps"]:
             if app["application-id"] == self.app_id:
@@ -63,18 +116,59 @@ class RequestHelper:
                         
                         self.max_tokens = rate_limit.get("max_tokens", 1000)
                         self.refill_rate = rate_limit.get("refill_rate", 10)
-                        self.burst_capacity = burst.get("capacity", 100)
+                        self.burst_capacity = burst.get("capacity", DEFAULT_BURST_CAPACITY)
                         self.burst_window = burst.get("window", 60)
+                        self.burst_decay = burst.get("decay")
+                        if self.burst_decay not in BURST_DECAY_MODES:
+                            amt_logger.logger.error(
+                                f"Unknown burst decay {self.burst_decay!r} for {self.app_id}:{self.model_id}, "
+                                f"using window resets"
+                            )
+                            self.burst_decay = None
+                        self.algorithm = rate_limit.get("algorithm", "token_bucket")
+                        self.token_limits = self._token_limits(app, model)
                         
                         return model
         
         # Default values if not found in dynamic config
         self.max_tokens = 1000
         self.refill_rate = 10
-        self.burst_capacity = 100
+        self.burst_capacity = DEFAULT_BURST_CAPACITY
         self.burst_window = 60
+        self.burst_decay = None
+        self.algorithm = "token_bucket"
+        self.token_limits = self._token_limits({}, {})
         return None
 
+    def _token_limits(self, app, model):
+        """
+        Limits of the current app_id + model_id in RedisTokenBucket.check form, with the app's
+        hour/day/month "quotas" and the model's cost_per_1k_tokens weight in them, the model's
+        "shared_capacity" pool with the shed_below of the app's priority class, and the model's
+        "shadow" policies
+        """
+        rate_limit = model.get("rate_limit", {})
+        priority_classes = {**DEFAULT_PRIORITY_CLASSES, **self.dynamic_config.get("priority_classes", {})}
+        priority = app.get("priority", "standard")
+        if priority not in priority_classes:
+            amt_logger.logger.error(
+                f"Unknown priority {priority!r} for {self.app_id}, using standard"
+            )
+            priority = "standard"
+        limits = {
+            "max_tokens": self.max_tokens,
+            "refill_rate": self.refill_rate,
+            "burst_capacity": self.burst_capacity,
+            "burst_window": self.burst_window,
+            "burst_decay": self.burst_decay,
+            "quotas": app.get("quotas"),
+            "cost_per_1k_tokens": rate_limit.get("cost_per_1k_tokens"),
+            "shared_capacity": self.dynamic_config.get("shared_capacity", {}).get(self.model_id),
+            "shed_below": priority_classes[priority].get("shed_below", 0)
+        }
+        limits["shadow"] = [shadow_limits(policy, limits) for policy in model.get("shadow", [])]
+        return limits
+
     def _get_api_rate_config_for_app_model(self):
         """
         Get fixed API rate limiting configuration for current app_id and model_id
@@ -91,19 +185,31 @@ class RequestHelper:
                         
                         self.requests_per_minute = rate_limit.get("rpm", 60)
                         self.requests_per_second = rate_limit.get("rps", 1)
+                        self.rate_windows = self._rate_windows(rate_limit)
                         
                         return model
         
         # Default values if not found in API config
         self.requests_per_minute = 60
         self.requests_per_second = 1
+        self.rate_windows = windows_from_rate_limit({}, rpm=60, rps=1)
         return None
 
+    def _rate_windows(self, rate_limit):
+        """
+        Request/token windows of a model: "windows" (e.g. ["10/s", "500/min", "2M tokens/day"]) or rpm/rps
+        """
+        try:
+            return windows_from_rate_limit(rate_limit, rpm=60, rps=1)
+        except ValueError as e:
+            amt_logger.logger.error(f"Invalid rate limit windows for {self.app_id}:{self.model_id}: {str(e)}")
+            return windows_from_rate_limit({k: v for k, v in rate_limit.items() if k != "windows"}, rpm=60, rps=1)
+
     def _get_dynamic_state(self):
         """
         Get current dynamic/token-based state for app_id + model_id combination
         """
-        key = f"dynamic:{self.app_id}:{self.model_id}"
+        key = dynamic_key(self.app_id, self.model_id)
         
         try:
             state_data = redis_client.hmget(key, [
@@ -139,7 +245,7 @@ class RequestHelper:
         """
         Save dynamic/token-based state for app_id + model_id combination
         """
-        key = f"dynamic:{self.app_id}:{self.model_id}"
+        key = dynamic_key(self.app_id, self.model_id)
         try:
             redis_client.hset(key, {
                 "available_tokens": state["available_tokens"],
@@ -150,146 +256,377 @@ class RequestHelper:
         except Exception as e:
             amt_logger.logger.error(f"Failed to save dynamic state for {key}: {str(e)}")
 
-    def _get_api_rate_state(self):
+    def check_token_based_rate_limit(self, request, requested_tokens):
         """
-        Get current API rate limiting state for app_id + model_id combination
+        Check token-based rate limiting (uses RATE_LIMITS_DYNAMIC_INIT config) together with the
+        request/token windows of RATE_LIMITS and the app's quotas in one RedisTokenBucket.check,
+        so the token windows and quotas are only charged when the token bucket lets the request through too
         """
-        key = f"api_rate:{self.app_id}:{self.model_id}"
-        
+        # Load both configs for this app_id + model_id
+        self._get_api_rate_config_for_app_model()
+        self._get_dynamic_config_for_app_model()
+        self._lap("config")
+
+        # GCRA mode keeps one timestamp per key instead of the four token bucket fields
+        if self.algorithm == "gcra":
+            return self.check_gcra_rate_limit(requested_tokens)
+
+        trace_start = self.tracer.start() if self.tracer is not None else None
+        before = self._get_dynamic_state() if trace_start is not None else None
+
+        if self.api_rate_limiter is None:
+            self.api_rate_limiter = RedisTokenBucket(redis_client, metrics=self.metrics)
+        now = time.time()
         try:
-            state_data = redis_client.hmget(key, [
-                "requests_this_minute", "minute_window_start",
-                "requests_this_second", "second_window_start"
-            ])
-            
-            now = time.time()
-            return {
-                "requests_this_minute": int(state_data[0] or 0),
-                "minute_window_start": float(state_data[1] or now),
-                "requests_this_second": int(state_data[2] or 0),
-                "second_window_start": float(state_data[3] or now)
-            }
+            decision = self.api_rate_limiter.check(
+                self.app_id, self.model_id, requested_tokens, self.token_limits, windows=self.rate_windows, now=now,
+                lap=self._lap if self.profiler is not None else None
+            )
         except Exception as e:
-            amt_logger.logger.error(f"Failed to get API rate state: {str(e)}")
-            now = time.time()
-            return {
-                "requests_this_minute": 0,
-                "minute_window_start": now,
-                "requests_this_second": 0,
-                "second_window_start": now
+            amt_logger.logger.error(f"Failed token rate check for {self.app_id}:{self.model_id}: {str(e)}")
+            return True, "Allowed via token quota"
+        finally:
+            # Its round trips are laps of their own (outside_charge, script, refund), "check" is the rest
+            self._lap("check")
+        allowed, message = decision["allowed"], decision["message"]
+
+        # Bucket fields are only reported when the token bucket itself was evaluated
+        state = None
+        if decision["available_tokens"] is not None:
+            state = {
+                "available_tokens": decision["available_tokens"],
+                "last_refill_ts": now,
+                "burst_tokens_used": decision["burst_tokens_used"],
+                "burst_window_start": decision["burst_window_start"]
             }
+        if allowed:
+            self._record_charge(
+                self.api_rate_limiter.refund, self.app_id, self.model_id, requested_tokens, decision,
+                self.token_limits, windows=self.rate_windows, now=now
+            )
 
-    def _save_api_rate_state(self, state):
+        # Pairs under shadow policies aren't cached, so the shadows see every request
+        if not allowed and state is not None and not self.token_limits["shadow"]:
+            self.negative_cache.add(
+                self.app_id, self.model_id, requested_tokens, state,
+                self.max_tokens, self.refill_rate, self.burst_capacity, self.burst_window, self.burst_decay
+            )
+
+        if trace_start is not None:
+            self.tracer.record(
+                dynamic_key(self.app_id, self.model_id), requested_tokens,
+                before, state or before, allowed, message, trace_start
+            )
+        return allowed, message
+
+    def check_gcra_rate_limit(self, requested_tokens):
         """
-        Save API rate limiting state for app_id + model_id combination
+        Check token-based rate limiting in GCRA mode (rate_limit.algorithm = "gcra")
+        The request/token windows are checked first and only charged once GCRA allows; the app's
+        quotas are charged before GCRA and given back if it denies
         """
-        key = f"api_rate:{self.app_id}:{self.model_id}"
+        window_allowed, window_message = self.check_api_rate_limit(None, requested_tokens, dry_run=True)
+        if not window_allowed:
+            return False, window_message
+
+        if self.api_rate_limiter is None:
+            self.api_rate_limiter = RedisTokenBucket(redis_client, metrics=self.metrics)
+        if self.gcra_limiter is None:
+            self.gcra_limiter = GcraLimiter(redis_client)
+
+        now = time.time()
         try:
-            redis_client.hset(key, {
-                "requests_this_minute": state["requests_this_minute"],
-                "minute_window_start": state["minute_window_start"],
-                "requests_this_second": state["requests_this_second"],
-                "second_window_start": state["second_window_start"]
-            })
+            quota_message = self.api_rate_limiter.charge_app_and_model(
+                self.app_id, self.model_id, requested_tokens, self.token_limits, now
+            )
+        except Exception as e:
+            amt_logger.logger.error(f"Failed quota check for {self.app_id}:{self.model_id}: {str(e)}")
+            quota_message = None
+        if quota_message is not None:
+            return False, quota_message
+
+        limits = {
+            "max_tokens": self.max_tokens,
+            "refill_rate": self.refill_rate,
+            "burst_capacity": self.burst_capacity
+        }
+        gcra_charged = False
+        try:
+            decision = self.gcra_limiter.check(self.app_id, self.model_id, requested_tokens, limits, now)
+            gcra_charged = decision["allowed"]
         except Exception as e:
-            amt_logger.logger.error(f"Failed to save API rate state for {key}: {str(e)}")
+            amt_logger.logger.error(f"Failed GCRA check for {self.app_id}:{self.model_id}: {str(e)}")
+            decision = {"allowed": True, "message": "Allowed via GCRA token quota"}
+        finally:
+            self._lap("gcra")
+
+        # A concurrent request can take the last window slot in between; the window decides then
+        if decision["allowed"]:
+            window_allowed, window_message = self.check_api_rate_limit(None, requested_tokens)
+            if window_allowed:
+                self._record_charge(
+                    self.api_rate_limiter.charge_app_and_model, self.app_id, self.model_id, requested_tokens,
+                    self.token_limits, now, mode="refund"
+                )
+                if gcra_charged:
+                    self._record_charge(self.gcra_limiter.refund, self.app_id, self.model_id, requested_tokens, limits)
+                return True, decision["message"]
+            decision = {"allowed": False, "message": window_message}
+            if gcra_charged:
+                self._refund_charge(functools.partial(
+                    self.gcra_limiter.refund, self.app_id, self.model_id, requested_tokens, limits
+                ))
+        self._refund_quotas(requested_tokens, now)
+        return False, decision["message"]
+
+    def _record_charge(self, refund, *args, **kwargs):
+        """
+        Remember how to give back a charge the current decision made (see _refund_app_charges)
+        """
+        charges = _app_charges.get()
+        if charges is not None:
+            charges.append(functools.partial(refund, *args, **kwargs))
 
-    def check_token_based_rate_limit(self, request, requested_tokens):
+    def _refund_charge(self, refund):
+        try:
+            refund()
+        except Exception as e:
+            amt_logger.logger.error(f"Failed to refund a charge for {self.app_id}:{self.model_id}: {str(e)}")
+
+    def _refund_app_charges(self):
         """
-        Check token-based rate limiting (uses RATE_LIMITS_DYNAMIC_INIT config)
+        Give back everything the app/model checks charged, for a request a later limit denied
         """
-        # Load dynamic config for this app_id + model_id
-        self._get_dynamic_config_for_app_model()
-        
-        now = time.time()
-        state = self._get_dynamic_state()
-
-        # Token bucket refill logic
-        elapsed = now - state["last_refill_ts"]
-        refill = elapsed * self.refill_rate
-        state["available_tokens"] = min(self.max_tokens, state["available_tokens"] + refill)
-        state["last_refill_ts"] = now
-
-        # Burst window reset logic
-        if now - state["burst_window_start"] > self.burst_window:
-            state["burst_window_start"] = now
-            state["burst_tokens_used"] = 0
-
-        # Decision logic for token-based limiting
-        if requested_tokens <= state["available_tokens"]:
-            state["available_tokens"] -= requested_tokens
-            self._save_dynamic_state(state)
-            return True, "Allowed via token quota"
-        elif state["burst_tokens_used"] + requested_tokens <= self.burst_capacity:
-            state["burst_tokens_used"] += requested_tokens
-            self._save_dynamic_state(state)
-            return True, "Allowed via token burst quota"
-        else:
-            self._save_dynamic_state(state)
-            return False, "Token limit exceeded"
+        for refund in _app_charges.get() or []:
+            self._refund_charge(refund)
 
-    def check_api_rate_limit(self, request):
+    def _refund_quotas(self, requested_tokens, now):
+        try:
+            self.api_rate_limiter.charge_app_and_model(
+                self.app_id, self.model_id, requested_tokens, self.token_limits, now, mode="refund"
+            )
+        except Exception as e:
+            amt_logger.logger.error(f"Failed to refund quotas for {self.app_id}:{self.model_id}: {str(e)}")
+
+    def check_api_rate_limit(self, request, requested_tokens=None, dry_run=False):
         """
         Check API rate limiting (uses RATE_LIMITS config)
+        Every configured window is checked and charged in one atomic Redis call; token windows
+        are charged requested_tokens (nothing when it's None). dry_run checks without charging
         """
         # Load API rate config for this app_id + model_id
         self._get_api_rate_config_for_app_model()
-        
+        self._lap("api_config")
+
+        if self.api_rate_limiter is None:
+            self.api_rate_limiter = RedisTokenBucket(redis_client, metrics=self.metrics)
         now = time.time()
-        state = self._get_api_rate_state()
-
-        # Reset minute window if needed
-        if now - state["minute_window_start"] >= 60:
-            state["minute_window_start"] = now
-            state["requests_this_minute"] = 0
-
-        # Reset second window if needed
-        if now - state["second_window_start"] >= 1:
-            state["second_window_start"] = now
-            state["requests_this_second"] = 0
-
-        # Check rate limits
-        if state["requests_this_minute"] >= self.requests_per_minute:
-            self._save_api_rate_state(state)
-            return False, f"API rate limit exceeded: {self.requests_per_minute} requests/minute"
-
-        if state["requests_this_second"] >= self.requests_per_second:
-            self._save_api_rate_state(state)
-            return False, f"API rate limit exceeded: {self.requests_per_second} requests/second"
-
-        # Increment counters
-        state["requests_this_minute"] += 1
-        state["requests_this_second"] += 1
-        self._save_api_rate_state(state)
-        
-        return True, "API rate limit passed"
+        try:
+            decision = self.api_rate_limiter.check(
+                self.app_id, self.model_id, requested_tokens, windows=self.rate_windows, now=now, dry_run=dry_run,
+                token_bucket=False
+            )
+        except Exception as e:
+            amt_logger.logger.error(f"Failed API rate check for {self.app_id}:{self.model_id}: {str(e)}")
+            return True, "API rate limit passed"
+        finally:
+            self._lap("api_rate")
+        if decision["allowed"] and not dry_run:
+            self._record_charge(
+                self.api_rate_limiter.refund, self.app_id, self.model_id, requested_tokens, decision,
+                windows=self.rate_windows, now=now, token_bucket=False
+            )
+        return decision["allowed"], decision["message"]
+
+    def get_rate_limiting_string(self):
+        """
+        Request windows of the current app_id + model_id in limits syntax, e.g. "10/second;500/minute"
+        """
+        self._get_api_rate_config_for_app_model()
+        return limits_string(self.rate_windows)
+
+    def _lap(self, stage):
+        """
+        End a profiled stage of allow_request (no-op unless a profiler is set)
+        """
+        started_ns = _lap_started_ns.get()
+        if started_ns is not None:
+            _lap_started_ns.set(self.profiler.lap(stage, started_ns))
 
     def allow_request(self, request, requested_tokens=None):
         """
         Main method: Check both token-based AND API rate limiting
+        With a profiler set, every stage is timed and a sampled subset runs under the profiler
         """
+        if self.profiler is None:
+            return self._allow_request(request, requested_tokens)
+
+        # Profiler overhead would skew the stage timings, so profiled decisions aren't timed
+        if self.profiler.should_profile():
+            return self.profiler.run_profiled(self._allow_request, request, requested_tokens)
+
+        started_ns = self.profiler.start()
+        token = _lap_started_ns.set(started_ns)
+        try:
+            return self._allow_request(request, requested_tokens)
+        finally:
+            _lap_started_ns.reset(token)
+            self.profiler.record("total", self.profiler.start() - started_ns)
+
+    def _allow_request(self, request, requested_tokens=None):
+        charges = _app_charges.set([])
+        try:
+            return self._decide(request, requested_tokens)
+        finally:
+            _app_charges.reset(charges)
+
+    def _decide(self, request, requested_tokens=None):
         # First extract app_id and model_id from request
         self.data_extraction_from_request(request)
+        self._lap("extract")
+
+        # Reservations whose job died without releasing go back to their buckets (every few seconds)
+        self._refund_expired_reservations()
+
+        # Denied recently and can't have recovered yet: reject locally, no Redis calls
+        denied = requested_tokens is not None and self.negative_cache.is_denied(self.app_id, self.model_id, requested_tokens)
+        self._lap("negative_cache")
+        if denied:
+            return False, "Token limit exceeded"
+
+        # Provider model already at its adapted limit: deny before charging the app's limits
+        provider_allowed, provider_message = self.check_provider_rate_limit(requested_tokens, dry_run=True)
+        if not provider_allowed:
+            return False, provider_message
         
-        # Check API rate limiting first (faster check)
-        api_allowed, api_message = self.check_api_rate_limit(request)
-        if not api_allowed:
-            return False, api_message
-        
-        # If API rate limit passed, check token-based rate limiting
-        if requested_tokens is not None:
+        # Request-only checks have just the request windows; with tokens the windows and the
+        # token bucket are decided together, so nothing is charged for a denied request
+        if requested_tokens is None:
+            api_allowed, api_message = self.check_api_rate_limit(request)
+            if not api_allowed:
+                return False, api_message
+        else:
             token_allowed, token_message = self.check_token_based_rate_limit(request, requested_tokens)
             if not token_allowed:
                 return False, token_message
-            
-            return True, f"Request allowed - {api_message} + {token_message}"
+
+        # Charge the provider model's bucket once the app's own limits let the request through;
+        # if it denies after all, the app's charges are given back
+        provider_allowed, provider_message = self.check_provider_rate_limit(requested_tokens)
+        if not provider_allowed:
+            self._refund_app_charges()
+            return False, provider_message
+
+        if requested_tokens is not None:
+            return True, f"Request allowed - API rate limit passed + {token_message}"
         else:
             return True, f"Request allowed - {api_message}"
 
+    def check_provider_rate_limit(self, requested_tokens=None, dry_run=False):
+        """
+        Check the provider model the request goes to against its AIMD-adapted limits (provider_limits)
+        Allowed when provider_limits is unset or doesn't know the provider model
+        """
+        if self.provider_limits is None or self.provider is None:
+            return True, "Provider rate limit passed"
+
+        if self.api_rate_limiter is None:
+            self.api_rate_limiter = RedisTokenBucket(redis_client, metrics=self.metrics)
+        try:
+            decision = self.provider_limits.check(
+                self.api_rate_limiter, self.provider, self.model_id, requested_tokens, dry_run=dry_run
+            )
+        except Exception as e:
+            amt_logger.logger.error(f"Failed provider rate check for {self.provider}:{self.model_id}: {str(e)}")
+            return True, "Provider rate limit passed"
+        finally:
+            self._lap("provider_rate")
+        if decision is None or decision["allowed"]:
+            return True, "Provider rate limit passed"
+        return False, f"Provider capacity exceeded: {decision['message']}"
+
+    def on_provider_response(self, provider, model_id, status_code, headers=None):
+        """
+        Feed a provider response (status code and x-ratelimit-* headers) back into provider_limits
+        """
+        if self.provider_limits is not None:
+            self.provider_limits.on_provider_response(provider, model_id, status_code, headers)
+
+    def acquire_in_flight_slot(self, request):
+        """
+        Concurrency limiting: take one of the in-flight slots for app_id + model_id
+        Uses "concurrency": {"max_in_flight": N, "lease_ttl": seconds} from RATE_LIMITS_DYNAMIC_INIT
+        Returns (allowed, lease); pass the lease to release_in_flight_slot when the response completes
+        """
+        self.data_extraction_from_request(request)
+        model_config = self._get_dynamic_config_for_app_model() or {}
+        concurrency = model_config.get("concurrency", {})
+
+        # No cap configured for this app_id + model_id
+        if not concurrency.get("max_in_flight"):
+            return True, None
+
+        if self.concurrency_limiter is None:
+            self.concurrency_limiter = ConcurrencyLimiter(redis_client)
+        try:
+            lease = self.concurrency_limiter.acquire(
+                self.app_id, self.model_id,
+                concurrency["max_in_flight"], concurrency.get("lease_ttl", 300)
+            )
+        except Exception as e:
+            amt_logger.logger.error(f"Failed to acquire in-flight slot for {self.app_id}:{self.model_id}: {str(e)}")
+            return True, None
+
+        if lease is None:
+            return False, f"Concurrency limit exceeded: {concurrency['max_in_flight']} requests in flight"
+        return True, lease
+
+    def release_in_flight_slot(self, lease):
+        """
+        Release a slot taken by acquire_in_flight_slot (no-op for a None lease)
+        """
+        if lease is None:
+            return
+        try:
+            self.concurrency_limiter.release(lease)
+        except Exception as e:
+            amt_logger.logger.error(f"Failed to release in-flight slot {lease['lease_id']}: {str(e)}")
+
+    def reserve(self, app_id, model_id, tokens, duration, allow_partial=False):
+        """
+        Bulk reservation for batch/offline jobs: book tokens of app_id + model_id capacity
+        for the next `duration` seconds in one call, then spend them locally with
+        reservation.spend(n) and hand back the rest with reservation.release()
+        Returns a Reservation, or None if the bucket can't cover it
+        """
+        self.app_id = app_id
+        self.model_id = model_id
+        self._get_dynamic_config_for_app_model()
+
+        limits = {"max_tokens": self.max_tokens, "refill_rate": self.refill_rate}
+        try:
+            return self._get_capacity_reservations().reserve(app_id, model_id, tokens, duration, limits, allow_partial)
+        except Exception as e:
+            amt_logger.logger.error(f"Failed to reserve {tokens} tokens for {app_id}:{model_id}: {str(e)}")
+            return None
+
+    def _get_capacity_reservations(self):
+        if self.capacity_reservations is None:
+            self.capacity_reservations = CapacityReservations(redis_client)
+        return self.capacity_reservations
+
+    def _refund_expired_reservations(self):
+        try:
+            self._get_capacity_reservations().maybe_refund_expired()
+        except Exception as e:
+            amt_logger.logger.error(f"Failed to refund expired reservations: {str(e)}")
+
     def data_extraction_from_request(self, request):
         """
         Extract app_id and model_id from request - KEEPING YOUR ORIGINAL LOGIC
+        Also sets provider (the cloud provider path segment) once it is validated
         """
+        self.provider = None
         try:
             # YOUR ORIGINAL: Load your config from iConfig
             endpoint_config = json.loads(get_iconfig().configurations["ENDPOINT_CONFIG"])
@@ -347,6 +684,7 @@ class RequestHelper:
         try:
             request_cloud_provider = url_path_parts[0] if len(url_path_parts) > 0 else None
             cloud_provider = endpoint_config[request_cloud_provider]
+            self.provider = request_cloud_provider
         except KeyError:
             amt_logger.logger.debug(
                 f"Cloud provider {request_cloud_provider} not found in {env} config."
@@ -446,13 +784,43 @@ class RequestHelper:
                     }
                     
                     # Store dynamic rate limiting state
-                    redis_key = f"dynamic:{app_id}:{model_id}"
+                    redis_key = dynamic_key(app_id, model_id)
                     redis_client.hset(redis_key, dynamic_state)
                     print(f"Stored dynamic: {redis_key} -> {dynamic_state}")
                     
+            # Later rollouts diff against the config the buckets were initialized from
+            save_applied_config(redis_client, dynamic_ratelimit_config)
         except Exception as e:
             amt_logger.logger.error(f"Failed to initialize Redis dynamic state: {str(e)}")
 
+    def rollout_dynamic_config(self, redis_client):
+        """
+        Apply a RATE_LIMITS_DYNAMIC_INIT change to the live buckets without resetting them:
+        only pairs whose limits changed since the last rollout (recorded in Redis, see
+        config_apply.rollout_config) are rescaled, added pairs are created and removed pairs deleted
+        """
+        try:
+            raw_config = get_iconfig().configurations["RATE_LIMITS_DYNAMIC_INIT"]
+            new_config = json.loads(raw_config)
+        except Exception as e:
+            amt_logger.logger.error(f"Failed to load dynamic rate limits config: {str(e)}")
+            return None
+
+        try:
+            summary = rollout_config(redis_client, new_config)
+        except Exception as e:
+            amt_logger.logger.error(f"Failed to roll out dynamic rate limits config: {str(e)}")
+            return None
+        if summary is None:
+            print("Dynamic config rollout already running in another worker")
+            return None
+
+        self.dynamic_config = new_config
+        self._dynamic_config_raw = raw_config
+        self.negative_cache.invalidate()
+        print(f"Rolled out dynamic config: {summary}")
+        return summary
+
     def init_redis_api_rate_state(self, redis_client):
         """
         Initialize Redis state for API rate limiting (from RATE_LIMITS)
@@ -466,17 +834,16 @@ class RequestHelper:
                 for model in app["models"]:
                     model_id = model["model_id"]
                     
-                    # Initialize API rate limiting state
+                    # Initialize API rate limiting state: every window empty and starting now
                     now = time.time()
-                    api_state = {
-                        "requests_this_minute": 0,
-                        "minute_window_start": now,
-                        "requests_this_second": 0,
-                        "second_window_start": now
-                    }
+                    api_state = {}
+                    for _, seconds, unit in windows_from_rate_limit(model.get("rate_limit", {}), rpm=60, rps=1):
+                        count_field, start_field = window_fields(seconds, unit)
+                        api_state[count_field] = 0
+                        api_state[start_field] = now
                     
                     # Store API rate limiting state
-                    redis_key = f"api_rate:{app_id}:{model_id}"
+                    redis_key = api_rate_key(app_id, model_id)
                     redis_client.hset(redis_key, api_state)
                     print(f"Stored API rate: {redis_key} -> {api_state}")
                     
@@ -0,0 +1,255 @@
+import json
+import threading
+import time
+import uuid
+
+from redis_token_bucket import DEFAULT_LIMITS, dynamic_key, pair_tag
+
+# Shared by the scripts below: collect the unused part of expired reservations
+#
+# KEYS[1] dynamic:{app_id:model_id}        token bucket (same hash RequestHelper uses)
+# KEYS[2] reservations:{app_id:model_id}   zset of reservation id -> expires at
+# KEYS[3] reservation:{app_id:model_id}    hash of "{id}:granted" / "{id}:used"
+# ARGV[1] now
+SWEEP_LUA = """
+local now = tonumber(ARGV[1])
+local refund = 0
+for _, id in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now)) do
+    local granted = tonumber(redis.call('HGET', KEYS[3], id .. ':granted')) or 0
+    local used = tonumber(redis.call('HGET', KEYS[3], id .. ':used')) or 0
+    refund = refund + math.max(granted - used, 0)
+    redis.call('HDEL', KEYS[3], id .. ':granted', id .. ':used')
+    redis.call('ZREM', KEYS[2], id)
+end
+"""
+
+# Returns the refund to the bucket as is; the next refill caps it at max_tokens like any other gain
+# Returns the tokens refunded
+EXPIRE_LUA = SWEEP_LUA + """
+if refund > 0 and redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('HINCRBYFLOAT', KEYS[1], 'available_tokens', refund)
+end
+return tostring(refund)
+"""
+
+# Sweep, then refill the bucket to now with the refund on top
+# ARGV[2..3] max_tokens, refill_rate
+SWEEP_AND_REFILL_LUA = SWEEP_LUA + """
+local max_tokens = tonumber(ARGV[2])
+local refill_rate = tonumber(ARGV[3])
+
+local bucket = redis.call('HMGET', KEYS[1], 'available_tokens', 'last_refill_ts')
+local available = tonumber(bucket[1]) or max_tokens
+local last_refill = tonumber(bucket[2]) or now
+available = math.min(max_tokens, available + (now - last_refill) * refill_rate + refund)
+"""
+
+# ARGV[4..7] reservation id, tokens, duration, allow_partial
+# Books at most what the bucket holds now, so interactive traffic never finds it below zero
+RESERVE_LUA = SWEEP_AND_REFILL_LUA + """
+local id = ARGV[4]
+local tokens = tonumber(ARGV[5])
+local duration = tonumber(ARGV[6])
+local bookable = math.max(available, 0)
+
+local granted = tokens
+if tokens > bookable then
+    if ARGV[7] ~= '1' then
+        redis.call('HSET', KEYS[1], 'available_tokens', tostring(available), 'last_refill_ts', tostring(now))
+        return {0, '0', tostring(available)}
+    end
+    granted = math.floor(bookable)
+end
+
+available = available - granted
+redis.call('HSET', KEYS[1], 'available_tokens', tostring(available), 'last_refill_ts', tostring(now))
+if granted > 0 then
+    redis.call('ZADD', KEYS[2], now + duration, id)
+    redis.call('HSET', KEYS[3], id .. ':granted', granted, id .. ':used', 0)
+end
+return {1, tostring(granted), tostring(available)}
+"""
+
+# ARGV[4..5] reservation id, tokens used
+# Returns what was refunded; 0 if the reservation had already expired (and been refunded)
+RELEASE_LUA = SWEEP_AND_REFILL_LUA + """
+local id = ARGV[4]
+local granted = tonumber(redis.call('HGET', KEYS[3], id .. ':granted'))
+local unused = 0
+if granted then
+    local used = math.max(tonumber(ARGV[5]), tonumber(redis.call('HGET', KEYS[3], id .. ':used')) or 0)
+    unused = math.max(granted - used, 0)
+    available = math.min(max_tokens, available + unused)
+    redis.call('HDEL', KEYS[3], id .. ':granted', id .. ':used')
+    redis.call('ZREM', KEYS[2], id)
+end
+redis.call('HSET', KEYS[1], 'available_tokens', tostring(available), 'last_refill_ts', tostring(now))
+return tostring(unused)
+"""
+
+# Records usage so far, so a job that dies only gets its real leftover refunded on expiry
+CHECKPOINT_LUA = """
+if redis.call('HEXISTS', KEYS[1], ARGV[1] .. ':granted') == 1 then
+    redis.call('HSET', KEYS[1], ARGV[1] .. ':used', ARGV[2])
+    return 1
+end
+return 0
+"""
+
+
+# Every live reservation of every pair, scored by expiry, so expired ones get refunded even if
+# nothing touches their pair again; members are JSON [app_id, model_id, reservation id]
+RESERVATION_EXPIRY_KEY = "reservation_expiry"
+
+
+def reservation_keys(app_id, model_id):
+    return [
+        dynamic_key(app_id, model_id),
+        f"reservations:{pair_tag(app_id, model_id)}",
+        f"reservation:{pair_tag(app_id, model_id)}"
+    ]
+
+
+class Reservation:
+    def __init__(self, reservations, app_id, model_id, limits, reservation_id, granted, expires_at, checkpoint_every):
+        """
+        Capacity booked for a batch job, spent locally without further limiter calls
+        """
+        self.reservations = reservations
+        self.app_id = app_id
+        self.model_id = model_id
+        self.limits = limits
+        self.reservation_id = reservation_id
+        self.granted = granted
+        self.expires_at = expires_at
+        self.checkpoint_every = checkpoint_every
+        self.used = 0
+        self._checkpointed = 0
+        self.released = False
+
+    def spend(self, tokens):
+        """
+        Take tokens from the reservation; False once it is used up, expired or released
+        """
+        if self.released or time.time() >= self.expires_at or self.used + tokens > self.granted:
+            return False
+        self.used += tokens
+        if self.used - self._checkpointed >= self.checkpoint_every:
+            self.reservations.checkpoint(self)
+        return True
+
+    @property
+    def remaining(self):
+        return self.granted - self.used
+
+    def release(self):
+        """
+        Hand the unused part back to the bucket; returns the number of tokens refunded
+        """
+        if self.released:
+            return 0
+        self.released = True
+        return self.reservations.release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class CapacityReservations:
+    def __init__(self, redis_client, checkpoint_every=10000, sweep_interval=5):
+        """
+        Bulk reservations on the dynamic:{app_id:model_id} token buckets for batch/offline jobs
+        One call books a chunk of capacity; unused tokens go back on release, or on expiry
+        (minus usage checkpointed every checkpoint_every tokens) if the job never releases.
+        Expired reservations are refunded by refund_expired(), which the limiter's check path
+        runs through maybe_refund_expired() at most once per sweep_interval seconds per worker
+        """
+        self.redis_client = redis_client
+        self.checkpoint_every = checkpoint_every
+        self.sweep_interval = sweep_interval
+        self._reserve = redis_client.register_script(RESERVE_LUA)
+        self._release = redis_client.register_script(RELEASE_LUA)
+        self._checkpoint = redis_client.register_script(CHECKPOINT_LUA)
+        self._expire = redis_client.register_script(EXPIRE_LUA)
+        self._last_sweep = 0.0
+        self._sweep_lock = threading.Lock()
+
+    def reserve(self, app_id, model_id, tokens, duration, limits=None, allow_partial=False, now=None):
+        """
+        Atomically book tokens of the bucket's current capacity for the next `duration` seconds
+        Returns a Reservation, or None if the bucket can't cover it (allow_partial books what it can)
+        """
+        if now is None:
+            now = time.time()
+        limits = {**DEFAULT_LIMITS, **(limits or {})}
+        reservation_id = uuid.uuid4().hex
+
+        booked, granted, _ = self._reserve(
+            keys=reservation_keys(app_id, model_id),
+            args=[now, limits["max_tokens"], limits["refill_rate"],
+                  reservation_id, tokens, duration, 1 if allow_partial else 0]
+        )
+        granted = float(granted)
+        if not booked or granted <= 0:
+            return None
+        self.redis_client.zadd(RESERVATION_EXPIRY_KEY, {json.dumps([app_id, model_id, reservation_id]): now + duration})
+        return Reservation(self, app_id, model_id, limits, reservation_id, granted, now + duration, self.checkpoint_every)
+
+    def checkpoint(self, reservation):
+        self._checkpoint(
+            keys=[reservation_keys(reservation.app_id, reservation.model_id)[2]],
+            args=[reservation.reservation_id, reservation.used]
+        )
+        reservation._checkpointed = reservation.used
+
+    def release(self, reservation, now=None):
+        if now is None:
+            now = time.time()
+        limits = reservation.limits
+        refunded = self._release(
+            keys=reservation_keys(reservation.app_id, reservation.model_id),
+            args=[now, limits["max_tokens"], limits["refill_rate"], reservation.reservation_id, reservation.used]
+        )
+        self.redis_client.zrem(
+            RESERVATION_EXPIRY_KEY, json.dumps([reservation.app_id, reservation.model_id, reservation.reservation_id])
+        )
+        return float(refunded)
+
+    def refund_expired(self, now=None, batch_size=1000):
+        """
+        Return the unused part of every expired reservation to its bucket, whatever pair it is on
+        Safe to run from every worker at once: each reservation is refunded by one sweep only
+        Returns the number of tokens refunded
+        """
+        if now is None:
+            now = time.time()
+        refunded = 0.0
+        while True:
+            members = self.redis_client.zrangebyscore(RESERVATION_EXPIRY_KEY, "-inf", now, start=0, num=batch_size)
+            if not members:
+                return refunded
+            pairs = {tuple(json.loads(member)[:2]) for member in members}
+            pipe = self.redis_client.pipeline(transaction=False)
+            for app_id, model_id in pairs:
+                self._expire(keys=reservation_keys(app_id, model_id), args=[now], client=pipe)
+            refunded += sum(float(refund) for refund in pipe.execute())
+            self.redis_client.zrem(RESERVATION_EXPIRY_KEY, *members)
+            if len(members) < batch_size:
+                return refunded
+
+    def maybe_refund_expired(self, now=None):
+        """
+        refund_expired() if this worker hasn't swept for sweep_interval seconds; cheap enough per request
+        """
+        if now is None:
+            now = time.time()
+        if now - self._last_sweep < self.sweep_interval or not self._sweep_lock.acquire(blocking=False):
+            return 0.0
+        try:
+            self._last_sweep = now
+            return self.refund_expired(now)
+        finally:
+            self._sweep_lock.release()
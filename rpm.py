@@ -1,26 +1,32 @@
-from slowapi.errors import RateLimitExceeded
-from starlette.responses import JSONResponse
+import asyncio
+from limits import parse
+from asgi_limiter import RateLimitMiddleware, helper_ids
 
-@app.middleware("http")
-async def extract_ids(request: Request, call_next):
-    # Extract once per request
-    app_id, model_id = request_helper.data_extraction_from_request(request)
-    request.state.app_id = app_id
-    request.state.model_id = model_id
+# Used when the pair has no request window to parse (no config, or token windows only)
+DEFAULT_RATE_LIMIT = "60/minute"
 
-    # Use your existing function to get the limiter key
-    limit_key = request_helper.get_rate_limiting_string(request)
-
-    # Apply SlowAPI limit check manually
+async def limits_check(app_id, model_id, requested_tokens):
+    # "10/second;500/minute" style windows for this app_id + model_id; parse keeps the first
+    # (read before the first await, while request_helper still holds this request's ids)
     try:
-        limiter._check_request_limit(
-            request,
-            lambda req: limit_key,  # Key function
-            False
-        )
-    except RateLimitExceeded:
-        return JSONResponse({"error": "Rate limit exceeded"}, status_code=429)
+        limit_item = parse(request_helper.get_rate_limiting_string() or DEFAULT_RATE_LIMIT)
+    except ValueError:
+        limit_item = parse(DEFAULT_RATE_LIMIT)
+
+    # One atomic call enforces every configured window and the token bucket
+    # (limiter is created with strategy="token-bucket", see limits_storage.py); it is a
+    # Redis round trip, so it runs in a worker thread instead of on the event loop.
+    # The storage's decision dict carries remaining/reset_at for the X-RateLimit headers
+    return await asyncio.to_thread(
+        limiter.limiter.storage.acquire, app_id, model_id, limit_item, cost=requested_tokens
+    )
+
+def requested_tokens(scope):
+    return scope.get("state", {}).get("requested_tokens", 1)
 
-    # Continue to next handler
-    response = await call_next(request)
-    return response
+# Extracts the ids once per request into request.state.app_id / model_id and answers a denied
+# request with a 429 before it reaches the app (pure ASGI, see asgi_limiter.py)
+app.add_middleware(
+    RateLimitMiddleware, check=limits_check, extract_ids=helper_ids(request_helper),
+    requested_tokens=requested_tokens
+)
@@ -0,0 +1,124 @@
+import fcntl
+import os
+import threading
+from multiprocessing import resource_tracker, shared_memory
+
+from mmap_state import HEADER, KEY_SIZE, MAGIC, RECORD, STATE, VERSION, _encode_key
+from token_bucket import BUCKET_FIELDS, apply_token_bucket, compile_slot_table
+
+
+class SharedBucketTable:
+    def __init__(self, config, name="rate_limiter_buckets", lock_dir="/dev/shm"):
+        """
+        Bucket table in multiprocessing.shared_memory, shared by every worker process on a host
+        Same record layout as MmapBucketStore, so it is a drop-in replacement for it.
+        The first process to start creates and fills the segment, the rest attach by name.
+        Per-slot locks are fcntl byte-range locks on a lock file (byte N = slot N), so they
+        work whether workers are forked (gunicorn) or spawned (uvicorn --workers)
+        """
+        self.name = name
+        self.slots, self.limits, initial_states = compile_slot_table(config)
+        self.keys = [None] * len(self.limits)
+        for (app_id, model_id), slot in self.slots.items():
+            self.keys[slot] = _encode_key(app_id, model_id)
+
+        # fcntl locks are per process, so threads in the same worker also need a lock per slot
+        self._thread_locks = [threading.Lock() for _ in self.limits]
+
+        size = HEADER.size + RECORD.size * len(self.limits)
+        self.lock_path = os.path.join(lock_dir, f"{name}.lock")
+        self.lock_fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+
+        # Whole-file lock so nobody attaches while the creator is still filling the table
+        fcntl.lockf(self.lock_fd, fcntl.LOCK_EX)
+        try:
+            try:
+                self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+                created = True
+            except FileExistsError:
+                self.shm = shared_memory.SharedMemory(name=name)
+                created = False
+
+            # The segment outlives any single worker; without this the resource tracker
+            # unlinks it as soon as the process that touched it exits. Call unlink() on shutdown
+            resource_tracker.unregister(self.shm._name, "shared_memory")
+
+            if created:
+                self._initialize(initial_states)
+            else:
+                self._check_layout()
+        finally:
+            fcntl.lockf(self.lock_fd, fcntl.LOCK_UN)
+
+    def _offset(self, slot):
+        return HEADER.size + slot * RECORD.size
+
+    def _initialize(self, initial_states):
+        """
+        Fill a freshly created segment from the config
+        """
+        buf = self.shm.buf
+        HEADER.pack_into(buf, 0, MAGIC, VERSION, len(self.limits))
+        for slot, key in enumerate(self.keys):
+            state = initial_states[slot]
+            RECORD.pack_into(buf, self._offset(slot), key, *(state[field] for field in BUCKET_FIELDS))
+
+    def _check_layout(self):
+        """
+        Make sure an existing segment was built from the same config as this worker's
+        """
+        buf = self.shm.buf
+        magic, version, count = HEADER.unpack_from(buf, 0)
+        keys = [RECORD.unpack_from(buf, self._offset(slot))[0].rstrip(b"\x00") for slot in range(count)]
+        if magic != MAGIC or version != VERSION or keys != self.keys:
+            raise ValueError(
+                f"Shared bucket table {self.name} was created from a different config; "
+                f"unlink it and restart all workers"
+            )
+
+    def apply(self, app_id, model_id, requested_tokens=1, now=None):
+        """
+        Apply the token bucket to one slot under a per-slot lock
+        Raises KeyError if the (app_id, model_id) is not in the config
+        Returns (allowed, message)
+        """
+        slot = self.slots[(app_id, model_id)]
+        offset = self._offset(slot) + KEY_SIZE
+        buf = self.shm.buf
+
+        with self._thread_locks[slot]:
+            fcntl.lockf(self.lock_fd, fcntl.LOCK_EX, 1, slot, os.SEEK_SET)
+            try:
+                state = dict(zip(BUCKET_FIELDS, STATE.unpack_from(buf, offset)))
+                allowed, message = apply_token_bucket(state, self.limits[slot], requested_tokens, now)
+                if allowed:
+                    STATE.pack_into(buf, offset, *(state[field] for field in BUCKET_FIELDS))
+            finally:
+                fcntl.lockf(self.lock_fd, fcntl.LOCK_UN, 1, slot, os.SEEK_SET)
+        return allowed, message
+
+    def get_state(self, app_id, model_id):
+        """
+        Current state for one (app_id, model_id), for inspection
+        """
+        slot = self.slots[(app_id, model_id)]
+        return dict(zip(BUCKET_FIELDS, STATE.unpack_from(self.shm.buf, self._offset(slot) + KEY_SIZE)))
+
+    def close(self):
+        """
+        Detach this worker; the table stays available to the others
+        """
+        self.shm.close()
+        os.close(self.lock_fd)
+
+    def unlink(self):
+        """
+        Remove the segment for good, e.g. from the gunicorn master on shutdown or after a config change
+        """
+        # SharedMemory.unlink() unregisters from the resource tracker again, so hand it back first
+        resource_tracker.register(self.shm._name, "shared_memory")
+        self.shm.unlink()
+        try:
+            os.remove(self.lock_path)
+        except FileNotFoundError:
+            pass
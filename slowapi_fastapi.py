@@ -24,18 +24,25 @@ async def inference(request: Request, payload: PayloadModel):
 --------------
 # limiter_config.py or app.py
 from slowapi import Limiter
-from limits.storage import RedisStorage  # optional for production
+from limits_storage import policies_from_config  # registers tokenbucket+redis:// and "token-bucket"
 
 def rate_limit_key_func(request):
     return f"{request.state.app_id}:{request.state.model}"
 
+# rpm window and token bucket are enforced together in one Redis call per limit
 limiter = Limiter(
     key_func=rate_limit_key_func,
-    storage_uri="redis://localhost:6379"  # optional: for persistent, distributed limits
+    storage_uri="tokenbucket+redis://localhost:6379",
+    storage_options={"policies": policies_from_config(rate_limits_config)},
+    strategy="token-bucket"
 )
 
+def requested_tokens(request):
+    return getattr(request.state, "requested_tokens", 1)
 
 @router.post("/v1/chat/completions")
+# cost= is what the token bucket charges; the "N/minute" part is the request window
+@limiter.limit("6/minute", cost=requested_tokens)
 async def chat_completions(params: LLMV1ChatCompletion, request: Request):
     request.state.app_id = params.app_id
     request.state.model = params.model
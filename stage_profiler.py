@@ -0,0 +1,187 @@
+import cProfile
+import itertools
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+
+class StageProfiler:
+    def __init__(self, reservoir=4096, profile_rate=0.0, profile_mode="cprofile"):
+        """
+        Per-stage latency of limiter decisions (extract, config, check, ...)
+        Each stage keeps its last `reservoir` durations in a ring (lock-free like DecisionTracer),
+        from which summary() computes p50/p99. Timings use perf_counter_ns, which is monotonic.
+
+        profile_rate > 0 also runs that fraction of decisions under a profiler:
+        - "cprofile": one cProfile.Profile across all sampled decisions, dump_cprofile() writes pstats
+        - "stacks": call stacks with self time, dump_stacks() writes the collapsed format that
+          flamegraph.pl / speedscope read
+        One decision is profiled at a time; a sampled decision that finds the profiler busy runs unprofiled.
+        Leave the profiler unset (None) on the limiter to disable it
+        """
+        self.reservoir = reservoir
+        self.profile_rate = profile_rate
+        self.profile_mode = profile_mode
+        self._stages = {}  # stage -> (ring of durations, itertools.count)
+        self._profile = cProfile.Profile() if profile_mode == "cprofile" else None
+        self._stacks = {}
+        self._profile_lock = threading.Lock()
+        self.profiled = 0
+
+    def start(self):
+        return time.perf_counter_ns()
+
+    def record(self, stage, duration_ns):
+        entry = self._stages.get(stage)
+        if entry is None:
+            entry = self._stages.setdefault(stage, ([None] * self.reservoir, itertools.count()))
+        samples, counter = entry
+        samples[next(counter) % self.reservoir] = duration_ns
+
+    def lap(self, stage, started_ns):
+        """
+        Record the time since started_ns as one stage; returns the start of the next one
+        """
+        now = time.perf_counter_ns()
+        self.record(stage, now - started_ns)
+        return now
+
+    def summary(self):
+        """
+        {stage: {"count", "mean_us", "p50_us", "p99_us", "max_us"}} over the samples held
+        """
+        summary = {}
+        for stage, (samples, _) in list(self._stages.items()):
+            durations = sorted(d for d in samples if d is not None)
+            if not durations:
+                continue
+            count = len(durations)
+            summary[stage] = {
+                "count": count,
+                "mean_us": sum(durations) / count / 1000,
+                "p50_us": durations[(count - 1) // 2] / 1000,
+                "p99_us": durations[min(count - 1, int(count * 0.99))] / 1000,
+                "max_us": durations[-1] / 1000
+            }
+        return summary
+
+    def save(self, path):
+        """
+        Write summary() as JSON, the input of compare()
+        """
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2, sort_keys=True)
+
+    def should_profile(self):
+        return self.profile_rate > 0 and random.random() < self.profile_rate
+
+    def run_profiled(self, fn, *args, **kwargs):
+        if not self._profile_lock.acquire(blocking=False):
+            return fn(*args, **kwargs)
+        try:
+            self.profiled += 1
+            if self._profile is not None:
+                return self._profile.runcall(fn, *args, **kwargs)
+            return self._run_with_stacks(fn, args, kwargs)
+        finally:
+            self._profile_lock.release()
+
+    def _run_with_stacks(self, fn, args, kwargs):
+        # names is the current call stack, frames its [start_ns, child_ns]; a frame's self time
+        # is charged to its full stack when it returns
+        frames = []
+        names = []
+        stacks = self._stacks
+
+        def hook(frame, event, arg):
+            if event == "call" or event == "c_call":
+                if event == "call":
+                    code = frame.f_code
+                    name = f"{os.path.basename(code.co_filename).rsplit('.', 1)[0]}:{code.co_name}"
+                else:
+                    name = getattr(arg, "__qualname__", getattr(arg, "__name__", "?"))
+                names.append(name)
+                frames.append([time.perf_counter_ns(), 0])
+            elif frames:
+                started_ns, child_ns = frames.pop()
+                elapsed = time.perf_counter_ns() - started_ns
+                stack = ";".join(names)
+                names.pop()
+                stacks[stack] = stacks.get(stack, 0) + elapsed - child_ns
+                if frames:
+                    frames[-1][1] += elapsed
+
+        sys.setprofile(hook)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            sys.setprofile(None)
+
+    def dump_cprofile(self, path):
+        """
+        pstats file of the profiled decisions (python -m pstats, snakeviz)
+        """
+        if self._profile is None:
+            raise ValueError(f"No cProfile data in {self.profile_mode!r} mode, use dump_stacks()")
+        self._profile.dump_stats(path)
+
+    def dump_stacks(self, path):
+        """
+        Collapsed stacks, one "frame;frame;frame self_time_us" line each (flamegraph.pl input)
+        """
+        with open(path, "w") as f:
+            for stack, self_ns in sorted(self._stacks.items()):
+                if self_ns >= 1000:
+                    f.write(f"{stack} {self_ns // 1000}\n")
+
+
+def compare(baseline, current, threshold=0.1, stat="p99_us", min_delta_us=1.0):
+    """
+    Stages whose stat got worse than baseline by more than threshold (relative) and
+    min_delta_us (absolute, so sub-microsecond noise doesn't fail a run)
+    Returns [(stage, baseline value, current value)]; stages missing on either side are skipped
+    """
+    regressions = []
+    for stage, before in sorted(baseline.items()):
+        after = current.get(stage)
+        if after is None:
+            continue
+        if after[stat] > before[stat] * (1 + threshold) and after[stat] - before[stat] > min_delta_us:
+            regressions.append((stage, before[stat], after[stat]))
+    return regressions
+
+
+# Benchmark comparator: python stage_profiler.py baseline.json current.json [--threshold 0.1] [--stat p99_us]
+# Exits 1 if any stage regressed; the files are StageProfiler.save() output
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Compare two StageProfiler summaries")
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument("--threshold", type=float, default=0.1, help="allowed relative slowdown per stage")
+    parser.add_argument("--stat", default="p99_us", choices=("mean_us", "p50_us", "p99_us", "max_us"))
+    parser.add_argument("--min-delta-us", type=float, default=1.0, help="ignore slowdowns smaller than this")
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+
+    for stage in sorted(set(baseline) | set(current)):
+        before = baseline.get(stage, {}).get(args.stat)
+        after = current.get(stage, {}).get(args.stat)
+        if before is None or after is None:
+            print(f"{stage:>16}: only in {'current' if before is None else 'baseline'}")
+        else:
+            change = (after / before - 1) * 100 if before else 0
+            print(f"{stage:>16}: {before:10.1f}us -> {after:10.1f}us ({change:+.0f}%)")
+
+    regressions = compare(baseline, current, args.threshold, args.stat, args.min_delta_us)
+    for stage, before, after in regressions:
+        print(f"REGRESSION {stage}: {args.stat} {before:.1f}us -> {after:.1f}us (threshold {args.threshold:.0%})")
+    sys.exit(1 if regressions else 0)
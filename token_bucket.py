@@ -0,0 +1,166 @@
+import math
+import time
+
+from policy_spec import windows_from_rate_limit
+
+# Dynamic state fields, same names as the Redis hash fields in RequestHelper
+BUCKET_FIELDS = ("available_tokens", "last_refill_ts", "burst_tokens_used", "burst_window_start")
+
+# Burst accounting (burst "decay"): None zeroes burst_tokens_used once burst_window has elapsed;
+# "linear" drains it by burst_capacity per burst_window and "exponential" shrinks it by a factor e
+# per burst_window, both continuously, so capacity comes back gradually instead of all at once.
+# In the decaying modes burst_window_start holds the time of the last decay
+BURST_DECAY_MODES = (None, "linear", "exponential")
+
+# burst_capacity of a model whose config doesn't set one, here and in RequestHelper
+DEFAULT_BURST_CAPACITY = 100
+
+
+# Priority classes (app "priority"): a class is shed once shared model capacity would fall
+# below shed_below of its size; override per config with "priority_classes"
+DEFAULT_PRIORITY_CLASSES = {
+    "premium": {"shed_below": 0},
+    "standard": {"shed_below": 0.1},
+    "basic": {"shed_below": 0.3}
+}
+
+
+def _app_id_of(app):
+    """
+    Configs use either "app_id" (rate_limits.json) or "application-id" (iConfig)
+    """
+    return app.get("app_id", app.get("application-id"))
+
+
+def shadow_limits(policy, live_limits):
+    """
+    Token bucket limits of a shadow policy: its own rate_limit/burst values over the live ones
+    """
+    rate_limit = policy.get("rate_limit", {})
+    burst = policy.get("burst", {})
+    return {
+        "name": policy["name"],
+        "max_tokens": rate_limit.get("max_tokens", live_limits["max_tokens"]),
+        "refill_rate": rate_limit.get("refill_rate", live_limits["refill_rate"]),
+        "burst_capacity": burst.get("burst_capacity", burst.get("capacity", live_limits["burst_capacity"])),
+        "burst_window": burst.get("burst_window", burst.get("window", live_limits["burst_window"]))
+    }
+
+
+def decay_burst(burst_tokens_used, elapsed, burst_capacity, burst_window, decay):
+    """
+    burst_tokens_used after elapsed seconds in a decaying burst mode
+    """
+    if burst_window <= 0:
+        return 0.0
+    if decay == "linear":
+        return max(0.0, burst_tokens_used - elapsed * burst_capacity / burst_window)
+    if decay == "exponential":
+        return burst_tokens_used * math.exp(-elapsed / burst_window)
+    raise ValueError(f"Unknown burst decay {decay!r}, expected one of {BURST_DECAY_MODES}")
+
+
+def compile_slot_table(config):
+    """
+    Compile a rate limit config into an (app_id, model_id) -> slot table
+    Returns (slots, limits, initial_states), all indexed by slot number
+    Slots are assigned in sorted key order so the same config always gives the same layout
+    """
+    entries = []
+    for app in config.get("apps", []):
+        app_id = _app_id_of(app)
+        for model in app.get("models", []):
+            entries.append(((app_id, model["model_id"]), app, model))
+    entries.sort(key=lambda entry: entry[0])
+
+    priority_classes = {**DEFAULT_PRIORITY_CLASSES, **config.get("priority_classes", {})}
+    shared_capacity = config.get("shared_capacity", {})
+
+    now = time.time()
+    slots = {}
+    limits = []
+    initial_states = []
+    for key, app, model in entries:
+        rate_limit = model.get("rate_limit", {})
+        burst = model.get("burst", {})
+        max_tokens = rate_limit.get("max_tokens", 1000)
+        if burst.get("decay") not in BURST_DECAY_MODES:
+            raise ValueError(f"{key}: unknown burst decay {burst['decay']!r}, expected one of {BURST_DECAY_MODES}")
+        # A misspelled class must not pass as one that is never shed
+        priority = app.get("priority", "standard")
+        if priority not in priority_classes:
+            raise ValueError(f"{key}: unknown priority {priority!r}, expected one of {sorted(priority_classes)}")
+
+        slots[key] = len(limits)
+        model_limits = {
+            "rpm": rate_limit.get("rpm"),
+            "rps": rate_limit.get("rps"),
+            # Every request/token window of the model, "windows" or rpm/rps (see policy_spec)
+            "windows": windows_from_rate_limit(rate_limit),
+            "max_tokens": max_tokens,
+            "refill_rate": rate_limit.get("refill_rate", 10),
+            "burst_capacity": burst.get("burst_capacity", burst.get("capacity", DEFAULT_BURST_CAPACITY)),
+            "burst_window": burst.get("burst_window", burst.get("window", 60)),
+            "burst_decay": burst.get("decay"),
+            # App-wide long-horizon quotas and this model's weight in them
+            "quotas": app.get("quotas"),
+            "cost_per_1k_tokens": rate_limit.get("cost_per_1k_tokens"),
+            # Model capacity shared by all apps ("shared_capacity": {model_id: {max_tokens, refill_rate}})
+            "shared_capacity": shared_capacity.get(model["model_id"]),
+            "shed_below": priority_classes[priority].get("shed_below", 0)
+        }
+        # Trial policies ("shadow": [{"name", "rate_limit", "burst"}]), fields default to the live ones
+        model_limits["shadow"] = [shadow_limits(policy, model_limits) for policy in model.get("shadow", [])]
+        limits.append(model_limits)
+        initial_states.append({
+            "available_tokens": rate_limit.get("available_tokens", max_tokens),
+            "last_refill_ts": rate_limit.get("last_refill_ts", now),
+            "burst_tokens_used": burst.get("burst_tokens_used", 0),
+            "burst_window_start": burst.get("burst_window_start", now)
+        })
+    return slots, limits, initial_states
+
+
+def apply_token_bucket(state, limits, requested_tokens=1, now=None):
+    """
+    Token bucket + burst window decision used by the in-process limiters (sample_main.py semantics)
+    Updates state in place only when the request is allowed
+    Returns (allowed, message)
+    """
+    if now is None:
+        now = time.time()
+
+    # Refill logic; fractional tokens are kept, since last_refill_ts moves to now on every
+    # allowed request and truncating would starve buckets with a low refill_rate
+    elapsed = now - state["last_refill_ts"]
+    refilled_tokens = elapsed * limits["refill_rate"]
+    new_available = min(state["available_tokens"] + refilled_tokens, limits["max_tokens"])
+
+    if new_available < requested_tokens:
+        return False, "Token bucket limit exceeded"
+
+    # Burst check
+    burst_window_start = state["burst_window_start"]
+    burst_tokens_used = state["burst_tokens_used"]
+    if limits["burst_capacity"]:
+        if limits.get("burst_decay"):
+            burst_tokens_used = decay_burst(
+                burst_tokens_used, now - burst_window_start, limits["burst_capacity"], limits["burst_window"],
+                limits["burst_decay"]
+            ) + requested_tokens
+            if burst_tokens_used > limits["burst_capacity"]:
+                return False, "Burst limit exceeded"
+            burst_window_start = now
+        elif now - burst_window_start > limits["burst_window"]:
+            burst_window_start = now
+            burst_tokens_used = requested_tokens
+        else:
+            if burst_tokens_used + requested_tokens > limits["burst_capacity"]:
+                return False, "Burst limit exceeded"
+            burst_tokens_used += requested_tokens
+
+    state["available_tokens"] = new_available - requested_tokens
+    state["last_refill_ts"] = now
+    state["burst_tokens_used"] = burst_tokens_used
+    state["burst_window_start"] = burst_window_start
+    return True, "Allowed"